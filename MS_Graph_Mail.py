@@ -1,209 +1,880 @@
-import authentication, json, configparser, os.path
-import urllib.request, urllib.parse, urllib.error
+import authentication, json, os.path, http.client, re, threading, zlib
+import urllib.parse
+from time import time
 from datetime import datetime
+from collections import namedtuple
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from connection_pool import ConnectionPool
+from json_stream import CollectionReader
+from file_store import FileLock, write_json, read_json
+from request_scheduler import RequestScheduler, RETRY_STATUSES, parse_retry_after
+from instrumentation import logger, span
+import instrumentation
 
-def get_messages(folder_paths = None, params = None):
+__all__ = ['get_messages', 'iter_messages', 'iter_message_records', 'MessageRecord',
+           'fetch_folders', 'FolderResult', 'sync_messages', 'SyncResult', 'get_request',
+           'request_json', 'send_request', 'iter_pages', 'batch_requests', 'BatchResponse',
+           'mailbox_key', 'get_scheduler_stats', 'get_connection_stats', 'get_folder_ids',
+           'get_folder_index', 'FolderIndex', 'GRAPH_ROOT', 'BATCH_LIMIT']
+
+# Root of every Graph url. Can be pointed at a local stand-in server (see benchmark.py),
+# so read it as MS_Graph_Mail.GRAPH_ROOT rather than importing it
+GRAPH_ROOT = "https://graph.microsoft.com/v1.0"
+
+# All Graph requests share one keep-alive connection pool, so only the first
+# request to graph.microsoft.com pays for the TCP + TLS handshake
+_pool = ConnectionPool()
+
+# Every request also goes through one scheduler, which rate limits per mailbox
+# (per account for /me) and retries throttled (429 / 503) requests after their Retry-After
+_scheduler = RequestScheduler()
+
+# Result of fetching a single folder concurrently. error is None on success,
+# otherwise messages is empty and error holds the exception for that folder only.
+FolderResult = namedtuple('FolderResult', ['folder', 'messages', 'error'])
+
+def get_messages(folder_paths = None, params = None, max_workers = None, store = None,
+                 query = None):
     """Grabs messages from the Microsoft Graph API. It will take 
     the folder paths is the format this/is/path1;this/is/path2 and
     find the folder ids asscociated with the paths to grab the messages
     from the folders according to the params. If no params are provided,
-    it will grab all messages in the folders from today."""
+    it will grab all messages in the folders from today.
+    If max_workers is given, the folders are fetched concurrently and a 
+    folder that fails is reported and skipped instead of failing the rest.
+    If a MessageStore is given, every message fetched is also written to it.
+    With a MessageQuery (mail_query.py) instead of params, only the messages
+    and fields it asks for are downloaded, and each message is returned as a
+    dict of the query's fields."""
     
-    headers = authentication.get_headers()
+    if query is not None:
+        return _query_messages(folder_paths, params, max_workers, store, query)
     
-    if not folder_paths:
-        folder_paths = 'inbox'
+    if not max_workers and store is None:
+        # Decoded straight from the response, without holding whole pages
+        return [ {  'subject' : message.subject,
+                    'body'    : message.body   }
+                        for message in iter_message_records(folder_paths, params) ]
+    
+    if max_workers:
+        messages = []
+        for result in fetch_folders(folder_paths, params, max_workers=max_workers, 
+                                    store=store):
+            if result.error:
+                logger.error(f"Failed to get messages from {result.folder}: {result.error}")
+                continue
+            messages.extend(result.messages)
+    else:
+        messages = iter_messages(folder_paths, params, store=store)
+    
+    return [ {  'subject' : message['subject'], 
+                'body'    : message['body']['content']   } 
+                    for message in messages ]
+
+def _query_messages(folder_paths, params, max_workers, store, query):
+    compiled = _compile(query, params)
+    
+    if max_workers:
+        messages = []
+        for result in fetch_folders(folder_paths, max_workers=max_workers, store=store,
+                                    query=compiled):
+            if result.error:
+                logger.error(f"Failed to get messages from {result.folder}: {result.error}")
+                continue
+            messages.extend(result.messages)
+        if compiled.limit is not None:
+            messages = messages[:compiled.limit]
+    else:
+        messages = iter_messages(folder_paths, store=store, query=compiled)
     
-    folder_ids = _get_folder_ids(folder_paths, headers=headers)
+    return [ compiled.project(message) for message in messages ]
 
-    head = "https://graph.microsoft.com/v1.0/me/mailFolders"
-    tail = "messages"
+def iter_messages(folder_paths = None, params = None, page_size = None, 
+                  max_items = None, headers = None, store = None, query = None):
+    """Generator version of get_messages. Yields the raw message dicts one 
+    page at a time, following @odata.nextLink lazily, so only one page is 
+    held in memory and the next page is only requested once the caller has
+    consumed the current one. page_size sets $top, max_items stops after 
+    that many messages across all folders. Messages are written through to
+    store (a MessageStore) in batches as they are yielded. A MessageQuery
+    replaces params (and max_items, unless given)."""
     
-    if not params:
-        today = datetime.now().strftime("%Y-%m-%dT00:00:00Z")
-        params = { 
-            "$select": "from,subject,body",
-            "$filter": f"receivedDateTime ge {today}"
-        }
+    query = _compile(query, params)
+    if max_items is None and query is not None:
+        max_items = query.limit
+    if max_items is not None and max_items <= 0:
+        return
     
-    messages = []
+    folder_ids, params, headers = _prepare_fetch(folder_paths, params, page_size, 
+                                                 headers, store, query)
     
+    count = 0
     for folder in folder_ids.keys():
-        id = folder_ids.get(folder)
-        endpoint = f"{head}/{id}/{tail}"
+        endpoint = _messages_endpoint(folder_ids.get(folder))
         
-        response = get_request(endpoint, params, headers)
-        data = response.get('value')
-        messages.extend(
-            {   'subject' : message['subject'], 
-                'body'    : message['body']['content']   } 
-                    for message in data)
+        messages = _matching(iter_pages(endpoint, params, headers), query)
+        if store is not None:
+            messages = _write_through(messages, store, folder)
         
-    return messages
+        for message in messages:
+            yield message
+            count += 1
+            if max_items is not None and count >= max_items:
+                return
+
+# Compact alternative to the raw message dicts: each page is decoded item by item
+# straight from the response stream (json_stream.py) and every message is turned into
+# a MessageRecord, which only keeps the fields that were selected.
+def iter_message_records(folder_paths = None, params = None, page_size = None,
+                         max_items = None, headers = None, lazy_bodies = False,
+                         query = None):
+    """Like iter_messages, but yields MessageRecords decoded incrementally from the
+    response, so neither a whole page nor its parsed tree is ever held in memory.
+    With lazy_bodies the bodies are kept compressed until they are read.
+    The connection stays in use while a page is being consumed."""
     
-def get_request(endpoint, params = None, headers = None):
-    """Request function using built-in urllib. This function is 
-    written to avoid having to install unnecessary libraries like 
-    requests for simple GET requests. The inputs and outputs are
-    similar to the requests.get function from the requests library."""
+    query = _compile(query, params)
+    if max_items is None and query is not None:
+        max_items = query.limit
+    if max_items is not None and max_items <= 0:
+        return
     
-    if params:
-        if not isinstance(params, dict):
-            raise TypeError("Params must be a dictionary")
-        query = urllib.parse.urlencode(params)
-        url = f'{endpoint}?{query}'    
-    else:    
-        url = endpoint
+    folder_ids, params, headers = _prepare_fetch(folder_paths, params, page_size, headers,
+                                                 query=query)
     
-    request = urllib.request.Request(url, headers=headers)
+    count = 0
+    for folder in folder_ids.keys():
+        endpoint = _messages_endpoint(folder_ids.get(folder))
+        
+        for item in _matching(_stream_pages(endpoint, params, headers), query):
+            yield MessageRecord(item, lazy_bodies)
+            count += 1
+            if max_items is not None and count >= max_items:
+                return
 
-    with urllib.request.urlopen(request) as response:
-        try:
-            if response.status == 200:
-                try:
-                    data = json.loads(response.read().decode())
-                except json.JSONDecodeError as e:
-                    print(f"JSON Decode Error: {e.msg}")
-                    data = None
-            else:
-                print(f"Error accessing emails: {response.status_code}")
-                print(response.read().decode())
+class MessageRecord:
+    '''A message with only the fields that were selected, in slots instead of the
+    dicts Graph returns (message, from, emailAddress and body each cost one). Fields
+    that weren't selected are None; selected fields without a slot go in extra.
+    With lazy_body the body content is kept zlib compressed and decoded when .body
+    is read, which for HTML mail is a fraction of the size.'''
+
+    __slots__ = ('id', 'subject', 'received', 'sender', 'sender_name', 'body_type',
+                 '_body', '_compressed', 'extra')
+
+    def __init__(self, message, lazy_body = False):
+        self.id = message.get('id')
+        self.subject = message.get('subject')
+        self.received = message.get('receivedDateTime')
         
-        except urllib.error.HTTPError as e:
-            print(f"HTTP Error: {e.code} - {e.reason}")
-            print(e.read().decode())
-            data = None
+        sender = (message.get('from') or {}).get('emailAddress') or {}
+        self.sender = sender.get('address')
+        self.sender_name = sender.get('name')
         
-        except urllib.error.URLError as e:
-            print(f"URL Error: {e.reason}")
-            print(e.read().decode())
-            data = None
-    
-    return data
+        body = message.get('body') or {}
+        self.body_type = body.get('contentType')
+        content = body.get('content')
+        self._compressed = lazy_body and content is not None
+        self._body = zlib.compress(content.encode(), 1) if self._compressed else content
+        
+        extra = { key : value for key, value in message.items() 
+                    if key not in _RECORD_FIELDS and not key.startswith('@odata.') }
+        self.extra = extra or None
+
+    @property
+    def body(self):
+        if self._compressed:
+            return zlib.decompress(self._body).decode()
+        return self._body
 
-def _get_folder_ids(folder_paths, headers = None):
+    def __repr__(self):
+        return f'MessageRecord(id={self.id!r}, subject={self.subject!r})'
+
+# Graph fields that have a slot in MessageRecord
+_RECORD_FIELDS = frozenset(('id', 'subject', 'receivedDateTime', 'from', 'body'))
+
+def fetch_folders(folder_paths = None, params = None, max_workers = 4, 
+                  ordered = True, page_size = None, headers = None, store = None,
+                  query = None):
+    """Fetches every folder (including all of its pages) on a bounded thread 
+    pool, all sharing the same token. Yields a FolderResult per folder, either 
+    in the order the folders were given (ordered=True) or as soon as each one
+    completes. At most max_workers folders are in flight at once. A MessageQuery
+    replaces params; its limit applies to each folder."""
     
-    if folder_paths is None:
-        return {'inbox' : 'inbox'}
+    query = _compile(query, params)
+    limit = query.limit if query is not None else None
+    folder_ids, params, headers = _prepare_fetch(folder_paths, params, page_size, 
+                                                 headers, store, query)
     
-    if isinstance(folder_paths, str):
-        if folder_paths.strip().lower() == 'inbox':
-            return {'inbox' : 'inbox'}
+    def fetch(folder):
+        endpoint = _messages_endpoint(folder_ids.get(folder))
+        messages = list(islice(_matching(iter_pages(endpoint, params, headers), query),
+                               limit))
+        if store is not None:
+            store.add_messages(messages, folder)
+        return messages
+    
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = { executor.submit(fetch, folder) : folder for folder in folder_ids.keys() }
+        
+        # futures keeps submission order, as_completed yields the fastest first
+        for future in (futures if ordered else as_completed(futures)):
+            folder = futures[future]
+            try:
+                yield FolderResult(folder, future.result(), None)
+            except Exception as e:
+                yield FolderResult(folder, [], e)
+    finally:
+        # Don't start folders nobody is going to read if the caller stops early
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Incremental sync with Graph delta queries. The @odata.deltaLink returned at the end of
+# each sync is stored per folder in delta_links.json, so the next poll only downloads
+# what changed since the last one instead of every message received today.
+_DELTA_FILE = 'delta_links.json'
+_delta_lock = threading.Lock()
+
+# changed holds the added or updated messages, removed the ids of deleted ones.
+# resynced is True when the folder was synced from scratch (first run or expired token),
+# in which case changed is the full content of the folder.
+SyncResult = namedtuple('SyncResult', ['folder', 'changed', 'removed', 'resynced'])
+
+def sync_messages(folder_paths = None, params = None, page_size = None,
+                  headers = None, delta_file = _DELTA_FILE, store = None):
+    """Returns a SyncResult per folder with only the messages that were added,
+    updated or deleted since the previous sync_messages call. params only apply
+    to the initial sync (the delta link remembers them); delta queries support
+    $select and a receivedDateTime $filter. If a MessageStore is given, the 
+    changes are applied to it; after a resync of an expired delta link, the
+    folder's stored messages the resync didn't return are deleted from it."""
+
+    if not headers:
+        headers = authentication.get_headers()
+
+    if not folder_paths:
+        folder_paths = 'inbox'
+
+    folder_ids = get_folder_ids(folder_paths, headers=headers)
+    params = dict(params) if params else { "$select": "from,subject,body" }
+    if store is not None:
+        params = _with_received(params)
+
+    sync_headers = dict(headers)
+    if page_size:
+        sync_headers['Prefer'] = f'odata.maxpagesize={page_size}'
+
+    results = []
+    for folder, folder_id in folder_ids.items():
+        with _delta_lock:
+            delta_link = _load_delta_links(delta_file).get(folder_id)
+
+        changed, removed, resynced, new_delta_link = _sync_folder(
+            folder_id, delta_link, params, sync_headers)
+        
+        if store is not None:
+            store.add_messages(changed, folder)
+            store.remove_messages(removed)
+            if resynced and delta_link is not None:
+                # The delta link expired, so whatever was deleted since the last
+                # sync is only known by its absence from the resync
+                stale = store.retain_messages(folder, (message['id'] for message in changed))
+                if stale:
+                    logger.info(f"Removed {stale} stale messages of {folder} after a resync")
+
+        # Saved after every folder so a failure later on doesn't lose the progress.
+        # The file lock keeps other processes syncing into the same file from
+        # dropping each other's links.
+        with _delta_lock, FileLock(f'{delta_file}.lock'):
+            delta_links = dict(_load_delta_links(delta_file))
+            delta_links[folder_id] = new_delta_link
+            _save_delta_links(delta_links, delta_file)
+
+        results.append(SyncResult(folder, changed, removed, resynced))
+
+    return results
+
+def _sync_folder(folder_id, delta_link, params, headers):
+    """Follows the delta pages of one folder until the final page hands out a
+    new delta link. Falls back to a full resync if the delta link expired (410)."""
+
+    resynced = delta_link is None
+    if resynced:
+        url = f"{GRAPH_ROOT}/me/mailFolders/{folder_id}/messages/delta"
+        query = params
+    else:
+        url = delta_link
+        query = None
+
+    changed = []
+    removed = []
+    while True:
+        status, data = _get_json(url, query, headers)
+
+        if status == 410 and not resynced:
+            logger.info("Delta token expired. Running a full resync.")
+            return _sync_folder(folder_id, None, params, headers)
+
+        if status != 200 or not data:
+            raise RuntimeError(f"Failed to sync folder {folder_id}: {status}")
+
+        for item in data.get('value', []):
+            if '@removed' in item:
+                removed.append(item['id'])
+            else:
+                changed.append(item)
+
+        next_link = data.get('@odata.nextLink')
+        if not next_link:
+            return changed, removed, resynced, data.get('@odata.deltaLink')
+
+        url = next_link
+        query = None
+
+def _load_delta_links(delta_file):
+    """The saved delta links; shared with read_json's cache, so not to be modified."""
+
+    try:
+        return read_json(delta_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to load delta links: {e}")
+        return {}
+
+def _save_delta_links(delta_links, delta_file):
+    try:
+        write_json(delta_file, delta_links)
+    except OSError as e:
+        logger.warning(f"Failed to save delta links: {e}")
+
+def _prepare_fetch(folder_paths, params, page_size, headers, store = None, query = None):
+    """Resolves the folder ids, params and headers shared by the fetch functions."""
     
     if not headers:
         headers = authentication.get_headers()
     
-    config_ids = _load_folder_ids_from_config(headers)
+    if not folder_paths:
+        folder_paths = 'inbox'
+    
+    folder_ids = get_folder_ids(folder_paths, headers=headers)
     
-    if config_ids:
-        print("Loaded Folder ID's from config file")
+    if query is not None:
+        params = query.params
+        if query.headers:
+            headers = dict(headers, **query.headers)
     
-    folder_ids = config_ids
+    params = dict(params) if params else _default_params()
+    if page_size:
+        params['$top'] = page_size
+    if store is not None:
+        params = _with_received(params)
+    
+    return folder_ids, params, headers
 
-    if not folder_ids:
-        print("Loading Folder IDs from Microsoft Graph")
-        folder_ids = {'inbox' : 'inbox'}
-        main_folders = []
-        for path in folder_paths.split(';'):
-            if path.lower() == 'inbox':
-                main_folders.append('inbox')
-                continue
-            main_folders.append(os.path.basename(path))
-            folders = path.split('/')
-            _iterate_folders(folders, folder_ids, None, headers)
+def _compile(query, params):
+    """The CompiledQuery of a MessageQuery (or None), which can't be combined with params."""
+    
+    if query is None:
+        return None
+    if params:
+        raise ValueError("Pass either params or a query, not both")
+    return query.compile() if hasattr(query, 'compile') else query
 
-        folder_ids = { folder : folder_ids[folder] for folder in main_folders }
+def _matching(messages, query):
+    """Drops the messages failing the query's client side predicates."""
+    
+    if query is None or not query.tests:
+        return messages
+    return filter(query.matches, messages)
 
-        update_config_folder_ids(folder_ids)
+def _with_received(params):
+    """The store indexes receivedDateTime, so make sure a $select includes it."""
+    
+    select = params.get('$select')
+    if select and 'receivedDateTime' not in select.split(','):
+        params = dict(params)
+        params['$select'] = f'{select},receivedDateTime'
+    return params
 
-    return folder_ids
+def _write_through(messages, store, folder):
+    """Passes the messages through unchanged while writing them to the store
+    in batches. Whatever is buffered is flushed even if the caller stops early."""
+    
+    batch = []
+    try:
+        for message in messages:
+            batch.append(message)
+            if len(batch) >= store.batch_size:
+                store.add_messages(batch, folder)
+                batch = []
+            yield message
+    finally:
+        if batch:
+            store.add_messages(batch, folder)
+
+def _messages_endpoint(folder_id):
+    return f"{GRAPH_ROOT}/me/mailFolders/{folder_id}/messages"
 
-def _iterate_folders(folders, folder_ids, current_id, headers):
-    """Iterate through the folder in the path. Finds the folder id by getting 
-    the child folders of the current folder and checking if the next folder in"""
+def _default_params():
+    """Params used when none are given: all messages received today."""
     
-    if not folders or not isinstance(folders, list):
-        return None
+    today = datetime.now().strftime("%Y-%m-%dT00:00:00Z")
+    return { 
+        "$select": "from,subject,body",
+        "$filter": f"receivedDateTime ge {today}"
+    }
+
+def iter_pages(endpoint, params, headers):
+    """Yields every item of a paged Graph collection, following @odata.nextLink.
+    The next link already carries the query string, so params are only sent
+    with the first request."""
+    
+    url = endpoint
+    while url:
+        data = get_request(url, params, headers)
+        if not data:
+            raise RuntimeError(f"Failed to get page {url}")
+        yield from data.get('value', [])
+        url = data.get('@odata.nextLink')
+        params = None
     
-    current_folder = folders[0]
+def _stream_pages(endpoint, params, headers):
+    """Streaming version of iter_pages: the items of each page are decoded as
+    they arrive instead of after the whole page was read and parsed."""
+    
+    url = endpoint
+    while url:
+        if params:
+            url = f'{url}?{urllib.parse.urlencode(params)}'
+        
+        try:
+            response = send_request('GET', url, headers=headers, stream=True)
+        except (http.client.HTTPException, OSError) as e:
+            logger.error(f"URL Error: {e}")
+            raise RuntimeError(f"Failed to get page {url}") from e
+        
+        with response:
+            if response.status != 200:
+                logger.error(f"Error accessing emails: {response.status}")
+                logger.error(response.read().decode(errors='replace'))
+                raise RuntimeError(f"Failed to get page {url}")
+            
+            reader = CollectionReader(response.read)
+            yield from reader
+            url = reader.members.get('@odata.nextLink')
+        params = None
+
+def get_request(endpoint, params = None, headers = None):
+    """Request function using built-in http.client. This function is
+    written to avoid having to install unnecessary libraries like
+    requests for simple GET requests. The inputs and outputs are
+    similar to the requests.get function from the requests library.
+    Connections are kept alive and reused between calls."""
 
-    # Don't need to find the folder id if it is already in the folder_ids dictionary
-    if current_folder in folder_ids.keys():
-        return _iterate_folders(folders[1:], folder_ids, folder_ids.get(current_folder) , headers)
+    status, data = _get_json(endpoint, params, headers)
 
-    # Find the folder id if it is not in the folder_ids dictionary
-    url = f"https://graph.microsoft.com/v1.0/me/mailFolders/{current_id}/childFolders"
-    if not current_id:
-        url = f"https://graph.microsoft.com/v1.0/me/mailFolders"
-    data = get_request(url, headers = headers)
-    if not data:
-        print(f"Failed to get child folders of {current_id}")
+    if status is None:
         return None
-    child_folders = data['value']
-    
-    print(f"Checking {current_folder}'s children")
-    for child in child_folders:
-        print(f"Found: {child['displayName']}")    
-        if child['displayName'].upper() == current_folder.upper():
-            folder_ids[current_folder] = child['id']
-            break
-    if not folder_ids.get(current_folder):
-        print(f"Failed to find {current_folder}")
+
+    if status != 200:
+        logger.error(f"Error accessing emails: {status}")
+        logger.error(f"{data}")
         return None
+
+    return data
+
+def _get_json(endpoint, params = None, headers = None):
+    """Sends a GET request and returns (status, parsed body) so callers can
+    react to specific status codes. status is None if the request failed to send."""
+
+    if params:
+        if not isinstance(params, dict):
+            raise TypeError("Params must be a dictionary")
+        query = urllib.parse.urlencode(params)
+        url = f'{endpoint}?{query}'
+    else:
+        url = endpoint
+
+    return request_json('GET', url, None, headers)
+
+def request_json(method, url, payload = None, headers = None):
+    """Sends a request, with payload (if not None) as its JSON body, and returns
+    (status, parsed body). status is None if the request failed to send."""
+
+    body = None
+    if payload is not None:
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json'
+        body = json.dumps(payload).encode()
+
+    try:
+        response = send_request(method, url, body=body, headers=headers)
+
+    except (http.client.HTTPException, OSError) as e:
+        logger.error(f"URL Error: {e}")
+        return None, None
+
+    try:
+        data = json.loads(response.data) if response.data else None
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON Decode Error: {e.msg}")
+        data = None
+
+    return response.status, data
+
+def send_request(method, url, body = None, headers = None, stream = False):
+    """Sends a request over the connection pool, through the scheduler. With
+    stream=True a StreamedResponse is returned once the headers are in; the
+    caller reads the body and must close it."""
+    
+    attempts = 0
+    def send():
+        nonlocal attempts
+        attempts += 1
+        if not stream:
+            return _pool.request(method, url, body=body, headers=headers)
+        
+        response = _pool.stream(method, url, body=body, headers=headers)
+        if response.status in RETRY_STATUSES:
+            # Going to be retried or handed back as a failure, free the connection
+            with response:
+                response.read()
+        return response
     
-    return _iterate_folders(folders[1:], folder_ids, folder_ids.get(current_folder), headers)
+    with span('http.request') as s:
+        response = _scheduler.execute(mailbox_key(url, headers), send)
+        
+        # Only pay for classifying the url when someone is listening
+        if instrumentation.is_enabled():
+            s.set(method=method, endpoint=_endpoint_class(url), status=response.status,
+                  retries=attempts - 1)
+            # A streamed body hasn't been read yet
+            if not stream:
+                s.set(bytes=len(response.data))
+    
+    return response
 
-def _load_folder_ids_from_config(headers):
-    """Loads the folder ids from the config file if they exist and
-    verifies them with the Microsoft Graph API."""
+# Path segments kept as is when classifying a url; anything else is an id
+_ENDPOINT_NAMES = frozenset(('me', 'users', 'mailFolders', 'childFolders', 'messages', 
+                             'delta', 'attachments', '$value', '$batch', 'subscriptions'))
 
-    config = configparser.ConfigParser()
-    config.read('azure.cnf')
+def _endpoint_class(url):
+    """Turns a Graph url into its endpoint class, e.g. me/mailFolders/{id}/messages."""
     
-    if not config.has_section('Folder IDs'):
-        return None
+    path = urllib.parse.urlsplit(url).path
+    if path.startswith(urllib.parse.urlsplit(GRAPH_ROOT).path):
+        path = path[len(urllib.parse.urlsplit(GRAPH_ROOT).path):]
+    return '/'.join(segment if segment in _ENDPOINT_NAMES else '{id}' 
+                        for segment in path.split('/') if segment)
+
+def mailbox_key(url, headers = None):
+    """Graph throttles per mailbox: /users/{id}/... is that mailbox's limit. /me/...
+    and anything else, including $batch, is counted against the account whose token
+    is in headers, so every account of a TokenPool gets a limit of its own."""
+    
+    path = urllib.parse.urlsplit(url).path.split('/')
+    if 'users' in path[:-1]:
+        i = path.index('users')
+        return f'users/{path[i + 1].lower()}'
+    
+    account = authentication.account_of(headers)
+    return f'me/{account}' if account else 'me'
+
+def get_scheduler_stats():
+    """Returns the scheduler counters: requests, retries, throttled responses
+    and retries refused because the retry budget ran out."""
+    
+    return _scheduler.stats()
+
+def get_connection_stats():
+    """Returns the connection pool counters: requests sent, connections
+    opened, and how many requests reused an open connection."""
+    
+    return _pool.stats()
+
+# Graph's JSON batching endpoint accepts up to 20 sub-requests per call. Independent 
+# requests are packed together so N lookups cost ceil(N / 20) round trips instead of N.
+# Sub-requests inside one call are not ordered, so requests that need the result of 
+# another request must go in a later batch_requests() call.
+BATCH_LIMIT = 20
+
+# Sub-response of a $batch call. body is the parsed JSON body (or the error object)
+BatchResponse = namedtuple('BatchResponse', ['status', 'headers', 'body'])
+
+def batch_requests(requests, headers = None):
+    """Sends the requests through Graph's $batch endpoint. Each request is either
+    a url or a (method, url) tuple; urls may be absolute or relative to /v1.0.
+    Returns a BatchResponse per request, in the same order as the requests.
+    Errors are reported per item, including when a whole batch call fails.
+    Sub-requests that were throttled are sent again in a later batch once
+    their Retry-After has passed."""
+
+    if not headers:
+        headers = authentication.get_headers()
+
+    headers = dict(headers)
+    headers['Content-Type'] = 'application/json'
+
+    requests = [ ('GET', request) if isinstance(request, str) else request
+                    for request in requests ]
+    responses = [None] * len(requests)
+
+    pending = list(range(len(requests)))
+    attempt = 0
+    while pending:
+        throttled = []
+        retry_after = None
+
+        for start in range(0, len(pending), BATCH_LIMIT):
+            chunk = pending[start:start + BATCH_LIMIT]
+
+            # The sub-request id is the request's position so answers can be mapped back
+            payload = { 'requests' : [
+                {   'id'     : str(i),
+                    'method' : requests[i][0],
+                    'url'    : _relative_url(requests[i][1])  }
+                        for i in chunk ] }
+
+            status, data = _post_json(f"{GRAPH_ROOT}/$batch", payload, headers)
+            if status != 200 or not data:
+                for i in chunk:
+                    responses[i] = BatchResponse(status, {}, data)
+                continue
+
+            for item in data.get('responses', []):
+                i = int(item['id'])
+                responses[i] = BatchResponse(
+                    item.get('status'), item.get('headers', {}), item.get('body'))
+
+                if responses[i].status in RETRY_STATUSES:
+                    throttled.append(i)
+                    delay = parse_retry_after(responses[i].headers.get('Retry-After'))
+                    if delay is not None:
+                        retry_after = max(retry_after or 0, delay)
+
+            # Graph should answer every id, but don't leave holes if it didn't
+            for i in chunk:
+                if responses[i] is None:
+                    responses[i] = BatchResponse(None, {}, None)
+
+        if not throttled or not _scheduler.backoff(mailbox_key(GRAPH_ROOT, headers),
+                                                   attempt, retry_after=retry_after):
+            break
+
+        pending = sorted(throttled)
+        attempt += 1
+
+    return responses
+
+def _relative_url(url):
+    if url.startswith(GRAPH_ROOT):
+        url = url[len(GRAPH_ROOT):]
+    if not url.startswith('/'):
+        url = f'/{url}'
+    return url
+
+def _post_json(url, payload, headers):
+    """POSTs a JSON payload and returns (status, parsed body). status is None
+    if the request could not be sent."""
+    
+    status, data = request_json('POST', url, payload, headers)
     
-    folder_ids = { option: config.get('Folder IDs', option) for 
-                        option in config.options('Folder IDs') }
-    folder_ids = _verify_folder_ids(folder_ids, headers)
+    if status is not None and status != 200:
+        logger.warning(f"Batch request failed: {status}")
+    
+    return status, data
+
+def get_folder_ids(folder_paths, headers = None, account = None):
+    """Returns { path : folder_id } for every ';' separated path, resolved from
+    the cached folder tree index of the account (see get_folder_index). If a path
+    can't be found the index is refreshed once in case the folder was created after
+    the index was fetched, unless the index is younger than _FOLDER_REFRESH_AGE."""
+
+    if folder_paths is None:
+        return {'inbox' : 'inbox'}
+
+    if isinstance(folder_paths, str):
+        if folder_paths.strip().lower() == 'inbox':
+            return {'inbox' : 'inbox'}
+
+    if not headers:
+        headers = authentication.get_headers(account)
+
+    with span('folders.resolve', paths=folder_paths.count(';') + 1):
+        return _resolve_paths(folder_paths, headers, account)
+
+def _resolve_paths(folder_paths, headers, account):
+    index = get_folder_index(headers, account=account)
+    refreshed = False
+
+    folder_ids = {}
+    for path in folder_paths.split(';'):
+        path = path.strip()
+        if path.lower() == 'inbox':
+            folder_ids['inbox'] = 'inbox'
+            continue
+
+        folder_id = index.resolve(path)
+        if folder_id is None and not refreshed and index.is_expired(_FOLDER_REFRESH_AGE):
+            index = get_folder_index(headers, refresh=True, account=account)
+            refreshed = True
+            folder_id = index.resolve(path)
+
+        if folder_id is None:
+            logger.warning(f"Failed to find {path}")
+            continue
+
+        folder_ids[path] = folder_id
+
     return folder_ids
 
-def _verify_folder_ids(folder_ids, headers):
-    print('Verifying Folder IDs')
-    graph_url = "https://graph.microsoft.com/v1.0/me/mailFolders"
-    for folder in folder_ids.keys():
-        url = f"{graph_url}/{folder_ids[folder]}"
-        request = urllib.request.Request(url, headers=headers)
-        try:
-            with urllib.request.urlopen(request) as response:
+# The folder tree index replaces the per-run folder id verification. The whole folder
+# hierarchy is fetched once, level by level, and kept in memory and in folder_index.json.
+# Paths are then resolved from memory in O(depth) until the index is older than the TTL.
+# Every account has an index (and file) of its own, see get_folder_index.
+_FOLDER_INDEX_FILE = 'folder_index.json'
+_FOLDER_INDEX_TTL = 24 * 60 * 60
+
+# A path missing from the index only refetches it once the index is this old, so a
+# misspelled or deleted path doesn't cost a whole tree fetch on every call
+_FOLDER_REFRESH_AGE = 5 * 60
+_FOLDER_PAGE_SIZE = 250
+_FOLDER_FIELDS = 'id,displayName,parentFolderId,childFolderCount'
+
+# account : FolderIndex and account : lock, None being the default account's.
+# _folder_index_lock only guards adding locks
+_folder_indexes = {}
+_folder_index_locks = {}
+_folder_index_lock = threading.Lock()
+
+class FolderIndex:
+    '''In-memory index of the mail folder tree. Folders are stored by parent,
+    so full paths like Inbox/Logger/Device resolve case-insensitively one
+    segment at a time, and folders sharing a name in different places
+    don't collide.'''
+
+    def __init__(self, folders, fetched_at = None):
+        self.folders = folders
+        self.fetched_at = fetched_at or time()
+
+        # Top level folders have the (unlisted) root folder as parent; file them under None
+        ids = { folder['id'] for folder in folders }
+        self._children = {}
+        for folder in folders:
+            parent_id = folder.get('parentFolderId')
+            if parent_id not in ids:
+                parent_id = None
+            children = self._children.setdefault(parent_id, {})
+            children[folder['displayName'].upper()] = folder['id']
+
+    def resolve(self, path):
+        """Returns the folder id of the path, or None if it doesn't exist."""
+
+        folder_id = None
+        for name in path.strip('/').split('/'):
+            folder_id = self._children.get(folder_id, {}).get(name.strip().upper())
+            if folder_id is None:
+                return None
+        return folder_id
+
+    def is_expired(self, ttl = _FOLDER_INDEX_TTL):
+        return time() - self.fetched_at > ttl
+
+    @classmethod
+    def fetch(cls, headers):
+        """Fetches the whole folder tree. Each level costs one request per 20
+        folders that have children (through $batch), independent of how many
+        paths are resolved later."""
+
+        params = { '$top' : _FOLDER_PAGE_SIZE, '$select' : _FOLDER_FIELDS }
+        query = urllib.parse.urlencode(params)
+
+        level = list(iter_pages(f"{GRAPH_ROOT}/me/mailFolders", params, headers))
+        folders = list(level)
+
+        while level:
+            parents = [ folder['id'] for folder in level if folder.get('childFolderCount') ]
+            urls = [ f"/me/mailFolders/{parent_id}/childFolders?{query}" for parent_id in parents ]
+
+            level = []
+            for parent_id, response in zip(parents, batch_requests(urls, headers)):
                 if response.status != 200:
-                    print(f"Error accessing folder {folder}")
-                    print("Refreshing Folder IDs")
-                    return None
-        except urllib.error.HTTPError as e:
-            print(f"HTTP Error: {e.code} - {e.reason}")
-            print(e.read().decode())
+                    raise RuntimeError(f"Failed to get child folders of {parent_id}")
+                level.extend(response.body.get('value', []))
+
+                next_link = response.body.get('@odata.nextLink')
+                if next_link:
+                    level.extend(iter_pages(next_link, None, headers))
+
+            folders.extend(level)
+
+        return cls(folders)
+
+    @classmethod
+    def load(cls, path = _FOLDER_INDEX_FILE, ttl = _FOLDER_INDEX_TTL):
+        """Loads the index from disk. Returns None if it is missing, unreadable or expired."""
+
+        if not os.path.exists(path):
             return None
-        except urllib.error.URLError as e:
-            print(f"URL Error: {e.reason}")
-            print(e.read().decode())
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            index = cls(data['folders'], data['fetched_at'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to load folder index: {e}")
             return None
-        
-    return folder_ids
 
-def update_config_folder_ids(folder_ids):
-    print('Adding Folder IDs to config file')
-    config = configparser.ConfigParser()
-    config.read('azure.cnf')
-    if not config.has_section('Folder IDs'):
-        config.add_section('Folder IDs')
-    
-    for folder in folder_ids.keys():
-        config.set('Folder IDs', folder, folder_ids[folder])
-    
-    with open('azure.cnf', 'w') as f:
-        config.write(f)
-    
+        if index.is_expired(ttl):
+            return None
+        return index
+
+    def save(self, path = _FOLDER_INDEX_FILE):
+        try:
+            write_json(path, { 'fetched_at' : self.fetched_at, 'folders' : self.folders })
+        except OSError as e:
+            logger.warning(f"Failed to save folder index: {e}")
+
+def get_folder_index(headers = None, refresh = False, ttl = _FOLDER_INDEX_TTL,
+                     account = None):
+    """Returns the folder tree index, loading it from disk or fetching it from
+    Microsoft Graph when there is no index younger than ttl seconds. Each account
+    (the one whose token is in headers, else account as for get_headers) has an
+    index of its own, so mailboxes never resolve paths to each other's folders."""
+
+    if headers:
+        account = authentication.account_of(headers) or account
+
+    with _folder_index_lock:
+        lock = _folder_index_locks.setdefault(account, threading.Lock())
+
+    with lock:
+        index = _folder_indexes.get(account)
+        if refresh or index is None or index.is_expired(ttl):
+            path = _folder_index_file(account)
+            index = None if refresh else FolderIndex.load(path, ttl)
+            if index is None:
+                logger.info("Loading Folder IDs from Microsoft Graph")
+                with span('folders.fetch_index') as s:
+                    index = FolderIndex.fetch(headers or authentication.get_headers(account))
+                    s.set(folders=len(index.folders))
+                index.save(path)
+            _folder_indexes[account] = index
+
+        return index
+
+def _folder_index_file(account):
+    """folder_index.json for the default account, folder_index.<account>.json otherwise."""
+
+    if account is None:
+        return _FOLDER_INDEX_FILE
+    name, extension = os.path.splitext(_FOLDER_INDEX_FILE)
+    account = re.sub(r'[^\w.@-]', '_', account)
+    return f'{name}.{account}{extension}'
+
 
 if __name__ == "__main__":
     from pprint import pprint
@@ -0,0 +1,210 @@
+import asyncio, ssl, gzip, urllib.parse, http.client, email.parser
+from connection_pool import Response
+
+# asyncio counterpart of connection_pool.py: a keep-alive pool of HTTP/1.1 connections on
+# top of asyncio streams, so async code can talk to Graph without a thread per request
+# and without third party libraries. Connections are kept open per host and handed back
+# out; at most `max_connections` requests per host are in flight at once, the others wait
+# on a semaphore, which is what keeps hundreds of concurrent reads from opening hundreds
+# of connections.
+__all__ = ['AsyncConnectionPool']
+
+# A kept-alive connection the server closed while it was idle fails with one of these
+_STALE_ERRORS = (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected,
+                 asyncio.IncompleteReadError)
+
+_MAX_LINE = 65536
+
+class AsyncConnectionPool:
+    '''Pool of persistent HTTP(S) connections, keyed by (scheme, host, port). Must be
+    used from a single event loop. `timeout` applies to each request as a whole.'''
+
+    def __init__(self, max_connections=16, timeout=30, ssl_context=None):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+
+        self._idle = {}
+        self._slots = {}
+        self._loop = None
+        self._counters = { 'requests' : 0, 'opened' : 0, 'reused' : 0, 'discarded' : 0 }
+
+    async def request(self, method, url, body=None, headers=None):
+        """Sends the request over a pooled connection and returns a Response
+        (the same namedtuple as ConnectionPool.request, with the body gzip-decoded)."""
+
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported URL scheme: {parts.scheme}")
+
+        default_port = 443 if parts.scheme == 'https' else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+
+        host = parts.hostname if not parts.port else f'{parts.hostname}:{parts.port}'
+        request = self._encode(method, path, host, body, headers)
+
+        # Connections and semaphores belong to the loop that created them; a new
+        # loop (another asyncio.run) starts over with fresh ones
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._idle = {}
+            self._slots = {}
+
+        async with self._slot(key):
+            status, response_headers, data = await asyncio.wait_for(
+                self._send(key, method, request), self.timeout)
+
+        if response_headers.get('Content-Encoding', '').lower() == 'gzip':
+            data = gzip.decompress(data)
+
+        return Response(status, response_headers, data)
+
+    def stats(self):
+        """Returns a snapshot of the connection counters, including how many
+        requests reused an already open connection."""
+
+        stats = dict(self._counters)
+        stats['idle'] = sum(len(conns) for conns in self._idle.values())
+        return stats
+
+    async def close(self):
+        """Closes every idle connection in the pool."""
+
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, writer in conns:
+                writer.close()
+        for conns in idle.values():
+            for _, writer in conns:
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+
+    def _encode(self, method, path, host, body, headers):
+        headers = dict(headers) if headers else {}
+        headers.setdefault('Host', host)
+        headers.setdefault('Accept-Encoding', 'gzip')
+        if body is not None or method in ('POST', 'PUT', 'PATCH'):
+            headers['Content-Length'] = str(len(body or b''))
+
+        lines = [ f'{method} {path} HTTP/1.1' ]
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        return request + body if body else request
+
+    async def _send(self, key, method, request):
+        # A reused connection may have been dropped by the server while it sat
+        # in the pool; in that case retry once on a fresh connection
+        while True:
+            conn, reused = await self._checkout(key)
+            reader, writer = conn
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, data, will_close = await self._read_response(reader, method)
+            except _STALE_ERRORS as e:
+                self._discard(conn)
+                if reused:
+                    continue
+                if isinstance(e, asyncio.IncompleteReadError):
+                    raise http.client.IncompleteRead(e.partial, e.expected) from None
+                raise
+            except BaseException:
+                self._discard(conn)
+                raise
+
+            if will_close:
+                self._discard(conn)
+            else:
+                self._idle.setdefault(key, []).append(conn)
+            return status, headers, data
+
+    async def _read_response(self, reader, method):
+        line = await _readline(reader)
+        if not line:
+            raise http.client.RemoteDisconnected('Remote end closed connection without response')
+
+        try:
+            version, status, _ = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(line) from None
+
+        header_lines = []
+        while True:
+            line = await _readline(reader)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line)
+        headers = email.parser.BytesParser(_class=http.client.HTTPMessage).parsebytes(
+            b''.join(header_lines))
+
+        will_close = (version == 'HTTP/1.0'
+                        or headers.get('Connection', '').lower() == 'close')
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            data = b''
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = await self._read_chunked(reader)
+        elif headers.get('Content-Length') is not None:
+            data = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            # No length: the body runs until the server closes the connection
+            data = await reader.read()
+            will_close = True
+
+        return status, headers, data, will_close
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            line = await _readline(reader)
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise http.client.IncompleteRead(b''.join(chunks)) from None
+            if size == 0:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+        # Trailers, up to the empty line
+        while await _readline(reader) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(chunks)
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = asyncio.Semaphore(self.max_connections)
+        return slot
+
+    async def _checkout(self, key):
+        self._counters['requests'] += 1
+        idle = self._idle.get(key)
+        if idle:
+            self._counters['reused'] += 1
+            return idle.pop(), True
+        self._counters['opened'] += 1
+
+        scheme, host, port = key
+        conn = await asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == 'https' else None, limit=_MAX_LINE)
+        return conn, False
+
+    def _discard(self, conn):
+        conn[1].close()
+        self._counters['discarded'] += 1
+
+async def _readline(reader):
+    try:
+        return await reader.readline()
+    except ValueError:
+        # The stream's limit (_MAX_LINE) was hit before the end of the line
+        raise http.client.LineTooLong('header line') from None
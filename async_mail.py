@@ -0,0 +1,189 @@
+import asyncio, json, urllib.parse, http.client
+import authentication, MS_Graph_Mail, instrumentation
+from async_connection_pool import AsyncConnectionPool
+from MS_Graph_Mail import FolderResult
+from instrumentation import logger, span
+
+# asyncio API for token acquisition and mail retrieval, for services running an event loop.
+# Same behaviour as the blocking functions in MS_Graph_Mail, but requests go over
+# async_connection_pool.py instead of a thread each, so one loop can drive hundreds of
+# folder / mailbox reads at once:
+#
+#   async for message in async_mail.iter_messages('Inbox/Logs', page_size=100):
+#       ...
+#   async for result in async_mail.fetch_folders(paths, ordered=False):
+#       ...
+#
+# Shared with the blocking code: the token (through AsyncTokenProvider), the folder index
+# and the scheduler, so sync and async requests count against the same per mailbox limits.
+# Requests per host in flight are capped by the pool's max_connections.
+__all__ = ['get_headers', 'get_request', 'iter_messages', 'fetch_folders', 'close']
+
+_pool = AsyncConnectionPool()
+_tokens = authentication.AsyncTokenProvider()
+
+# AsyncTokenProviders of the token pool's accounts, by account
+_account_tokens = {}
+
+async def get_headers(account = None):
+    """Returns the Microsoft Graph API headers, refreshing the token (in a worker
+    thread, once for all waiting coroutines) if needed. With an account (home_account_id
+    or username) the headers are for that account, from the token pool."""
+
+    if account is None:
+        tokens = _tokens
+    else:
+        tokens = _account_tokens.get(account)
+        if tokens is None:
+            provider = authentication.get_token_pool().provider(account)
+            tokens = _account_tokens.setdefault(
+                account, authentication.AsyncTokenProvider(provider))
+
+    headers = await tokens.get_headers()
+    if not headers:
+        logger.warning("Microsoft Graph API Headers not created")
+        return None
+
+    return headers
+
+async def get_request(endpoint, params = None, headers = None):
+    """Async version of MS_Graph_Mail.get_request. Returns the parsed JSON body,
+    or None if the request failed."""
+
+    status, data = await _get_json(endpoint, params, headers)
+
+    if status is None:
+        return None
+
+    if status != 200:
+        logger.error(f"Error accessing emails: {status}")
+        logger.error(f"{data}")
+        return None
+
+    return data
+
+async def iter_messages(folder_paths = None, params = None, page_size = None,
+                        max_items = None, headers = None, query = None):
+    """Async version of MS_Graph_Mail.iter_messages: yields the raw message dicts
+    one page at a time, only requesting the next page once the current one has
+    been consumed. A MessageQuery replaces params (and max_items, unless given)."""
+
+    query = MS_Graph_Mail._compile(query, params)
+    if max_items is None and query is not None:
+        max_items = query.limit
+    if max_items is not None and max_items <= 0:
+        return
+
+    folder_ids, params, headers = await _prepare_fetch(folder_paths, params, page_size, headers,
+                                                       query)
+
+    count = 0
+    for folder in folder_ids.keys():
+        endpoint = MS_Graph_Mail._messages_endpoint(folder_ids.get(folder))
+        async for message in _iter_pages(endpoint, params, headers):
+            if query is not None and not query.matches(message):
+                continue
+            yield message
+            count += 1
+            if max_items is not None and count >= max_items:
+                return
+
+async def fetch_folders(folder_paths = None, params = None, ordered = True,
+                        page_size = None, headers = None, query = None):
+    """Fetches every folder (including all of its pages) concurrently and yields
+    a FolderResult per folder, in the order given (ordered=True) or as soon as
+    each one completes. A folder that fails doesn't affect the others. A
+    MessageQuery replaces params; its limit applies to each folder."""
+
+    query = MS_Graph_Mail._compile(query, params)
+    folder_ids, params, headers = await _prepare_fetch(folder_paths, params, page_size, headers,
+                                                       query)
+
+    async def fetch(folder):
+        endpoint = MS_Graph_Mail._messages_endpoint(folder_ids.get(folder))
+        try:
+            messages = []
+            async for message in _iter_pages(endpoint, params, headers):
+                if query is not None and not query.matches(message):
+                    continue
+                messages.append(message)
+                if query is not None and len(messages) == query.limit:
+                    break
+            return FolderResult(folder, messages, None)
+        except Exception as e:
+            return FolderResult(folder, [], e)
+
+    tasks = [ asyncio.ensure_future(fetch(folder)) for folder in folder_ids.keys() ]
+    try:
+        for task in (tasks if ordered else asyncio.as_completed(tasks)):
+            yield await task
+    finally:
+        # Don't keep fetching folders nobody is going to read if the caller stops early
+        for task in tasks:
+            task.cancel()
+
+async def close():
+    """Closes the idle connections of the pool."""
+
+    await _pool.close()
+
+async def _prepare_fetch(folder_paths, params, page_size, headers, query = None):
+    if not headers:
+        headers = await get_headers()
+
+    # Folder paths normally resolve from the in-memory folder index; when it has
+    # to be fetched that happens with the blocking client, in a worker thread
+    return await asyncio.to_thread(MS_Graph_Mail._prepare_fetch, folder_paths, params,
+                                   page_size, headers, None, query)
+
+async def _iter_pages(endpoint, params, headers):
+    url = endpoint
+    while url:
+        data = await get_request(url, params, headers)
+        if not data:
+            raise RuntimeError(f"Failed to get page {url}")
+        for item in data.get('value', []):
+            yield item
+        url = data.get('@odata.nextLink')
+        params = None
+
+async def _get_json(endpoint, params = None, headers = None):
+    if params:
+        if not isinstance(params, dict):
+            raise TypeError("Params must be a dictionary")
+        url = f'{endpoint}?{urllib.parse.urlencode(params)}'
+    else:
+        url = endpoint
+
+    try:
+        response = await _send('GET', url, headers=headers)
+    except (http.client.HTTPException, OSError) as e:
+        logger.error(f"URL Error: {e}")
+        return None, None
+
+    try:
+        data = json.loads(response.data) if response.data else None
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON Decode Error: {e.msg}")
+        data = None
+
+    return response.status, data
+
+async def _send(method, url, body = None, headers = None):
+    """Sends a request over the async pool, through the shared scheduler."""
+
+    attempts = 0
+    async def send():
+        nonlocal attempts
+        attempts += 1
+        return await _pool.request(method, url, body=body, headers=headers)
+
+    with span('http.request') as s:
+        response = await MS_Graph_Mail._scheduler.execute_async(
+            MS_Graph_Mail.mailbox_key(url, headers), send)
+
+        if instrumentation.is_enabled():
+            s.set(method=method, endpoint=MS_Graph_Mail._endpoint_class(url),
+                  status=response.status, bytes=len(response.data), retries=attempts - 1)
+
+    return response
@@ -1,7 +1,8 @@
-import msal, webbrowser, urllib.parse, socket, threading, configparser, os.path, json
+import threading, os, os.path, json, heapq
 from time import time
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from instrumentation import logger, span
+from file_store import FileLock, write_atomic, write_json, read_json
 
 # This module is used to authenticate the user and retrieve a token from Microsoft Graph API.
 # The main usage is to get the headers for the Microsoft Graph API, as the token is only
@@ -10,334 +11,808 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 # something other than the Microsoft Graph API headers.
 
 # load_token_data() is the main function that is used to retrieve the token data and now 
-# also handles the token data cache. 
-__all__ = ['get_headers', 'load_token_data']
-
-class _AuthorizationCodeHandler(BaseHTTPRequestHandler):
-    '''This class handles the authorization code from the redirect URI. It is a simple 
-    HTTP request handler that listens for a GET request on the redirect URI. It then 
-    extracts the authorization code from the request and stores it in the server's auth_code.'''
-
-    def do_GET(self):
-        query_components = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
-        
-        # Black Magic!!! wooooo~ 
-        # On a serious note, this allows the server to access the auth_code variable
-        self.server.auth_code = query_components.get('code', [None])[0]
-        
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(b"""
-            <html>
-                <body style="text-align: center; padding: 20px;">
-                    <h3>Authentication successful!</h3>
-                    <p>You can close this window now.</p>
-                </body>
-            </html>
-        """)
-        threading.Thread(target=self.server.shutdown).start()
-
-    def log_message(self, format, *args):
-        # Suppress logging; only interested in the authorization code
+# also handles the token data cache. Both it and get_headers() are thin wrappers around a
+# module level TokenProvider, which keeps the token in memory and renews it in the background.
+# Passing account=... to either uses a TokenPool instead, which holds the tokens of many
+# accounts (see TokenPool below).
+
+# msal, the config parser (azure_config.py) and the interactive login stack
+# (interactive_login.py) are imported lazily, only once a token has to be refreshed or a
+# user has to log in. Handing out a cached token therefore doesn't pay for importing msal
+# and everything it pulls in.
+
+# token.json (and tokens.json, msal_cache.bin) may be shared by several processes started
+# together. Refreshes take a file lock (token.json.lock) so only one process refreshes
+# while the others wait and reuse its token, files are written atomically, and a file is
+# only parsed again when it changed (see file_store.py).
+__all__ = ['get_headers', 'load_token_data', 'TokenProvider', 'TokenPool', 'AsyncTokenProvider',
+           'get_token_pool', 'account_of', 'call_later']
+
+# MSAL applications are cached per (client_id, authority) so authority discovery only
+# happens once per process. Each application is backed by a SerializableTokenCache that
+# is persisted to msal_cache.bin, which lets acquire_token_silent() find the signed in
+# accounts again in later runs instead of forcing a new login.
+_MSAL_CACHE_FILE = 'msal_cache.bin'
+_apps = {}
+
+# Extra keyword arguments for PublicClientApplication, e.g. an http_client that
+# talks to a local stand-in authority (see benchmark.py)
+_msal_options = {}
+_apps_lock = threading.Lock()
+
+def _load_msal_cache(cache_file=_MSAL_CACHE_FILE):
+    """Returns a SerializableTokenCache loaded from disk if the cache file exists."""
+    
+    import msal
+    
+    cache = msal.SerializableTokenCache()
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache.deserialize(f.read())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load MSAL cache: {e}")
+    return cache
+
+def _persist_msal_cache(app, cache_file=_MSAL_CACHE_FILE):
+    """Writes the MSAL token cache back to disk, only if it has changed. Other
+    processes may have saved accounts or newer tokens since this one loaded the
+    file, so under the file's lock the file is read again and merged into the
+    cache first, instead of the last writer's cache winning."""
+    
+    cache = app.token_cache
+    if not cache.has_state_changed:
         return
+    
+    try:
+        with FileLock(f'{cache_file}.lock'):
+            state = _merge_msal_state(_read_msal_state(cache_file),
+                                      json.loads(cache.serialize()))
+            text = json.dumps(state, indent=4)
+            cache.deserialize(text)
+            write_atomic(cache_file, text)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to save MSAL cache: {e}")
 
+def _read_msal_state(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return {}
+    return json.loads(text) if text else {}
 
-def _get_auth_code(app: msal.PublicClientApplication, config:configparser.ConfigParser):
-    '''This function retrieves the authorization code from a user login.
-       First it gets a free port from the allowed range, then it starts 
-       an HTTP server that listens for a GET request on the redirect URI.  
-       It then extracts and returns the authorization code from the request.
-    '''
-    
-    # Test and reserve a free port from the allowed range
-    port = None
-    
-    start_port = config['Ports']['start']
-    end_port = config['Ports']['end']
-    
-    if start_port:
-        if not isinstance(start_port, int):
-            try:
-                start_port = int(start_port)
-            except ValueError:
-                raise ValueError("start_port must be an integer")
-    if end_port:
-        if not isinstance(end_port, int):
-            try:
-                end_port = int(end_port)
-            except ValueError:
-                raise ValueError("end_port must be an integer")
-    
-    if end_port is None:
-        allowed_ports = [start_port]
-    else:
-        allowed_ports = range(start_port, end_port)
-
-    for _port in allowed_ports:
-        try:            
-            # Keep the socket open for the duration of the request; 
-            # This is to ensure that the server can receive the authorization code
-
-            # with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            _socket.bind(('localhost', _port))
-            port = _port
-            break
-        except socket.error:
-            # Port is already in use; try the next one
+def _merge_msal_state(saved, current):
+    """Both caches' entries; where both hold the same entry (same account, scopes,
+    ...) the more recently written one, this process's on a tie."""
+    
+    merged = dict(saved)
+    for credential_type, entries in current.items():
+        saved_entries = saved.get(credential_type)
+        if not isinstance(entries, dict) or not isinstance(saved_entries, dict):
+            merged[credential_type] = entries
             continue
+        
+        entries = dict(entries)
+        for key, entry in saved_entries.items():
+            if key not in entries or _written_at(entry) > _written_at(entries[key]):
+                entries[key] = entry
+        merged[credential_type] = entries
+    return merged
+
+def _written_at(entry):
+    # Refresh tokens carry last_modification_time, access tokens cached_at
+    try:
+        return int(entry.get('last_modification_time') or entry.get('cached_at') or 0)
+    except (AttributeError, ValueError):
+        return 0
+
+def _get_app(client_id, authority):
+    """Returns the cached MSAL application for the client and authority,
+    creating it on first use."""
+    
+    import msal
+    
+    key = (client_id, authority)
+    with _apps_lock:
+        app = _apps.get(key)
+        if app is None:
+            # Initialize Microsoft Authentication Library (MSAL)
+            # This is the client application that will be used to acquire the token
+            app = msal.PublicClientApplication(
+                client_id,
+                authority=authority,
+                token_cache=_load_msal_cache(),
+                **_msal_options
+            )
+            _apps[key] = app
+    return app
+
+def _app_from_config(config):
+    return _get_app(config.client_id, config.authority), list(config.scopes)
+
+def _acquire_silent(app, scopes, account=None):
+    """Fast path: lets MSAL serve the token from its own cache, refreshing it 
+    with the cached refresh token when needed. account is a home_account_id or
+    username; without one the first cached account is used."""
+    
+    accounts = app.get_accounts()
+    if account is not None:
+        accounts = [ cached for cached in accounts if _is_account(cached, account) ]
+    if not accounts:
+        return None
+    
+    return app.acquire_token_silent(scopes, account=accounts[0])
+
+def _is_account(cached, account):
+    """True if an MSAL account dict is the account given by id or username."""
+    
+    return (cached.get('home_account_id') == account
+                or (cached.get('username') or '').lower() == account.lower())
+
+def _account_key(token_data):
+    """The home_account_id ("<object id>.<tenant id>") of the account a token was
+    issued to, from its id token claims. None if the claims aren't there."""
     
-    if port is None:
-        raise RuntimeError("No free ports available in the allowed range")
-      
-    # Launch a quick and dirty HTTP server. This will be used to receive the
-    # authorization URL from the redirect URI. Otherwise we would need to have
-    # the user manually copy and paste the URL into the browser... EWWW!
-    redirect_uri_base = config['Redirect URI']['base']
-    redirect_uri = f"{redirect_uri_base}:{port}"
-    
-    host = redirect_uri_base.split('//')[1]
-    _socket.close()
-    server = HTTPServer((host, port), _AuthorizationCodeHandler)
-    server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    # # Add claims to force MFA
-    # claims = {
-    #     "access_token": {
-    #         "amr": {
-    #             "values": ["mfa"]
-    #         }
-    #     }
-    # }
-    
-    auth_url = app.get_authorization_request_url(
-        scopes=[scope for scope in config['Scopes'].values()],
-        redirect_uri=redirect_uri#,
-        # prompt='login'#,  # Force fresh login
-        # claims=claims,   # Request MFA
-    )
-    
-    webbrowser.get().open(auth_url, new=1, autoraise=True)
-    server.serve_forever()
-    return server.auth_code, redirect_uri
-
-
-# retrieve_token() currently creates a new app instance every time it is called
-# therefore the app is not cached and the user is forced to login every time
-# TODO: Change this into a class that can be instantiated once and reused
-
-def _retrieve_token():
+    claims = (token_data or {}).get('id_token_claims') or {}
+    if claims.get('oid') and claims.get('tid'):
+        return f"{claims['oid']}.{claims['tid']}"
+    return None
+
+def _account_username(token_data):
+    claims = (token_data or {}).get('id_token_claims') or {}
+    username = claims.get('preferred_username')
+    return username.lower() if username else None
+
+def _retrieve_token(account=None):
     """This is the main function this script is used for. It retrieves a token from
-    Microsoft Graph API using the authorization code after user authentication."""
+    Microsoft Graph API using the authorization code after user authentication.
+    If an account is given, the login page is pre-filled with it and a token for
+    any other account is rejected."""
 
-    # Read the configuration file
     # Azure.cnf contains all information regarding authentication
     # It is used so that this can be configured without changing the code
-    config = configparser.ConfigParser()
-    config.read('azure.cnf')
-
-    tenant_id = config['Tenant']['id'] 
-    client_id = config['Client']['id']
-
-    authority = f'https://login.microsoftonline.com/{tenant_id}'
-    scopes = [ scope for scope in config['Scopes'].values() ]
+    config = _read_config()
 
-    # Initialize Microsoft Authentication Library (MSAL)
-    # This is the client application that will be used to acquire the token
-    app = msal.PublicClientApplication(
-        client_id,
-        authority=authority
-    )
+    app, scopes = _app_from_config(config)
 
     result = None
-    token = None
 
     try:
-        accounts = app.get_accounts()
-
-        if accounts:
-            # Retrieve token from cache if available
-            # Will only work if not expired... should check that down the line
-            # The app will most likely need to be kept alive for accounts to be cached
-            # Maybe a class should be created to keep the app alive? or 
-            # TODO: Check if token is expired and refresh it if necessary
-            # TODO: Specify the account to use from the cache
-            
-            # print(f"Found cached account: {accounts[0]['username']}")
-            result = app.acquire_token_silent(scopes, account=accounts[0])
+        # Retrieve token from cache if available
+        with span('auth.silent'):
+            result = _acquire_silent(app, scopes, account)
         
-        else:
+        if not result or "access_token" not in result:
             # ~The Sauce~
-            
-            # Prompt User login for authentication and retrieve the authorization code
-            auth_code , redirect_uri = _get_auth_code(app, config)
-            
-            if not auth_code:
-                raise ValueError("No authorization code received")
-            
-            # Retrieve token using the authorization code
-            result = app.acquire_token_by_authorization_code(
-                code=auth_code,
-                scopes=scopes,
-                redirect_uri=redirect_uri
-            )
+            with span('auth.interactive_login'):
+                
+                # Prompt User login (browser or device code) for authentication
+                from interactive_login import login
+                login_hint = account if account and '@' in account else None
+                result = login(app, config, login_hint)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+    
+    _persist_msal_cache(app)
         
     if result and "access_token" in result:
         
+        if account and account.lower() not in (_account_key(result), _account_username(result)):
+            logger.error(f"Signed in with a different account than {account}")
+            return None
+        
         return result
     
     return None
 
-def _save_token(token_data):
+def _save_token(token_data, token_file='token.json'):
     """Saves the token data to the token.json cache file.
     Handles errors that may occur when saving the token."""
     
     try:    
-        with open('token.json', 'w') as f:
-            json.dump(token_data, f)
+        write_json(token_file, token_data)
         return True
         
     except json.JSONDecodeError as e:
-        print(f"JSON Decode Error: {e.msg}")
+        logger.error(f"JSON Decode Error: {e.msg}")
     
     except FileNotFoundError as e:
-        print(f"File not found: {e.filename}")
+        logger.warning(f"File not found: {e.filename}")
     
     except PermissionError as e:
-        print(f"Permission Error: {e.filename}")
+        logger.error(f"Permission Error: {e.filename}")
     
     except IsADirectoryError as e:
-        print(f"Is a directory error: {e.filename}")
+        logger.error(f"Is a directory error: {e.filename}")
         
     except IOError as e:
-        print(f"I/O error: {e}")
+        logger.error(f"I/O error: {e}")
     
     except OSError as e:
-        print(f"OS error: {e}")
+        logger.error(f"OS error: {e}")
 
     return False
 
-def _refresh_token(refresh_token):
+def _refresh_token(refresh_token, account=None):
     """This function will use the refresh token to get a new access token.
-    This is used when the token is expired and needs to be refreshed."""
+    This is used when the token is expired and needs to be refreshed.
+    MSAL's own cache is tried first; the refresh token from token.json is
+    only redeemed directly when MSAL has no account cached."""
 
     if not refresh_token:
         return None
     
-    config = configparser.ConfigParser()
-    config.read('azure.cnf')
+    config = _read_config()
     
-    client_id = config['Client']['id']
-    tenant_id = config['Tenant']['id']
-    authority = f'https://login.microsoftonline.com/{tenant_id}'
-
-    scopes = [ scope for scope in config['Scopes'].values() ]
+    app, scopes = _app_from_config(config)
     
-    app = msal.PublicClientApplication(
-        client_id,
-        authority=authority
-    )
+    result = _acquire_silent(app, scopes, account)
+    if not result or "access_token" not in result:
+        result = app.acquire_token_by_refresh_token(
+            refresh_token=refresh_token,
+            scopes=scopes
+        )
     
-    result = app.acquire_token_by_refresh_token(
-        refresh_token=refresh_token,
-        scopes=scopes
-    )
+    _persist_msal_cache(app)
 
     if result and "access_token" in result:
+        # Tokens served from MSAL's cache don't carry the refresh token;
+        # keep the old one so token.json stays refreshable
+        result.setdefault('refresh_token', refresh_token)
         return result
     
     return None
 
-def load_token_data():
-    """Returns Token Data. If token data is stored, it will check that it is still
-    valid and if not, it will refresh the token if possible, otherwise it will fetch
-    a new token by prompting the user for authentication."""
+def _read_config():
+    """The parsed azure.cnf (an AzureConfig), only read again when the file changed."""
+
+    from azure_config import load_config
+
+    return load_config()
+
+def _read_token_file(token_file):
+    """Reads the cached token data from disk. Returns None if the file
+    does not exist or cannot be read."""
     
-    if os.path.exists('token.json'):
-        try:
-            with open('token.json', 'r') as f:
-                token_data = json.load(f)
-            expires_on = token_data.get('expires_on')
-            if expires_on:
-                expires_on = int(expires_on)
-                if expires_on < int(time()):
-                    print("Token has expired. Getting New Token.")
-                    refresh_token = token_data.get('refresh_token')
-                    if not refresh_token:
-                        print("Token has no refresh token.")
-                        return None
-                    token_data = _refresh_token(refresh_token)
-                    token_data['expires_on'] = int(time()) + int(token_data.get('expires_in'))
-                    datestamp = datetime.fromtimestamp(token_data.get('expires_on'))
-                    print(f"Token refreshed. Expires on: {datestamp}")
-                    _save_token(token_data)
-                    if not token_data:
-                        print("Failed to refresh token.")
-            else:
+    if not os.path.exists(token_file):
+        return None
+    
+    try:
+        # Only parsed if the file changed since it was last read
+        with span('auth.token_file'):
+            return read_json(token_file)
+    
+    # Token Error Handling 
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON Decode Error: {e.msg}")
+    
+    except FileNotFoundError as e:
+        logger.warning(f"File not found: {e.filename}")
+
+    except PermissionError as e:
+        logger.error(f"Permission Error: {e.filename}")
+    
+    except IsADirectoryError as e:
+        logger.error(f"Is a directory error: {e.filename}")
+        
+    except IOError as e:
+        logger.error(f"I/O error: {e}")
+    
+    except OSError as e:
+        logger.error(f"OS error: {e}")
+    
+    return None
+
+def _stamp_expiry(token_data):
+    """MSAL only returns the relative 'expires_in'; store the absolute
+    'expires_on' so the cached token can be checked later without MSAL."""
+    
+    token_data['expires_on'] = int(time()) + int(token_data.get('expires_in'))
+    return token_data
+
+def _is_newer(token_data, than):
+    """True if token_data expires later than the token `than` (which may be None)."""
+    
+    if not token_data or not token_data.get('expires_on'):
+        return False
+    return not than or int(token_data['expires_on']) > int(than.get('expires_on') or 0)
+
+def _is_expired(token_data):
+    expires_on = token_data.get('expires_on') if token_data else None
+    if not expires_on:
+        return True
+    return int(expires_on) < int(time())
+
+
+class _RenewalQueue:
+    '''Runs the background renewals of every TokenProvider from a single thread
+    (instead of a threading.Timer, which is a thread, per provider), so a pool of
+    hundreds of accounts doesn't keep hundreds of threads asleep. Each renewal that
+    comes due runs on a short lived thread of its own so slow refreshes don't hold
+    up the others.'''
+    
+    def __init__(self):
+        self._heap = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = None
+    
+    def schedule(self, delay, function, *args):
+        """Calls function(*args) in `delay` seconds. Returns a handle with cancel()."""
+        
+        entry = [time() + delay, 0, function, args]
+        with self._condition:
+            self._sequence += 1
+            entry[1] = self._sequence
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='token-renewal',
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return _Renewal(entry)
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    # Cancelled entries are dropped once they reach the top
+                    while self._heap and self._heap[0][2] is None:
+                        heapq.heappop(self._heap)
+                    wait = self._heap[0][0] - time() if self._heap else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                _, _, function, args = heapq.heappop(self._heap)
+            threading.Thread(target=function, args=args, daemon=True).start()
+
+class _Renewal:
+    __slots__ = ('_entry',)
+    
+    def __init__(self, entry):
+        self._entry = entry
+    
+    def cancel(self):
+        self._entry[2] = None
+
+_renewals = _RenewalQueue()
+
+def call_later(delay, function, *args):
+    """Calls function(*args) in `delay` seconds from the renewal thread, for other
+    modules with something to renew (e.g. subscriptions). Returns a handle with cancel()."""
+    
+    return _renewals.schedule(delay, function, *args)
+
+class TokenProvider:
+    '''Keeps the token data in memory so headers can be handed out without
+    touching the disk. Only one thread refreshes the token at a time, everyone
+    else waits for that refresh and reuses the result. Once a token is loaded,
+    a background timer renews it `renew_margin` seconds before it expires so
+    request threads never have to block on a refresh.
+    
+    A single provider is meant to be created once and kept alive for the 
+    lifetime of the process; get_headers() and load_token_data() use a 
+    module level instance.
+    
+    account (a home_account_id or username) ties the provider to one account 
+    when MSAL has several cached. store, if given, replaces token_file: an object
+    with load(account) and save(account, token_data), like TokenPool.'''
+    
+    def __init__(self, token_file='token.json', renew_margin=300, account=None, store=None):
+        self.token_file = token_file
+        self.renew_margin = renew_margin
+        self.account = account
+        self.store = store
+        
+        # (token_data, headers) are swapped as a single tuple so readers 
+        # never see headers from one token and data from another
+        self._state = (None, None)
+        self._lock = threading.Lock()
+        self._timer = None
+    
+    def get_token_data(self):
+        """Returns the current token data, loading or refreshing it first if needed."""
+        
+        token_data, _ = self._state
+        if not _is_expired(token_data):
+            return token_data
+        
+        with self._lock:
+            # Another thread may have refreshed the token while we were waiting
+            token_data, _ = self._state
+            if not _is_expired(token_data):
+                return token_data
+            
+            with span('auth.token_load') as s:
+                token_data = self._acquire(token_data)
+                s.set(ok=token_data is not None)
+            self._set(token_data)
+            return token_data
+    
+    def get_headers(self):
+        """Returns the Microsoft Graph API headers for the current token."""
+        
+        token_data, headers = self._state
+        if headers is None or _is_expired(token_data):
+            if not self.get_token_data():
+                return None
+            _, headers = self._state
+        
+        # Hand out a copy so callers can add their own headers safely
+        return dict(headers)
+    
+    def invalidate(self):
+        """Drops the in-memory token, forcing the next call to reload it."""
+        
+        with self._lock:
+            self._set(None)
+    
+    def close(self):
+        """Stops the background renewal timer."""
+        
+        with self._lock:
+            self._cancel_timer()
+    
+    def _acquire(self, stale_data):
+        """Loads the token from disk, refreshes it or prompts the user for a 
+        new one. Must be called while holding the lock."""
+        
+        token_data = stale_data
+        if token_data is None:
+            token_data = self._load()
+            if token_data and not token_data.get('expires_on'):
                 token_data = None
+            if not _is_expired(token_data):
+                return token_data
+        
+        with self._shared_lock():
+            # Another process may have refreshed the token while we waited for the lock
+            latest = self._load()
+            if _is_newer(latest, token_data) and not _is_expired(latest):
+                return latest
             
-            if not token_data:
-                print("Token data not found. Retrieving new token.")
-                token_data = _retrieve_token()
-                if not token_data:
-                    print("Failed to retrieve token")
-                    return None
-                expires_on = int(time()) + int(token_data.get('expires_in'))
-                token_data['expires_on'] = expires_on
-                _save_token(token_data)
+            if token_data:
+                logger.info("Token has expired. Getting New Token.")
+                refreshed = self._refresh(token_data)
+                if refreshed:
+                    return refreshed
+                logger.warning("Failed to refresh token.")
             
-            if 'access_token' in token_data:
-                return token_data
+            logger.info("Token data not found. Retrieving new token.")
+            token_data = _retrieve_token(self.account)
+            if not token_data:
+                logger.warning("Failed to retrieve token")
+                return None
+            _stamp_expiry(token_data)
+            self._save(token_data)
+            return token_data
+    
+    def _shared_lock(self):
+        """The lock that keeps other processes from refreshing the same token."""
+        
+        if self.store is not None:
+            return self.store.lock(self.account)
+        return FileLock(f'{self.token_file}.lock')
+    
+    def _load(self):
+        if self.store is not None:
+            return self.store.load(self.account)
+        return _read_token_file(self.token_file)
+    
+    def _save(self, token_data):
+        if self.store is not None:
+            return self.store.save(self.account, token_data)
+        return _save_token(token_data, self.token_file)
+    
+    def _refresh(self, token_data):
+        refresh_token = token_data.get('refresh_token')
+        if not refresh_token:
+            logger.warning("Token has no refresh token.")
+            return None
+        
+        try:
+            with span('auth.refresh') as s:
+                token_data = _refresh_token(refresh_token, self.account)
+                s.set(ok=token_data is not None)
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
+            return None
+        
+        if not token_data:
+            return None
+        
+        _stamp_expiry(token_data)
+        datestamp = datetime.fromtimestamp(token_data.get('expires_on'))
+        logger.info(f"Token refreshed. Expires on: {datestamp}")
+        self._save(token_data)
+        return token_data
+    
+    def _set(self, token_data):
+        headers = None
+        if token_data and 'access_token' in token_data:
+            headers = { 'Authorization': f'Bearer {token_data["access_token"]}',
+                        'Content-Type': 'application/json'  }
+        else:
+            token_data = None
         
-        # Token Error Handling 
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {e.msg}")
+        _, previous = self._state
+        if previous is not None:
+            _token_accounts.pop(previous['Authorization'], None)
+        account = _account_key(token_data) or self.account
+        if headers is not None and account is not None:
+            _token_accounts[headers['Authorization']] = account
         
-        except FileNotFoundError as e:
-            print(f"File not found: {e.filename}")
+        self._state = (token_data, headers)
+        self._schedule_renewal(token_data)
     
-        except PermissionError as e:
-            print(f"Permission Error: {e.filename}")
+    def _schedule_renewal(self, token_data):
+        self._cancel_timer()
+        if not token_data or not token_data.get('refresh_token'):
+            return
+        
+        # Renew ahead of expiry; if the token lives shorter than the margin, 
+        # renew halfway through its lifetime instead of spinning
+        remaining = int(token_data['expires_on']) - time()
+        delay = max(remaining - self.renew_margin, remaining / 2, 0)
         
-        except IsADirectoryError as e:
-            print(f"Is a directory error: {e.filename}")
+        self._timer = _renewals.schedule(delay, self._renew, token_data)
+    
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+    
+    def _renew(self, scheduled_data):
+        """Background renewal. Never prompts the user; if the refresh fails
+        the token is left alone and the next caller after expiry handles it."""
+        
+        with self._lock:
+            token_data, _ = self._state
+            if token_data is not scheduled_data:
+                # Already replaced by a foreground refresh
+                return
             
-        except IOError as e:
-            print(f"I/O error: {e}")
+            with self._shared_lock():
+                # Every process sharing the file schedules the same renewal; 
+                # the first one refreshes and the others pick up its token
+                latest = self._load()
+                if _is_newer(latest, token_data):
+                    self._set(latest)
+                    return
+                
+                refreshed = self._refresh(token_data)
+                if refreshed:
+                    self._set(refreshed)
+
+
+class AsyncTokenProvider:
+    '''asyncio front end to a TokenProvider (by default the module level one, so
+    async code shares the in-memory token, token.json and the renewal timer with
+    everything else in the process). A valid token is handed out without awaiting
+    anything. Otherwise one coroutine loads or refreshes it in a worker thread under
+    an asyncio.Lock, and the others wait for that instead of each taking a thread.'''
+    
+    def __init__(self, provider=None):
+        self.provider = provider
+        self._lock = None
+        self._loop = None
+    
+    async def get_headers(self):
+        """Returns the Microsoft Graph API headers for the current token."""
         
-        except OSError as e:
-            print(f"OS error: {e}")
-        return None
-    else:
-        print("Token data not found. Retrieving new token.")
-        token_data = _retrieve_token()
-        if not token_data:
-            print("Failed to retrieve token")
+        import asyncio
+        
+        headers = self._cached_headers()
+        if headers is not None:
+            return headers
+        
+        # A lock can only be used from the loop it was first used in
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        
+        async with self._lock:
+            # Refreshed by whoever held the lock before us
+            headers = self._cached_headers()
+            if headers is not None:
+                return headers
+            return await asyncio.to_thread(self._target().get_headers)
+    
+    def _target(self):
+        # Looked up on every call so a replaced module level provider is picked up
+        return self.provider or _provider
+    
+    def _cached_headers(self):
+        token_data, headers = self._target()._state
+        if headers is None or _is_expired(token_data):
             return None
-        expires_on = int(time()) + int(token_data.get('expires_in'))
-        token_data['expires_on'] = expires_on
-        _save_token(token_data)
-    return token_data
+        return dict(headers)
+
+
+# Tokens of many accounts in one process, for serving several mailboxes without separate
+# processes and working directories. Accounts are keyed by MSAL's home_account_id,
+# "<object id>.<tenant id>", which identifies the account and its tenant together;
+# usernames work as aliases. All of the tokens are persisted to a single file.
+_POOL_FILE = 'tokens.json'
+
+class TokenPool:
+    '''A TokenProvider per account, created on first use. Every account has its own
+    lock and renewal, so refreshing one account never holds up requests for the
+    others, and finding an account's provider is a dict lookup. The tokens are
+    stored in `token_file` as { home_account_id : token data }.
+    
+    The file can be shared by several processes: each account has its own slot in
+    the lock file, so processes only wait for each other when they refresh the
+    same account.'''
+    
+    def __init__(self, token_file=_POOL_FILE, renew_margin=300):
+        self.token_file = token_file
+        self.renew_margin = renew_margin
+        
+        # Keyed by every name an account was asked for (id and usernames)
+        self._providers = {}
+        self._lock = threading.Lock()
+        
+        # As last read from token_file (shared with file_store's cache, so never
+        # modified). Guarded by _file_lock, which is only ever taken after _lock
+        self._tokens = None
+        self._aliases = {}
+        self._file_lock = threading.Lock()
+    
+    def provider(self, account):
+        """Returns the TokenProvider of the account (home_account_id or username)."""
+        
+        provider = self._providers.get(account)
+        if provider is not None:
+            return provider
+        
+        with self._lock:
+            key = self._resolve(account)
+            provider = self._providers.get(key)
+            if provider is None:
+                provider = TokenProvider(self.token_file, self.renew_margin, 
+                                         account=key, store=self)
+                self._providers[key] = provider
+            self._providers[account] = provider
+        return provider
+    
+    def get_headers(self, account):
+        return self.provider(account).get_headers()
+    
+    def get_token_data(self, account):
+        return self.provider(account).get_token_data()
+    
+    def accounts(self):
+        """Returns the home_account_ids of every account with a stored token."""
+        
+        with self._file_lock:
+            return list(self._loaded())
+    
+    def close(self):
+        """Stops the background renewals of every account."""
+        
+        with self._lock:
+            providers = set(self._providers.values())
+        for provider in providers:
+            provider.close()
+    
+    # load(), save() and lock() are the store TokenProvider works with
+    
+    def load(self, account):
+        with self._file_lock:
+            return self._loaded().get(self._aliases.get(account.lower(), account))
+    
+    def save(self, account, token_data):
+        key = _account_key(token_data) or account
+        
+        # Slot 0 locks the whole file: read, add the account and write back 
+        # without losing accounts other processes saved in the meantime
+        with self._file_lock, FileLock(f'{self.token_file}.lock'):
+            tokens = dict(self._loaded())
+            tokens[key] = token_data
+            for alias in (_account_username(token_data), account.lower()):
+                if alias and alias != key:
+                    self._aliases[alias] = key
+            saved = _save_token(tokens, self.token_file)
+            if saved:
+                self._tokens = tokens
+        
+        # Asked for by username before the id was known: later lookups by id 
+        # must find the same provider
+        if key != account:
+            with self._lock:
+                provider = self._providers.get(account)
+                if provider is not None:
+                    self._providers.setdefault(key, provider)
+        return saved
+    
+    def lock(self, account):
+        return FileLock.for_key(f'{self.token_file}.lock', self._resolve(account))
+    
+    def _resolve(self, account):
+        with self._file_lock:
+            self._loaded()
+            return self._aliases.get(account.lower(), account)
+    
+    def _loaded(self):
+        """Returns the stored tokens, read again only if another process changed
+        the file since. Must be called holding _file_lock."""
+        
+        tokens = _read_token_file(self.token_file)
+        if tokens is None:
+            # Nothing stored yet, or unreadable: keep what we had
+            return self._tokens or {}
+        
+        if tokens is not self._tokens:
+            self._tokens = tokens
+            for key, token_data in tokens.items():
+                username = _account_username(token_data)
+                if username:
+                    self._aliases[username] = key
+        return tokens
+
 
-def get_headers():
+# Authorization header : account its token was issued to (the home_account_id, or the
+# name a TokenPool account was asked for), for code that is only handed the headers and
+# has to tell the accounts' mailboxes apart. Holds the current token of every provider.
+_token_accounts = {}
+
+_provider = TokenProvider()
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_token_pool():
+    """Returns the module level TokenPool used for get_headers(account=...)."""
+    
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = TokenPool()
+    return _pool
+
+def load_token_data(account=None):
+    """Returns Token Data. If token data is stored, it will check that it is still
+    valid and if not, it will refresh the token if possible, otherwise it will fetch
+    a new token by prompting the user for authentication.
+    With an account (home_account_id or username) the token of that account is
+    taken from the token pool (tokens.json) instead of token.json."""
+    
+    if account is not None:
+        return get_token_pool().get_token_data(account)
+    
+    return _provider.get_token_data()
+
+def get_headers(account=None):
     """Returns the headers for the Microsoft Graph API. 
     This will automatically prompt user login if no token is
     found or if the token is expired and it is not possible to
     refresh it.
     The only need for a token is for the headers, so this 
     function simplifies the 
+    
+    With an account, the headers are for that account (see load_token_data).
     """
     
-    token_data = load_token_data()
-    token = token_data.get("access_token")
-    if not token:
-        print("Microsoft Graph API Headers not created")
+    if account is not None:
+        headers = get_token_pool().get_headers(account)
+    else:
+        headers = _provider.get_headers()
+    
+    if not headers:
+        logger.warning("Microsoft Graph API Headers not created")
         return None
     
-    headers = { 'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'  }
+    return headers
+
+def account_of(headers):
+    """Returns the account (home_account_id) whose token is in headers, or None if
+    it isn't known: headers that didn't come from get_headers(), or the token.json
+    token when it has no id token claims."""
     
-    return headers
\ No newline at end of file
+    if not headers:
+        return None
+    return _token_accounts.get(headers.get('Authorization'))
@@ -0,0 +1,177 @@
+import os, threading
+from collections import namedtuple
+from instrumentation import span
+
+# azure.cnf, parsed once. Every token refresh and login used to read and parse the file
+# again with a new ConfigParser and rebuild the scope list; load_config() instead hands
+# out one immutable AzureConfig and only parses the file again once it changed on disk
+# (a stat() per call). Values are checked when the file is parsed, so a typo in a port
+# or a missing scope shows up as a ConfigError naming the entry instead of a KeyError
+# somewhere in the login flow.
+#
+# Folder IDs are not configuration: they are resolved from the folder index that
+# MS_Graph_Mail caches in folder_index.json. A [Folder IDs] section left in azure.cnf by
+# older versions is ignored.
+__all__ = ['AzureConfig', 'ConfigError', 'load_config']
+
+_CONFIG_FILE = 'azure.cnf'
+
+_LOGIN_FLOWS = ('auto', 'browser', 'device_code')
+_LOGIN_TIMEOUT = 300
+
+class ConfigError(ValueError):
+    '''azure.cnf is missing, or one of its entries is missing or invalid.'''
+
+class AzureConfig(namedtuple('AzureConfig', ['tenant_id', 'client_id', 'scopes',
+                                             'redirect_base', 'ports', 'login_flow',
+                                             'login_timeout'])):
+    '''The settings of azure.cnf. scopes is a tuple of scope names, redirect_base the
+    loopback URL the login redirects to (without a port, None if not configured) and
+    ports the (start, end) range, both included, the login listener may use; (0, 0)
+    lets the OS pick any free port. login_flow is 'browser', 'device_code' or 'auto'
+    (the device code flow when there is no browser) and login_timeout the seconds a
+    login may take.'''
+
+    __slots__ = ()
+
+    @property
+    def authority(self):
+        return f'https://login.microsoftonline.com/{self.tenant_id}'
+
+    @property
+    def redirect_host(self):
+        """Host name of redirect_base, e.g. localhost."""
+
+        import urllib.parse
+
+        return urllib.parse.urlsplit(self.redirect_base).hostname if self.redirect_base else None
+
+    @classmethod
+    def parse(cls, text, source = _CONFIG_FILE):
+        """Parses and validates the content of a config file. Raises ConfigError."""
+
+        return cls._from_parser(_parser(text, source), source)
+
+    @classmethod
+    def _from_parser(cls, parser, source):
+        return cls(tenant_id=_required(parser, 'Tenant', 'id', source),
+                   client_id=_required(parser, 'Client', 'id', source),
+                   scopes=_scopes(parser, source),
+                   redirect_base=_redirect_base(parser, source),
+                   ports=_ports(parser, source),
+                   login_flow=_login_flow(parser, source),
+                   login_timeout=_login_timeout(parser, source))
+
+# abspath : (file signature, AzureConfig)
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def load_config(path = _CONFIG_FILE):
+    """Returns the AzureConfig of `path`, parsed again only if the file changed
+    since the last call. Raises ConfigError if it is missing or invalid."""
+
+    key = os.path.abspath(path)
+    try:
+        stat = os.stat(key)
+    except OSError as e:
+        raise ConfigError(f"Can't read {path}: {e.strerror}") from None
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    loaded = _loaded.get(key)
+    if loaded is not None and loaded[0] == signature:
+        return loaded[1]
+
+    with _loaded_lock:
+        loaded = _loaded.get(key)
+        if loaded is None or loaded[0] != signature:
+            with span('config.read', file=path):
+                try:
+                    with open(key, 'r') as f:
+                        text = f.read()
+                except OSError as e:
+                    raise ConfigError(f"Can't read {path}: {e.strerror}") from None
+
+                config = AzureConfig._from_parser(_parser(text, path), path)
+
+            loaded = _loaded[key] = (signature, config)
+        return loaded[1]
+
+def _parser(text, source):
+    import configparser
+
+    # Keys are kept as written; the defaults would lowercase them
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str
+    try:
+        parser.read_string(text, source)
+    except configparser.Error as e:
+        raise ConfigError(f"{source}: {e}") from None
+    return parser
+
+def _required(parser, section, option, source):
+    value = parser.get(section, option, fallback='').strip()
+    if not value:
+        raise ConfigError(f"{source}: [{section}] {option} is missing")
+    return value
+
+def _scopes(parser, source):
+    if not parser.has_section('Scopes'):
+        raise ConfigError(f"{source}: [Scopes] is missing")
+
+    scopes = tuple(scope.strip() for scope in parser['Scopes'].values() if scope.strip())
+    if not scopes:
+        raise ConfigError(f"{source}: [Scopes] has no scopes")
+    return scopes
+
+def _redirect_base(parser, source):
+    import urllib.parse
+
+    base = parser.get('Redirect URI', 'base', fallback='').strip().rstrip('/')
+    if not base:
+        return None
+
+    parts = urllib.parse.urlsplit(base)
+    if parts.scheme not in ('http', 'https') or not parts.hostname or parts.port or parts.path:
+        raise ConfigError(f"{source}: [Redirect URI] base must look like http://localhost, "
+                          f"not {base!r}")
+    return base
+
+def _ports(parser, source):
+    ports = []
+    for option in ('start', 'end'):
+        value = parser.get('Ports', option, fallback='').strip()
+        try:
+            port = int(value) if value else None
+        except ValueError:
+            raise ConfigError(f"{source}: [Ports] {option} must be a number, not {value!r}") from None
+        if port is not None and not 0 <= port <= 65535:
+            raise ConfigError(f"{source}: [Ports] {option} must be between 0 and 65535")
+        ports.append(port)
+
+    start, end = ports
+    if start is None:
+        start = end = 0
+    elif end is None:
+        end = start
+    if end < start:
+        raise ConfigError(f"{source}: [Ports] end is lower than start")
+    return (start, end)
+
+def _login_flow(parser, source):
+    flow = parser.get('Login', 'flow', fallback='auto').strip().lower() or 'auto'
+    if flow not in _LOGIN_FLOWS:
+        raise ConfigError(f"{source}: [Login] flow must be one of {', '.join(_LOGIN_FLOWS)}, "
+                          f"not {flow!r}")
+    return flow
+
+def _login_timeout(parser, source):
+    value = parser.get('Login', 'timeout', fallback='').strip()
+    if not value:
+        return _LOGIN_TIMEOUT
+    try:
+        timeout = float(value)
+    except ValueError:
+        raise ConfigError(f"{source}: [Login] timeout must be a number, not {value!r}") from None
+    if timeout <= 0:
+        raise ConfigError(f"{source}: [Login] timeout must be positive")
+    return timeout
@@ -0,0 +1,977 @@
+import argparse, asyncio, base64, glob, json, os, sys, tempfile, time, subprocess, platform, shutil, threading
+import urllib.parse, urllib.request, urllib.error
+from time import perf_counter
+
+import authentication, MS_Graph_Mail, async_mail
+from mock_servers import MockGraphServer, MockAuthorityServer, AuthorityHttpClient
+from request_scheduler import RequestScheduler
+
+# Offline benchmark harness. Runs the real code paths (get_headers, get_folder_ids,
+# get_messages, ...) against the local stand-ins in mock_servers.py through scripted
+# scenarios, and reports latency percentiles, throughput and how many requests each
+# scenario sent to the mock servers. Results are saved as JSON so runs on different
+# commits can be compared:
+#
+#   python benchmark.py                              # run every scenario
+#   python benchmark.py token_warm folders_cold     # run some of them
+#   python benchmark.py --out old.json ... then later --compare old.json
+#
+# Scenarios that need MSAL (token refresh, app startup) are skipped when it isn't installed.
+
+_BENCH_HEADERS = { 'Authorization' : 'Bearer benchmark', 'Content-Type' : 'application/json' }
+
+_CONFIG = '''[Tenant]
+id=benchmark-tenant
+[Client]
+id=benchmark-client
+[Redirect URI]
+base=http://localhost
+[Ports]
+start=0
+end=0
+[Scopes]
+1=User.Read
+2=Mail.Read
+'''
+
+SCENARIOS = {}
+
+def scenario(name, iterations, needs_msal = False):
+    """Registers a scenario. The function receives the Environment and the number
+    of iterations, and returns a list of per-operation durations in seconds."""
+
+    def register(function):
+        SCENARIOS[name] = (function, iterations, needs_msal)
+        return function
+    return register
+
+class Environment:
+    '''A temporary working directory (the modules use relative paths for azure.cnf,
+    token.json, ...) with the modules pointed at the mock servers.'''
+
+    def __init__(self, latency = 0.0, graph_rate = None):
+        self.latency = latency
+        self.graph_rate = graph_rate
+        self.graph = None
+        self.authority = None
+        # Anything a scenario wants reported besides the timings
+        self.details = {}
+
+    def __enter__(self):
+        self._cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix='msal-bench-')
+        os.chdir(self.directory)
+        with open('azure.cnf', 'w') as f:
+            f.write(_CONFIG)
+
+        self.authority = MockAuthorityServer(latency=self.latency).start()
+        authentication._msal_options['http_client'] = AuthorityHttpClient(self.authority.url)
+        authentication._apps.clear()
+
+        # Unless a service limit is being simulated, don't let the rate limiter
+        # be what the benchmark measures
+        rate = self.graph_rate or 1e9
+        MS_Graph_Mail._scheduler = RequestScheduler(rate=rate, burst=rate)
+        MS_Graph_Mail._pool.close()
+        return self
+
+    def __exit__(self, *exc):
+        for server in (self.graph, self.authority):
+            if server:
+                server.stop()
+        authentication._msal_options.pop('http_client', None)
+        authentication._provider.close()
+        if authentication._pool is not None:
+            authentication._pool.close()
+            authentication._pool = None
+        MS_Graph_Mail._pool.close()
+        os.chdir(self._cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start_graph(self, **options):
+        """Starts (or restarts) the mock Graph server with the given tree / mailbox shape."""
+
+        if self.graph:
+            self.graph.stop()
+        options.setdefault('latency', self.latency)
+        self.graph = MockGraphServer(**options).start()
+        MS_Graph_Mail.GRAPH_ROOT = f'{self.graph.url}/v1.0'
+        self.reset_folder_index()
+        return self.graph
+
+    def reset_folder_index(self):
+        MS_Graph_Mail._folder_indexes.clear()
+        name, extension = os.path.splitext(MS_Graph_Mail._FOLDER_INDEX_FILE)
+        for path in glob.glob(f'{name}*{extension}'):
+            os.remove(path)
+
+    def reset_provider(self):
+        authentication._provider.close()
+        authentication._provider = authentication.TokenProvider()
+
+    def write_token(self, expires_in):
+        token_data = { 'token_type' : 'Bearer', 'access_token' : 'cached-token',
+                       'refresh_token' : 'cached-refresh-token', 'expires_in' : 3600,
+                       'expires_on' : int(time.time()) + expires_in }
+        with open('token.json', 'w') as f:
+            json.dump(token_data, f)
+
+    def request_counts(self):
+        counts = {}
+        for name, server in (('graph', self.graph), ('authority', self.authority)):
+            if server:
+                for endpoint, count in server.reset_counts().items():
+                    counts[f'{name}.{endpoint}'] = count
+        return counts
+
+def _subprocess_environ():
+    """Environment for Python subprocesses that import the modules of this repository."""
+
+    paths = [ os.path.dirname(os.path.abspath(__file__)) ]
+    if os.environ.get('PYTHONPATH'):
+        paths.append(os.environ['PYTHONPATH'])
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(paths))
+
+def _timed(function, iterations, setup = None):
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = perf_counter()
+        function()
+        samples.append(perf_counter() - start)
+    return samples
+
+# ---------------------------------------------------------------- authentication
+
+@scenario('token_warm', 5000)
+def token_warm(env, iterations):
+    """get_headers() with the token already in memory."""
+
+    env.write_token(3600)
+    env.reset_provider()
+    authentication.get_headers()
+    return _timed(authentication.get_headers, iterations)
+
+@scenario('token_disk', 500)
+def token_disk(env, iterations):
+    """Cold start: a new process with a valid token.json."""
+
+    env.write_token(3600)
+    return _timed(authentication.get_headers, iterations, setup=env.reset_provider)
+
+@scenario('token_pool_warm', 5000)
+def token_pool_warm(env, iterations):
+    """get_headers(account=...) rotating over 500 accounts with tokens in memory."""
+
+    expires_on = int(time.time()) + 3600
+    tokens = { f'{i:04}.benchmark-tenant' : {
+                    'token_type' : 'Bearer', 'access_token' : f'token-{i}', 'expires_in' : 3600,
+                    'expires_on' : expires_on, 'id_token_claims' : {
+                        'oid' : f'{i:04}', 'tid' : 'benchmark-tenant',
+                        'preferred_username' : f'user{i}@example.com' } }
+                for i in range(500) }
+    with open(authentication._POOL_FILE, 'w') as f:
+        json.dump(tokens, f)
+
+    accounts = list(tokens)
+    for account in accounts:
+        authentication.get_headers(account=account)
+
+    state = { 'i' : 0 }
+    def lookup():
+        state['i'] += 1
+        authentication.get_headers(account=accounts[state['i'] % len(accounts)])
+    return _timed(lookup, iterations)
+
+@scenario('token_expired', 50, needs_msal=True)
+def token_expired(env, iterations):
+    """Cold start with an expired token.json: refreshed through the mock authority."""
+
+    def setup():
+        env.write_token(-60)
+        env.reset_provider()
+    return _timed(authentication.get_headers, iterations, setup=setup)
+
+# Run by token_refresh_herd in every worker process
+_HERD_WORKER = '''
+import sys, authentication, instrumentation
+from mock_servers import AuthorityHttpClient
+instrumentation.configure_logging(stream=sys.stderr)
+authentication._msal_options['http_client'] = AuthorityHttpClient(sys.argv[1])
+print(authentication.load_token_data()['access_token'])
+'''
+
+@scenario('token_refresh_herd', 5, needs_msal=True)
+def token_refresh_herd(env, iterations):
+    """16 processes starting at once with the same expired token.json."""
+
+    environ = _subprocess_environ()
+    samples = []
+    for _ in range(iterations):
+        env.write_token(-60)
+
+        start = perf_counter()
+        workers = [ subprocess.Popen([sys.executable, '-c', _HERD_WORKER, env.authority.url],
+                                     env=environ, stdout=subprocess.PIPE, text=True)
+                        for _ in range(16) ]
+        tokens = [ worker.communicate()[0].strip() for worker in workers ]
+        samples.append(perf_counter() - start)
+
+        # One process refreshes, the others wait for it and reuse its token, and
+        # token.json is never left half written
+        if any(worker.returncode for worker in workers):
+            raise RuntimeError('A worker process failed')
+        if len(set(tokens)) != 1:
+            raise RuntimeError(f'Workers ended up with {len(set(tokens))} different tokens')
+        with open('token.json') as f:
+            if json.load(f)['access_token'] != tokens[0]:
+                raise RuntimeError('token.json does not hold the shared token')
+    return samples
+
+@scenario('msal_app_startup', 50, needs_msal=True)
+def msal_app_startup(env, iterations):
+    """Creating the MSAL application (authority discovery) when it isn't cached yet."""
+
+    config = authentication._read_config()
+    return _timed(lambda: authentication._app_from_config(config), iterations,
+                  setup=authentication._apps.clear)
+
+@scenario('msal_app_cached', 5000, needs_msal=True)
+def msal_app_cached(env, iterations):
+    """Getting the already created MSAL application."""
+
+    config = authentication._read_config()
+    authentication._app_from_config(config)
+    return _timed(lambda: authentication._app_from_config(config), iterations)
+
+@scenario('config_cached', 5000)
+def config_cached(env, iterations):
+    """Getting the azure.cnf settings on a refresh, with the file unchanged."""
+
+    authentication._read_config()
+    return _timed(authentication._read_config, iterations)
+
+@scenario('config_parse', 500)
+def config_parse(env, iterations):
+    """Parsing and validating azure.cnf, as every refresh used to."""
+
+    import azure_config
+
+    with open('azure.cnf') as f:
+        text = f.read()
+    return _timed(lambda: azure_config.AzureConfig.parse(text), iterations)
+
+class FakeBrowser:
+    '''Stands in for the browser in the login scenarios. Given the login page URL, it
+    does what the login page does after a successful sign-in: calls the redirect URI
+    with a code and the state. Before that it sends `strays` requests a real browser or
+    a port scanner might (a favicon request, a redirect with the wrong state), which the
+    listener has to turn away. With redirect=False only the strays are sent.'''
+
+    def __init__(self, strays = 2, redirect = True):
+        self.strays = strays
+        self.redirect = redirect
+        self.rejected = 0
+
+    def __call__(self, url):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+        redirect_uri, state = query['redirect_uri'][0], query['state'][0]
+
+        requests = [ f'{redirect_uri}/favicon.ico',
+                     f'{redirect_uri}/?code=forged-code&state=forged-state' ][:self.strays]
+        if self.redirect:
+            requests.append(f'{redirect_uri}/?code=mock-auth-code&state={state}')
+
+        # The listener only starts handling requests once the browser was opened
+        threading.Thread(target=self._send, args=(requests,), daemon=True).start()
+
+    def _send(self, requests):
+        for url in requests:
+            try:
+                urllib.request.urlopen(url, timeout=10).close()
+            except urllib.error.HTTPError:
+                self.rejected += 1
+            except OSError:
+                return
+
+def _login_app(env, flow):
+    import interactive_login
+
+    config = authentication._read_config()._replace(login_flow=flow)
+    app, _ = authentication._app_from_config(config)
+    return interactive_login, app, config
+
+@scenario('login_browser', 20, needs_msal=True)
+def login_browser(env, iterations):
+    """Interactive login with a fake browser: port, redirect with two stray requests, code redemption."""
+
+    interactive_login, app, config = _login_app(env, 'browser')
+    browser = FakeBrowser()
+
+    def login():
+        result = interactive_login.login(app, config)
+        if not result or 'access_token' not in result:
+            raise RuntimeError(f'Login failed: {result}')
+
+    original, interactive_login._open_browser = interactive_login._open_browser, browser
+    try:
+        samples = _timed(login, iterations)
+    finally:
+        interactive_login._open_browser = original
+
+    if browser.rejected != 2 * iterations:
+        raise RuntimeError(f'{browser.rejected} stray requests rejected, expected {2 * iterations}')
+    env.details['stray_requests_rejected'] = browser.rejected
+    return samples
+
+@scenario('login_timeout', 5, needs_msal=True)
+def login_timeout(env, iterations):
+    """A login that never redirects back (0.2s login timeout); must give up, not hang."""
+
+    interactive_login, app, config = _login_app(env, 'browser')
+
+    def login():
+        code, _ = interactive_login.get_auth_code(app, config, timeout=0.2)
+        if code is not None:
+            raise RuntimeError('Got a code from a forged redirect')
+
+    original, interactive_login._open_browser = (interactive_login._open_browser,
+                                                 FakeBrowser(redirect=False))
+    try:
+        return _timed(login, iterations)
+    finally:
+        interactive_login._open_browser = original
+
+@scenario('login_device_code', 20, needs_msal=True)
+def login_device_code(env, iterations):
+    """Device code login against the mock authority (signed in on the third poll)."""
+
+    interactive_login, app, config = _login_app(env, 'device_code')
+
+    def login():
+        result = interactive_login.acquire_token_by_device_code(app, config, show=lambda message: None)
+        if not result or 'access_token' not in result:
+            raise RuntimeError(f'Login failed: {result}')
+
+    return _timed(login, iterations)
+
+# Modules a headless process holding a valid token.json should never import
+_LOGIN_MODULES = ('msal', 'interactive_login', 'webbrowser', 'http.server', 'requests',
+                  'cryptography', 'configparser')
+
+@scenario('startup_cached_token', 20)
+def startup_cached_token(env, iterations):
+    """Import time (-X importtime) of authentication in a new process with a valid token.json."""
+
+    env.write_token(3600)
+    code = 'import authentication; authentication.get_headers()'
+    environ = _subprocess_environ()
+
+    samples = []
+    for _ in range(iterations):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=environ,
+                                 capture_output=True, text=True, check=True)
+
+        # Lines look like "import time:       412 |       1873 |   authentication"
+        imported = {}
+        for line in process.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, module = line[len('import time:'):].split('|')
+                if cumulative.strip().isdigit():
+                    imported[module.strip()] = int(cumulative)
+        samples.append(imported['authentication'] / 1e6)
+
+    env.details['modules_imported'] = len(imported)
+    env.details['login_modules_imported'] = sorted(
+        module for module in imported
+            if any(module == name or module.startswith(name + '.') for name in _LOGIN_MODULES))
+    return samples
+
+# ---------------------------------------------------------------- folders
+
+def _folder_scenario(env, iterations, cold, **tree):
+    graph = env.start_graph(**tree)
+    paths = ';'.join(graph.folder_paths(count=50, min_depth=tree.get('depth', 3)))
+    resolve = lambda: MS_Graph_Mail.get_folder_ids(paths, headers=_BENCH_HEADERS)
+    if not cold:
+        resolve()
+        env.request_counts()
+    return _timed(resolve, iterations, setup=env.reset_folder_index if cold else None)
+
+@scenario('folders_cold', 20)
+def folders_cold(env, iterations):
+    """Resolving up to 50 folder paths with no folder index."""
+
+    return _folder_scenario(env, iterations, cold=True, depth=3, breadth=4)
+
+@scenario('folders_warm', 2000)
+def folders_warm(env, iterations):
+    """Resolving up to 50 folder paths from the in-memory folder index."""
+
+    return _folder_scenario(env, iterations, cold=False, depth=3, breadth=4)
+
+@scenario('folders_deep', 20)
+def folders_deep(env, iterations):
+    """Resolving paths 6 folders deep with no folder index."""
+
+    return _folder_scenario(env, iterations, cold=True, depth=6, breadth=2)
+
+# ---------------------------------------------------------------- messages
+
+@scenario('messages_large', 5)
+def messages_large(env, iterations):
+    """get_messages() on a 20,000 message folder, 1,000 per page."""
+
+    env.start_graph(depth=1, breadth=1, messages_per_folder=20000, body_size=2000,
+                    default_page_size=1000)
+    params = { '$select' : 'from,subject,body', '$top' : 1000 }
+    env.write_token(3600)
+    env.reset_provider()
+    return _timed(lambda: MS_Graph_Mail.get_messages('Inbox', params), iterations)
+
+@scenario('messages_first_item', 50)
+def messages_first_item(env, iterations):
+    """Time to the first message from iter_messages() on a large folder."""
+
+    env.start_graph(depth=1, breadth=1, messages_per_folder=20000, default_page_size=100)
+    first = lambda: next(MS_Graph_Mail.iter_messages('Inbox', { '$top' : 100 },
+                                                     headers=_BENCH_HEADERS))
+    return _timed(first, iterations)
+
+# The unread mail of the last day (of the ~3.5 days of mail in the folder), subjects and
+# senders only: the whole folder fetched and filtered locally, or the same as a MessageQuery
+_QUERY_SINCE = '2023-11-17T17:13:20Z'
+
+def _query_scenario(env, iterations, pushdown):
+    """Reports the KB Graph sent per call and the messages returned."""
+
+    from mail_query import MessageQuery
+
+    graph = env.start_graph(depth=1, breadth=1, messages_per_folder=5000, body_size=2000,
+                            default_page_size=1000)
+    query = (MessageQuery().select('subject', 'sender').received(since=_QUERY_SINCE)
+                           .unread().page_size(1000))
+    params = { '$select' : 'from,subject,body,receivedDateTime,isRead', '$top' : 1000 }
+
+    def fetch():
+        if pushdown:
+            return MS_Graph_Mail.get_messages('Inbox', query=query)
+        return [ { 'subject' : message['subject'],
+                   'sender'  : message['from']['emailAddress']['address'] }
+                    for message in MS_Graph_Mail.iter_messages('Inbox', params,
+                                                                headers=_BENCH_HEADERS)
+                        if not message['isRead'] and message['receivedDateTime'] >= _QUERY_SINCE ]
+
+    env.write_token(3600)
+    env.reset_provider()
+    env.details['messages'] = len(fetch())
+    env.request_counts()
+    graph.bytes_sent = 0
+    samples = _timed(fetch, iterations)
+    env.details['kb_per_call'] = round(graph.bytes_sent / iterations / 1024, 1)
+    return samples
+
+@scenario('messages_query_local', 5)
+def messages_query_local(env, iterations):
+    """Unread mail of the last day: whole folder downloaded, filtered locally."""
+
+    return _query_scenario(env, iterations, pushdown=False)
+
+@scenario('messages_query_pushdown', 5)
+def messages_query_pushdown(env, iterations):
+    """The same as a MessageQuery: $filter and $select applied by Graph."""
+
+    return _query_scenario(env, iterations, pushdown=True)
+
+# Fetches one folder in a separate process (so the mock server's own allocations aren't
+# counted) and prints the peak memory traced while consuming the messages one at a time,
+# and while keeping all of them
+_MEMORY_CLIENT = '''
+import sys, json, tracemalloc, MS_Graph_Mail
+MS_Graph_Mail.GRAPH_ROOT = sys.argv[1]
+headers = { 'Authorization' : 'Bearer benchmark' }
+MS_Graph_Mail.get_folder_ids('Inbox', headers=headers)
+fetch = lambda: MS_Graph_Mail.%s('Inbox', %r, headers=headers%s)
+tracemalloc.start()
+for message in fetch():
+    pass
+streamed = tracemalloc.get_traced_memory()[1]
+tracemalloc.reset_peak()
+messages = list(fetch())
+print(json.dumps([streamed, tracemalloc.get_traced_memory()[1]]))
+'''
+
+def _page_decoding(env, iterations, function, **options):
+    """Consumes 2,000 messages with 20 KB bodies, 1,000 per page, one message at a time.
+    The peak memory is measured in a separate process, see _MEMORY_CLIENT."""
+
+    env.start_graph(depth=1, breadth=1, messages_per_folder=2000, body_size=20000,
+                    default_page_size=1000)
+    params = { '$select' : 'from,subject,body', '$top' : 1000 }
+
+    extra = ''.join(f', {key}={value!r}' for key, value in options.items())
+    environ = _subprocess_environ()
+    process = subprocess.run([sys.executable, '-c', _MEMORY_CLIENT % (function, params, extra),
+                              MS_Graph_Mail.GRAPH_ROOT], env=environ, capture_output=True,
+                             text=True, check=True)
+    streamed, kept = json.loads(process.stdout)
+    env.details['peak_mb'] = round(streamed / 2 ** 20, 1)
+    env.details['peak_mb_keeping_all'] = round(kept / 2 ** 20, 1)
+    env.request_counts()
+
+    fetch = getattr(MS_Graph_Mail, function)
+    def consume():
+        for message in fetch('Inbox', params, headers=_BENCH_HEADERS, **options):
+            pass
+    return _timed(consume, iterations)
+
+@scenario('messages_decode_loads', 5)
+def messages_decode_loads(env, iterations):
+    """iter_messages(): whole 20 MB pages through json.loads, as dicts."""
+
+    return _page_decoding(env, iterations, 'iter_messages')
+
+@scenario('messages_decode_stream', 5)
+def messages_decode_stream(env, iterations):
+    """iter_message_records(): the same pages decoded from the stream into records."""
+
+    return _page_decoding(env, iterations, 'iter_message_records')
+
+@scenario('messages_decode_lazy', 5)
+def messages_decode_lazy(env, iterations):
+    """iter_message_records(lazy_bodies=True): records with compressed bodies."""
+
+    return _page_decoding(env, iterations, 'iter_message_records', lazy_bodies=True)
+
+def _multi_folder(env, iterations, max_workers = None, folders = 8, use_async = False):
+    """Fetches `folders` folders x 4 pages with at least 20ms latency, on threads
+    (max_workers) or from one event loop through async_mail."""
+
+    env.start_graph(depth=3 if folders > 16 else 2, breadth=6 if folders > 16 else 4,
+                    messages_per_folder=200, default_page_size=50,
+                    latency=max(env.latency, 0.02))
+    paths = ';'.join(env.graph.folder_paths(count=folders, min_depth=2))
+    MS_Graph_Mail.get_folder_ids(paths, headers=_BENCH_HEADERS)
+    env.request_counts()
+
+    def fetch():
+        results = MS_Graph_Mail.fetch_folders(paths, { '$top' : 50 }, max_workers=max_workers,
+                                              headers=_BENCH_HEADERS)
+        for result in results:
+            if result.error:
+                raise result.error
+
+    async def fetch_async():
+        async for result in async_mail.fetch_folders(paths, { '$top' : 50 }, ordered=False,
+                                                     headers=_BENCH_HEADERS):
+            if result.error:
+                raise result.error
+
+    if not use_async:
+        return _timed(fetch, iterations)
+
+    samples = _timed(lambda: asyncio.run(fetch_async()), iterations)
+    env.details['async_connections'] = async_mail._pool.stats()
+    return samples
+
+@scenario('folders_fetch_serial', 5)
+def folders_fetch_serial(env, iterations):
+    """8 folders x 4 pages with 20ms latency, one folder at a time."""
+
+    return _multi_folder(env, iterations, max_workers=1)
+
+@scenario('folders_fetch_concurrent', 5)
+def folders_fetch_concurrent(env, iterations):
+    """8 folders x 4 pages with 20ms latency, 8 folders in flight."""
+
+    return _multi_folder(env, iterations, max_workers=8)
+
+@scenario('folders_fetch_async', 5)
+def folders_fetch_async(env, iterations):
+    """8 folders x 4 pages with 20ms latency, from one event loop (async_mail)."""
+
+    return _multi_folder(env, iterations, use_async=True)
+
+@scenario('folders_fetch_threads_200', 3)
+def folders_fetch_threads_200(env, iterations):
+    """200 folders x 4 pages with 20ms latency, 16 threads."""
+
+    return _multi_folder(env, iterations, max_workers=16, folders=200)
+
+@scenario('folders_fetch_async_200', 3)
+def folders_fetch_async_200(env, iterations):
+    """200 folders x 4 pages with 20ms latency, one event loop, 16 connections."""
+
+    return _multi_folder(env, iterations, folders=200, use_async=True)
+
+@scenario('throttled_requests', 200)
+def throttled_requests(env, iterations):
+    """get_request() when 20% of responses are 429 with Retry-After: 0."""
+
+    env.start_graph(depth=1, breadth=1, error_rate=0.2, retry_after=0)
+    url = f'{MS_Graph_Mail.GRAPH_ROOT}/me/mailFolders'
+    return _timed(lambda: MS_Graph_Mail.get_request(url, headers=_BENCH_HEADERS), iterations)
+
+# ---------------------------------------------------------------- attachments
+
+# Downloads the attachments in a separate process, like _MEMORY_CLIENT, and prints the
+# peak memory traced: streamed to disk, or the way it used to be done, by listing the
+# attachments with their base64 contentBytes and decoding them in memory
+_ATTACHMENT_CLIENT = '''
+import sys, os, json, base64, tracemalloc, MS_Graph_Mail, mail_attachments, instrumentation
+instrumentation.configure_logging(stream=sys.stderr)
+MS_Graph_Mail.GRAPH_ROOT, directory, streamed = sys.argv[1], sys.argv[2], sys.argv[3] == '1'
+message_ids = json.loads(sys.argv[4])
+headers = { 'Authorization' : 'Bearer benchmark' }
+tracemalloc.start()
+if streamed:
+    for result in mail_attachments.download_attachments(message_ids, directory, headers=headers):
+        assert result.error is None, result.error
+else:
+    for message_id in message_ids:
+        data = MS_Graph_Mail.get_request(f'{MS_Graph_Mail.GRAPH_ROOT}/me/messages/{message_id}/attachments',
+                                         headers=headers)
+        for attachment in data['value']:
+            with open(os.path.join(directory, attachment['id']), 'wb') as f:
+                f.write(base64.b64decode(attachment['contentBytes']))
+print(json.dumps(tracemalloc.get_traced_memory()[1]))
+'''
+
+def _attachment_scenario(env, iterations, streamed, **options):
+    """8 messages with 2 attachments of 4 MB each. Reports MB/s and the peak memory
+    (measured in a separate process, see _ATTACHMENT_CLIENT)."""
+
+    import mail_attachments
+
+    graph = env.start_graph(depth=1, breadth=1, attachments_per_message=2,
+                            attachment_size=4 * 2 ** 20, **options)
+    folder_id = graph.children[None][0]
+    message_ids = [ f'{folder_id}-m{i}' for i in range(8) ]
+    total = 8 * 2 * graph.attachment_size
+
+    def download(directory):
+        if streamed:
+            for result in mail_attachments.download_attachments(message_ids, directory,
+                                                                 headers=_BENCH_HEADERS):
+                if result.error or result.bytes != graph.attachment_size:
+                    raise RuntimeError(f'Download failed: {result}')
+            return
+
+        for message_id in message_ids:
+            data = MS_Graph_Mail.get_request(f'{MS_Graph_Mail.GRAPH_ROOT}/me/messages/{message_id}/attachments',
+                                             headers=_BENCH_HEADERS)
+            for attachment in data['value']:
+                with open(os.path.join(directory, attachment['id']), 'wb') as f:
+                    f.write(base64.b64decode(attachment['contentBytes']))
+
+    directory = tempfile.mkdtemp(dir='.')
+    process = subprocess.run([sys.executable, '-c', _ATTACHMENT_CLIENT, MS_Graph_Mail.GRAPH_ROOT,
+                              directory, '1' if streamed else '0', json.dumps(message_ids)],
+                             env=_subprocess_environ(), capture_output=True, text=True, check=True)
+    env.details['peak_mb'] = round(json.loads(process.stdout) / 2 ** 20, 1)
+    shutil.rmtree(directory)
+    env.request_counts()
+
+    samples = []
+    for _ in range(iterations):
+        # Every iteration gets its first (broken off, with drop_after) downloads
+        graph._downloaded.clear()
+        directory = tempfile.mkdtemp(dir='.')
+        start = perf_counter()
+        download(directory)
+        samples.append(perf_counter() - start)
+
+        expected = b''.join(graph.attachment_chunk(position, graph.attachment_size)
+                            for position in range(0, graph.attachment_size, 64 * 1024))
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                if f.read() != expected:
+                    raise RuntimeError(f'{name} does not hold the attachment')
+        shutil.rmtree(directory)
+
+    env.details['mb_per_s'] = round(total / 2 ** 20 / (sum(samples) / len(samples)), 1)
+    return samples
+
+@scenario('attachments_stream', 5)
+def attachments_stream(env, iterations):
+    """download_attachments(): 16 x 4 MB streamed to disk in 1 MB chunks, 4 at a time."""
+
+    return _attachment_scenario(env, iterations, streamed=True)
+
+@scenario('attachments_inline', 5)
+def attachments_inline(env, iterations):
+    """The same attachments through contentBytes in the listing, decoded in memory."""
+
+    return _attachment_scenario(env, iterations, streamed=False)
+
+@scenario('attachments_resume', 5)
+def attachments_resume(env, iterations):
+    """download_attachments() when every first download breaks off after 1 MB."""
+
+    samples = _attachment_scenario(env, iterations, streamed=True, drop_after=2 ** 20)
+    requests = env.graph.counts.get('attachment.$value', 0)
+    env.details['value_requests_per_attachment'] = round(requests / (16 * iterations), 2)
+    return samples
+
+# ---------------------------------------------------------------- change notifications
+
+@scenario('notifications_push', 50)
+def notifications_push(env, iterations):
+    """10 new messages pushed by change notification, until all 10 are fetched (one $batch)."""
+
+    from mail_notifications import NotificationReceiver, SubscriptionManager
+
+    graph = env.start_graph(depth=1, breadth=1)
+    env.write_token(3600)
+    env.reset_provider()
+
+    with NotificationReceiver(host='127.0.0.1') as receiver:
+        with SubscriptionManager(receiver.url, receiver) as subscriptions:
+            if not subscriptions.subscribe('Inbox'):
+                raise RuntimeError('Subscribing failed')
+
+            graph.notify(count=3, client_state='forged-client-state')
+            if receiver.rejected != 3:
+                raise RuntimeError(f'{receiver.rejected} of 3 forged notifications rejected')
+
+            messages = receiver.messages(timeout=5)
+            def deliver():
+                message_ids = graph.notify(count=10)
+                received = [ next(messages)['id'] for _ in message_ids ]
+                if received != message_ids:
+                    raise RuntimeError('Did not receive the notified messages')
+
+            env.request_counts()
+            samples = _timed(deliver, iterations)
+
+            # Graph asks for the subscription to be renewed; the manager does so right away
+            graph.notify(lifecycle_event='reauthorizationRequired')
+            deadline = time.time() + 5
+            while not graph.counts.get('subscriptions.PATCH'):
+                if time.time() > deadline:
+                    raise RuntimeError('Subscription was not renewed')
+                time.sleep(0.01)
+
+    if graph.subscriptions:
+        raise RuntimeError('Subscription was not deleted')
+    return samples
+
+# ---------------------------------------------------------------- delta sync
+
+@scenario('sync_delta', 20)
+def sync_delta(env, iterations):
+    """sync_messages() polls of a 2,000 message folder, 10 changes per poll, into a store."""
+
+    from message_store import MessageStore
+
+    graph = env.start_graph(depth=1, breadth=1, messages_per_folder=2000, default_page_size=100)
+    folder_id = graph.children[None][0]
+    params = { '$select' : 'from,subject,body,receivedDateTime' }
+    headers = _BENCH_HEADERS
+    store = MessageStore('sync.db')
+
+    def sync():
+        [result] = MS_Graph_Mail.sync_messages('Inbox', params, page_size=1000,
+                                               headers=headers, store=store)
+        return result
+
+    def check(result, changed, removed, resynced):
+        if sorted(message['id'] for message in result.changed) != sorted(changed) or \
+                sorted(result.removed) != sorted(removed) or result.resynced != resynced:
+            raise RuntimeError(f'Unexpected sync result: {len(result.changed)} changed, '
+                               f'{len(result.removed)} removed, resynced={result.resynced}')
+        # Plain 'Inbox' is stored under the well-known folder name
+        if store.count('inbox') != len(graph._live_indices(folder_id)):
+            raise RuntimeError(f'{store.count("inbox")} messages stored')
+
+    try:
+        check(sync(), [ f'{folder_id}-m{i}' for i in range(2000) ], [], True)
+
+        # An expired delta link: everything again, and what was deleted in the
+        # meantime has to disappear from the store as well
+        graph.change_messages(folder_id, removed=range(1500, 1510))
+        graph.expire_delta_links()
+        live = [ f'{folder_id}-m{i}' for i in graph._live_indices(folder_id) ]
+        check(sync(), live, [], True)
+        env.request_counts()
+
+        state = { 'i' : 0 }
+        def change():
+            i = state['i'] = state['i'] + 1
+            edited = [ i * 2, i * 2 + 1 ]
+            deleted = [ 1000 + i * 2, 1000 + i * 2 + 1 ]
+            added = graph.change_messages(folder_id, added=6, changed=edited, removed=deleted)
+            state['expected'] = (added + [ f'{folder_id}-m{j}' for j in edited ],
+                                 [ f'{folder_id}-m{j}' for j in deleted ])
+
+        def poll():
+            state['result'] = sync()
+
+        samples = []
+        for _ in range(iterations):
+            samples.extend(_timed(poll, 1, change))
+            check(state['result'], *state['expected'], False)
+        return samples
+    finally:
+        store.close()
+
+# ---------------------------------------------------------------- local store
+
+@scenario('store_ingest', 1)
+def store_ingest(env, iterations):
+    """Writing 100,000 messages to the MessageStore (one sample per run)."""
+
+    from message_store import MessageStore
+
+    graph = MockGraphServer(depth=1, breadth=1, body_size=500)
+    messages = [ graph._message('bench', i, None) for i in range(100000) ]
+
+    def ingest():
+        store = MessageStore(f'ingest-{perf_counter()}.db')
+        store.add_messages(messages, 'Inbox')
+        store.close()
+    return _timed(ingest, iterations)
+
+@scenario('store_query', 200)
+def store_query(env, iterations):
+    """Subject, date window and full text queries against 100,000 stored messages."""
+
+    from message_store import MessageStore
+
+    graph = MockGraphServer(depth=1, breadth=1, body_size=500)
+    store = MessageStore('query.db')
+    store.add_messages((graph._message('bench', i, None) for i in range(100000)), 'Inbox')
+
+    queries = [ { 'subject' : 'Message 4242 ' },
+                { 'since' : '2023-11-15T00:00:00Z', 'until' : '2023-11-15T06:00:00Z' },
+                { 'search' : 'device AND error', 'limit' : 100 } ]
+    state = { 'i' : 0 }
+
+    def query():
+        state['i'] += 1
+        for _ in store.iter_messages(**queries[state['i'] % len(queries)]):
+            pass
+    try:
+        return _timed(query, iterations)
+    finally:
+        store.close()
+
+# ---------------------------------------------------------------- reporting
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(samples):
+    total = sum(samples)
+    return {
+        'iterations' : len(samples),
+        'mean_ms'    : total / len(samples) * 1000,
+        'min_ms'     : min(samples) * 1000,
+        'p50_ms'     : _percentile(samples, 0.50) * 1000,
+        'p90_ms'     : _percentile(samples, 0.90) * 1000,
+        'p99_ms'     : _percentile(samples, 0.99) * 1000,
+        'max_ms'     : max(samples) * 1000,
+        'ops_per_s'  : len(samples) / total if total else None }
+
+def run(names, iterations = None, latency = 0.0, graph_rate = None):
+    try:
+        import msal
+        has_msal = True
+    except ImportError:
+        has_msal = False
+
+    results = {}
+    for name in names:
+        function, default_iterations, needs_msal = SCENARIOS[name]
+        if needs_msal and not has_msal:
+            results[name] = { 'skipped' : 'msal is not installed' }
+            continue
+
+        with Environment(latency, graph_rate) as env:
+            samples = function(env, iterations or default_iterations)
+            result = summarize(samples)
+            result['requests'] = env.request_counts()
+            result['graph_scheduler'] = MS_Graph_Mail.get_scheduler_stats()
+            result['graph_connections'] = MS_Graph_Mail.get_connection_stats()
+            if env.details:
+                result['details'] = env.details
+        results[name] = result
+    return results
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline = None):
+    print(f"{'scenario':<26}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'ops/s':>12}  round trips")
+    for name, result in results.items():
+        if 'skipped' in result:
+            print(f"{name:<26}  skipped: {result['skipped']}")
+            continue
+
+        # Only real round trips: batched sub-requests and throttled answers are
+        # already counted in the request that carried them
+        requests = sum(count for endpoint, count in result['requests'].items()
+                       if '.batched.' not in endpoint and not endpoint.endswith('.throttled'))
+        requests /= result['iterations']
+        line = (f"{name:<26}{result['p50_ms']:>10.3f}{result['p90_ms']:>10.3f}"
+                f"{result['p99_ms']:>10.3f}{result['ops_per_s']:>12.1f}  {requests:.1f}/op")
+
+        old = (baseline or {}).get(name)
+        if old and 'p50_ms' in old and old['p50_ms']:
+            line += f"  (p50 {(result['p50_ms'] / old['p50_ms'] - 1) * 100:+.1f}% vs baseline)"
+        print(line)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks against local mock servers')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all)')
+    parser.add_argument('--list', action='store_true', help='list the scenarios and exit')
+    parser.add_argument('--iterations', type=int, help='override the iterations of every scenario')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of latency the mock servers add to every request')
+    parser.add_argument('--graph-rate', type=float,
+                        help='simulate a Graph rate limit (requests per second per mailbox)')
+    parser.add_argument('--out', default='benchmark_results.json', help='where to save the results')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, (function, iterations, _) in SCENARIOS.items():
+            print(f'{name:<26}{function.__doc__.strip()}')
+        return 0
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [ name for name in names if name not in SCENARIOS ]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    out = os.path.abspath(args.out)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = run(names, args.iterations, args.latency, args.graph_rate)
+
+    report = { 'commit'    : _commit(),
+               'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'python'    : platform.python_version(),
+               'platform'  : platform.platform(),
+               'latency'   : args.latency,
+               'results'   : results }
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_results(results, baseline)
+    print(f'\nSaved results to {out}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import http.client, ssl, threading, gzip, zlib, urllib.parse
+from collections import namedtuple
+
+# Keep-alive connection pool built on http.client, used in place of urllib.request.urlopen.
+# urlopen opens a brand new TCP + TLS connection for every request, which is most of the
+# latency when resolving folders and paging through mail. This pool keeps connections open
+# per host and hands them back out, so only the first request to a host pays the handshake.
+# Works with both http and https urls, so it can be pointed at a local stand-in server.
+__all__ = ['ConnectionPool', 'Response', 'StreamedResponse']
+
+# data is the response body, already gzip-decoded
+Response = namedtuple('Response', ['status', 'headers', 'data'])
+
+# Errors raised when a kept-alive connection was closed by the server while idle
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                 ConnectionResetError, BrokenPipeError)
+
+class ConnectionPool:
+    '''Thread safe pool of persistent HTTP(S) connections, keyed by (scheme, host, port).
+    At most `max_connections` connections per host are open at once; callers asking
+    for more wait until one is returned to the pool.'''
+
+    def __init__(self, max_connections=8, timeout=30, ssl_context=None):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._counters = { 'requests' : 0, 'opened' : 0, 'reused' : 0, 'discarded' : 0 }
+
+    def request(self, method, url, body=None, headers=None):
+        """Sends the request over a pooled connection and returns a Response.
+        The body is read completely so the connection can go back to the pool."""
+
+        key, path, headers = self._prepare(url, headers)
+
+        with self._slot(key):
+            conn, response = self._open(key, method, path, body, headers)
+            try:
+                data = response.read()
+            except BaseException:
+                self._discard(conn)
+                raise
+            self._release(key, conn, response)
+
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            data = gzip.decompress(data)
+
+        return Response(response.status, response.headers, data)
+
+    def stream(self, method, url, body=None, headers=None):
+        """Sends the request and returns a StreamedResponse as soon as the headers
+        are in, so the body can be read and processed piece by piece. The connection
+        stays checked out (and counts against max_connections) until it is closed."""
+
+        key, path, headers = self._prepare(url, headers)
+
+        slot = self._slot(key)
+        slot.acquire()
+        try:
+            conn, response = self._open(key, method, path, body, headers)
+        except BaseException:
+            slot.release()
+            raise
+        return StreamedResponse(self, key, slot, conn, response)
+
+    def stats(self):
+        """Returns a snapshot of the connection counters, including how many
+        requests reused an already open connection."""
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['idle'] = sum(len(conns) for conns in self._idle.values())
+        return stats
+
+    def close(self):
+        """Closes every idle connection in the pool."""
+
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _prepare(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported URL scheme: {parts.scheme}")
+
+        default_port = 443 if parts.scheme == 'https' else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+
+        headers = dict(headers) if headers else {}
+        headers.setdefault('Accept-Encoding', 'gzip')
+        return key, path, headers
+
+    def _open(self, key, method, path, body, headers):
+        # A reused connection may have been dropped by the server while it sat
+        # in the pool; in that case retry once on a fresh connection
+        while True:
+            conn, reused = self._checkout(key)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except _STALE_ERRORS:
+                self._discard(conn)
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                self._discard(conn)
+                raise
+
+    def _release(self, key, conn, response):
+        """Returns the connection to the pool once its response has been read."""
+
+        if response.will_close:
+            self._discard(conn)
+        else:
+            self._checkin(key, conn)
+
+    def _slot(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = threading.BoundedSemaphore(self.max_connections)
+        return slot
+
+    def _checkout(self, key):
+        with self._lock:
+            self._counters['requests'] += 1
+            idle = self._idle.get(key)
+            if idle:
+                self._counters['reused'] += 1
+                return idle.pop(), True
+            self._counters['opened'] += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout,
+                                               context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _discard(self, conn):
+        conn.close()
+        with self._lock:
+            self._counters['discarded'] += 1
+
+class StreamedResponse:
+    '''Response whose body is read incrementally from the connection with read(size),
+    already gzip-decoded. Use it as a context manager (or call close()): the connection
+    goes back to the pool if the body was read to the end, and is closed otherwise.'''
+
+    def __init__(self, pool, key, slot, conn, response):
+        self.status = response.status
+        self.headers = response.headers
+        self.bytes_read = 0
+
+        self._pool = pool
+        self._key = key
+        self._slot = slot
+        self._conn = conn
+        self._response = response
+        self._done = False
+
+        # 16 + MAX_WBITS: expect a gzip header and trailer
+        gzipped = response.getheader('Content-Encoding', '').lower() == 'gzip'
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+
+    def read(self, size=-1):
+        """Returns up to about `size` bytes of the decoded body (all of it if size
+        is negative), or b'' once the body is exhausted."""
+
+        limit = max(size, 0)
+        while True:
+            # Whatever didn't fit into the last read (mail compresses very well, a
+            # small chunk of gzip can decode to megabytes)
+            if self._decompressor and self._decompressor.unconsumed_tail:
+                data = self._decompressor.decompress(self._decompressor.unconsumed_tail, limit)
+                if data:
+                    return data
+
+            if self._done:
+                return b''
+
+            data = self._response.read() if size < 0 else self._response.read(size)
+            self.bytes_read += len(data)
+
+            if not data:
+                # http.client hands out b'' when the connection closes before
+                # Content-Length bytes came in, instead of raising
+                if self._response.length:
+                    raise http.client.IncompleteRead(b'', self._response.length)
+                self._done = True
+                return self._decompressor.flush() if self._decompressor else b''
+
+            if self._decompressor:
+                data = self._decompressor.decompress(data, limit)
+            # A gzip chunk can decode to nothing (just the header), keep reading then
+            if data:
+                return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        try:
+            # http.client closes the response once the whole body has been read
+            if self._done or self._response.isclosed():
+                self._pool._release(self._key, conn, self._response)
+            else:
+                # Reading the rest could take as long as the whole download
+                self._pool._discard(conn)
+        finally:
+            self._slot.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,168 @@
+import os, json, errno, tempfile, threading, time, zlib
+
+# Multi-process safe files. Several worker processes share token.json (and tokens.json,
+# msal_cache.bin, ...) in the same working directory, so:
+#   - FileLock: advisory lock shared between processes, so only one of them refreshes
+#     a token while the others wait and then reuse the result
+#   - write_atomic: writes a temp file and renames it over the old one, so a reader
+#     never sees a half written file
+#   - read_json: only re-parses a file when it changed since it was last read (mtime,
+#     size and inode), so picking up a sibling's refresh costs a stat()
+# Locks use fcntl record locks, or msvcrt on Windows.
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+__all__ = ['FileLock', 'write_atomic', 'write_json', 'read_json']
+
+# One descriptor per lock file for the whole process. POSIX record locks belong to the
+# process and closing *any* descriptor of the file drops all of them, so lock files
+# are opened once and never closed
+_lock_files = {}
+_lock_files_lock = threading.Lock()
+
+# (fd, slot) : threading.Lock held by the thread owning the slot in this process
+_slot_locks = {}
+
+# Number of slots a lock file is split into for FileLock.for_key; slot 0 is left for
+# locking the whole store
+_KEY_SLOTS = 4096
+
+class FileLock:
+    '''Exclusive advisory lock on one byte (`slot`) of `path`, held by one process
+    at a time, and by one thread of that process. Different slots of the same file are
+    independent locks, so a single lock file can serve many keys.'''
+
+    def __init__(self, path, slot=0):
+        self.path = path
+        self.slot = slot
+
+    @classmethod
+    def for_key(cls, path, key):
+        """The lock of `key` (e.g. an account). Keys that share a slot share a lock."""
+
+        return cls(path, 1 + zlib.crc32(key.encode()) % _KEY_SLOTS)
+
+    def __enter__(self):
+        # Record locks don't keep the threads of a process apart (and one thread's
+        # unlock would release them all), so threads queue on a lock of their own first
+        fd = _lock_file(self.path)
+        local = _slot_lock(fd, self.slot)
+        local.acquire()
+        try:
+            self._lock(fd)
+        except BaseException:
+            local.release()
+            raise
+        return self
+
+    def _lock(self, fd):
+        if fcntl is not None:
+            while True:
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX, 1, self.slot)
+                    return
+                except OSError as e:
+                    # The kernel's deadlock detection sees a process, not its threads:
+                    # two processes each with threads on different slots can look like a
+                    # cycle when none is waiting on itself. Back off and try again
+                    if e.errno != errno.EDEADLK:
+                        raise
+                time.sleep(0.01)
+
+        # msvcrt locks at the file position, which is shared by the threads
+        while True:
+            with _lock_files_lock:
+                os.lseek(fd, self.slot, os.SEEK_SET)
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                    return
+                except OSError:
+                    pass
+            time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        fd = _lock_file(self.path)
+        try:
+            if fcntl is not None:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, self.slot)
+            else:
+                with _lock_files_lock:
+                    os.lseek(fd, self.slot, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            _slot_lock(fd, self.slot).release()
+        return False
+
+def _lock_file(path):
+    path = os.path.abspath(path)
+    fd = _lock_files.get(path)
+    if fd is None:
+        with _lock_files_lock:
+            fd = _lock_files.get(path)
+            if fd is None:
+                fd = _lock_files[path] = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    return fd
+
+def _slot_lock(fd, slot):
+    lock = _slot_locks.get((fd, slot))
+    if lock is None:
+        with _lock_files_lock:
+            lock = _slot_locks.setdefault((fd, slot), threading.Lock())
+    return lock
+
+def write_atomic(path, text):
+    """Replaces the file with `text` in one step: readers see either the old or
+    the new content, never a truncated file. Raises OSError on failure. Returns
+    the signature read_json compares (renaming doesn't change it)."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+            signature = _signature(os.fstat(f.fileno()))
+        os.replace(temp, path)
+        return signature
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+# abspath : ((mtime_ns, size, inode), parsed content)
+_parsed = {}
+
+def write_json(path, data):
+    """write_atomic for JSON. The written data is remembered, so read_json of the
+    same file doesn't parse it again."""
+
+    # The signature is taken before the rename, in case another process
+    # replaces the file again right after
+    signature = write_atomic(path, json.dumps(data))
+    _parsed[os.path.abspath(path)] = (signature, data)
+
+def read_json(path):
+    """Returns the parsed JSON file, parsed again only if the file changed since the
+    last read_json or write_json in this process. The result is shared between
+    callers and must not be modified. Raises OSError / ValueError like json.load."""
+
+    path = os.path.abspath(path)
+    signature = _signature(os.stat(path))
+    cached = _parsed.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(path, 'r') as f:
+        data = json.load(f)
+    _parsed[path] = (signature, data)
+    return data
+
+def _signature(stat):
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
@@ -0,0 +1,220 @@
+import logging, json, math, sys, threading
+from time import perf_counter
+from collections import namedtuple
+
+# Instrumentation for the hot paths: token loads / refreshes / logins, config reads,
+# every HTTP request and folder resolution. When a poll is slow this tells where the
+# time went. It is off by default and costs next to nothing while off: span() hands back
+# a shared no-op object and count() returns straight away.
+#
+#   instrumentation.enable()                  # start recording latency histograms
+#   instrumentation.add_hook(print)           # get every Event as it happens
+#   instrumentation.snapshot()                # { name : { count, p50_ms, ... } }
+#   instrumentation.configure_logging(structured=True)   # JSON log lines
+#
+# Log messages (what used to be print() calls) go through the 'graph_mail' logger, which
+# by default prints the plain message to stdout like before.
+__all__ = ['enable', 'disable', 'is_enabled', 'add_hook', 'remove_hook', 'span', 'count',
+           'snapshot', 'reset', 'configure_logging', 'log_span', 'logger', 'Event']
+
+# kind is 'span' (value is the duration in seconds) or 'count' (value is the increment)
+Event = namedtuple('Event', ['kind', 'name', 'value', 'attrs'])
+
+_enabled = False
+_record_histograms = False
+_hooks = ()
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+
+def enable(histograms = True):
+    """Turns instrumentation on. histograms=False only calls the hooks."""
+
+    global _enabled, _record_histograms
+    _record_histograms = histograms
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def add_hook(hook):
+    """Calls hook(event) for every span and counter. Enables instrumentation
+    (without histograms, unless they were already on)."""
+
+    global _hooks, _enabled
+    with _lock:
+        # Replaced, never mutated, so emitting can iterate without the lock
+        _hooks = _hooks + (hook,)
+    _enabled = True
+
+def remove_hook(hook):
+    global _hooks
+    with _lock:
+        _hooks = tuple(h for h in _hooks if h is not hook)
+
+class _Span:
+    __slots__ = ('name', 'attrs', '_start')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """Adds attributes known only once the work is done (status, bytes, ...)."""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _emit('span', self.name, perf_counter() - self._start, self.attrs)
+        return False
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(name, **attrs):
+    """Times the enclosed block:  with span('http.request', method='GET') as s: ..."""
+
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name, attrs)
+
+def count(name, value = 1, **attrs):
+    if not _enabled:
+        return
+    _emit('count', name, value, attrs)
+
+def _emit(kind, name, value, attrs):
+    event = Event(kind, name, value, attrs)
+
+    if _record_histograms:
+        with _lock:
+            if kind == 'span':
+                histogram = _histograms.get(name)
+                if histogram is None:
+                    histogram = _histograms[name] = _Histogram()
+                histogram.add(value)
+            else:
+                _counters[name] = _counters.get(name, 0) + value
+
+    for hook in _hooks:
+        try:
+            hook(event)
+        except Exception as e:
+            logger.warning(f"Instrumentation hook failed: {e}")
+
+class _Histogram:
+    '''Latency histogram with logarithmic buckets (about 9% wide), so memory stays
+    constant however many samples are recorded.'''
+
+    _BASE = 2 ** (1 / 8)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = math.floor(math.log(max(seconds, 1e-7), self._BASE))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                # Upper edge of the bucket, capped at the largest sample
+                return min(self._BASE ** (bucket + 1), self.max)
+        return self.max
+
+    def summary(self):
+        return { 'count'   : self.count,
+                 'total_ms': self.total * 1000,
+                 'mean_ms' : self.total / self.count * 1000,
+                 'p50_ms'  : self.percentile(0.50) * 1000,
+                 'p90_ms'  : self.percentile(0.90) * 1000,
+                 'p99_ms'  : self.percentile(0.99) * 1000,
+                 'max_ms'  : self.max * 1000 }
+
+def snapshot():
+    """Returns { 'spans' : { name : latency summary }, 'counters' : { name : total } }."""
+
+    with _lock:
+        return { 'spans'    : { name : histogram.summary()
+                                    for name, histogram in _histograms.items() },
+                 'counters' : dict(_counters) }
+
+def reset():
+    """Clears the recorded histograms and counters."""
+
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+# ---------------------------------------------------------------- logging
+
+logger = logging.getLogger('graph_mail')
+
+class _JsonFormatter(logging.Formatter):
+    '''One JSON object per line: time, level, message and any structured fields
+    passed with extra={'fields' : {...}}.'''
+
+    def format(self, record):
+        entry = { 'time'    : self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+                  'level'   : record.levelname,
+                  'logger'  : record.name,
+                  'message' : record.getMessage() }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging(structured = False, stream = sys.stdout, level = logging.INFO,
+                      propagate = False):
+    """Replaces the 'graph_mail' log output. structured=True writes JSON lines;
+    stream=None removes the handler, so records only reach the application's own
+    logging configuration (with propagate=True)."""
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    if stream is not None:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(_JsonFormatter() if structured else logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+    logger.setLevel(level)
+    logger.propagate = propagate
+
+# Same output as the print() calls this replaces
+configure_logging()
+
+def log_span(event):
+    """Hook that writes every span and counter to the log as a structured record."""
+
+    logger.info(f"{event.name} {event.value:.6f}", extra={ 'fields' : dict(
+        event.attrs, event=event.name, kind=event.kind, value=event.value) })
@@ -0,0 +1,256 @@
+import msal, webbrowser, urllib.parse, socketserver, random, secrets, sys
+from time import time, monotonic
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from instrumentation import logger
+
+# Interactive login: opens the browser on the Microsoft login page and runs a small local
+# HTTP server that receives the authorization code from the redirect URI, or, on hosts
+# without a browser, uses the device code flow (the user signs in on another device).
+# This lives in its own module so that authentication.py can hand out cached tokens
+# without importing msal, the browser or the HTTP server machinery. It is only imported
+# when a user actually has to log in.
+#
+# The local server binds its port once (an OS assigned one, or a few random tries in the
+# [Ports] range), only accepts the redirect carrying the state it sent, and gives up after
+# [Login] timeout seconds instead of waiting forever for a browser that never comes back.
+__all__ = ['login', 'get_auth_code', 'acquire_token_by_device_code']
+
+# Random ports tried in a [Ports] range before giving up
+_PORT_ATTEMPTS = 32
+
+# Ports below this need root on most systems; a range including them only uses the rest
+_FIRST_UNPRIVILEGED_PORT = 1024
+
+# Seconds a connection to the local server may stay silent, so a stray connection
+# can't hold up the redirect
+_REQUEST_TIMEOUT = 10
+
+_SUCCESS_PAGE = b"""
+            <html>
+                <body style="text-align: center; padding: 20px;">
+                    <h3>Authentication successful!</h3>
+                    <p>You can close this window now.</p>
+                </body>
+            </html>
+        """
+
+_FAILURE_PAGE = b"""
+            <html>
+                <body style="text-align: center; padding: 20px;">
+                    <h3>Authentication failed</h3>
+                    <p>You can close this window and try again.</p>
+                </body>
+            </html>
+        """
+
+def _open_browser(url):
+    # Replaced in benchmark.py by a fake browser that calls the redirect URI directly
+    webbrowser.get().open(url, new=1, autoraise=True)
+
+class _AuthorizationCodeHandler(BaseHTTPRequestHandler):
+    '''This class handles the authorization code from the redirect URI. It is a simple
+    HTTP request handler that listens for a GET request on the redirect URI. It then
+    extracts the authorization code from the request and stores it in the server's auth_code.
+    Requests without the state of the login (favicon requests, anything else that finds
+    the port) are turned away and the server keeps waiting.'''
+
+    timeout = _REQUEST_TIMEOUT
+
+    def setup(self):
+        # A client that connects and sends nothing mustn't keep the server past its deadline
+        self.timeout = self.server.request_timeout()
+        super().setup()
+
+    def do_GET(self):
+        query_components = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+
+        state = query_components.get('state', [''])[0]
+        if not secrets.compare_digest(state.encode(), self.server.state.encode()):
+            self.send_error(400 if state else 404)
+            return
+
+        # Black Magic!!! wooooo~
+        # On a serious note, this allows the server to access the auth_code variable
+        self.server.auth_code = query_components.get('code', [None])[0]
+        self.server.error = (query_components.get('error_description')
+                                or query_components.get('error', [None]))[0]
+        self.server.done = True
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.end_headers()
+        self.wfile.write(_SUCCESS_PAGE if self.server.auth_code else _FAILURE_PAGE)
+
+    def log_message(self, format, *args):
+        # Suppress logging; only interested in the authorization code
+        return
+
+class _RedirectServer(HTTPServer):
+    '''HTTPServer waiting for one redirect with the given state.'''
+
+    def __init__(self, address, state):
+        super().__init__(address, _AuthorizationCodeHandler)
+        self.state = state
+        self.auth_code = None
+        self.error = None
+        self.done = False
+        self._deadline = None
+
+    def server_bind(self):
+        # HTTPServer also looks up the host's fully qualified name, a DNS query that
+        # can take seconds and that nothing here uses
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address[:2]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def wait(self, timeout):
+        """Handles requests until the redirect arrived or timeout seconds passed.
+        Returns False on timeout."""
+
+        self._deadline = monotonic() + timeout
+        while not self.done:
+            remaining = self._deadline - monotonic()
+            if remaining <= 0:
+                return False
+            self.timeout = remaining
+            self.handle_request()
+        return True
+
+    def request_timeout(self):
+        """Seconds a connection may stay silent: _REQUEST_TIMEOUT, but not past the deadline."""
+
+        if self._deadline is None:
+            return _REQUEST_TIMEOUT
+        return max(min(_REQUEST_TIMEOUT, self._deadline - monotonic()), 0.001)
+
+def _listen(host, ports, state):
+    """Binds the redirect server to a free, unprivileged port of the (start, end)
+    range. The bound server is used as is, so no other process can take the port
+    in between."""
+
+    start, end = ports
+    if start == 0 and end in (0, 65535):
+        # Any port will do; let the OS pick one
+        return _RedirectServer((host, 0), state)
+
+    # A handful of random tries rather than walking up from start, which could
+    # mean thousands of binds when the bottom of the range is busy
+    candidates = range(max(start, _FIRST_UNPRIVILEGED_PORT), end + 1)
+    if not candidates:
+        raise RuntimeError(f"No unprivileged port (>= {_FIRST_UNPRIVILEGED_PORT}) "
+                           f"in {start}-{end}")
+    for port in random.sample(candidates, min(len(candidates), _PORT_ATTEMPTS)):
+        try:
+            return _RedirectServer((host, port), state)
+        except OSError:
+            # Port is already in use; try another one
+            continue
+
+    raise RuntimeError(f"No free port found in {start}-{end}")
+
+def login(app: msal.PublicClientApplication, config, login_hint=None):
+    """Signs a user in with the flow of [Login] flow and returns MSAL's result
+    (a dict with access_token on success). login_hint pre-fills the username
+    on the login page (browser flow only)."""
+
+    flow = config.login_flow
+    if flow == 'auto':
+        flow = 'browser' if _has_browser() else 'device_code'
+
+    if flow == 'device_code':
+        return acquire_token_by_device_code(app, config)
+
+    auth_code, redirect_uri = get_auth_code(app, config, login_hint)
+    if not auth_code:
+        raise ValueError("No authorization code received")
+
+    # Retrieve token using the authorization code
+    return app.acquire_token_by_authorization_code(
+        code=auth_code,
+        scopes=list(config.scopes),
+        redirect_uri=redirect_uri
+    )
+
+def get_auth_code(app: msal.PublicClientApplication, config, login_hint=None, timeout=None):
+    '''This function retrieves the authorization code from a user login.
+       First it binds an HTTP server to a free port from the allowed range, then
+       opens the login page, which redirects back to that server.
+       It then extracts and returns the authorization code from the request.
+       login_hint pre-fills the username on the login page. Returns
+       (None, redirect_uri) if the login failed or took longer than timeout
+       seconds ([Login] timeout by default).
+    '''
+
+    if config.redirect_base is None:
+        raise ValueError("azure.cnf has no [Redirect URI] base")
+    if timeout is None:
+        timeout = config.login_timeout
+
+    # Launch a quick and dirty HTTP server. This will be used to receive the
+    # authorization URL from the redirect URI. Otherwise we would need to have
+    # the user manually copy and paste the URL into the browser... EWWW!
+    # The state ties the redirect to this login; anything else calling the port is ignored
+    state = secrets.token_urlsafe(24)
+    server = _listen(config.redirect_host, config.ports, state)
+    redirect_uri = f"{config.redirect_base}:{server.port}"
+
+    try:
+        # # Add claims to force MFA
+        # claims = {
+        #     "access_token": {
+        #         "amr": {
+        #             "values": ["mfa"]
+        #         }
+        #     }
+        # }
+
+        auth_url = app.get_authorization_request_url(
+            scopes=list(config.scopes),
+            redirect_uri=redirect_uri,
+            state=state,
+            login_hint=login_hint#,
+            # prompt='login'#,  # Force fresh login
+            # claims=claims,   # Request MFA
+        )
+
+        _open_browser(auth_url)
+
+        if not server.wait(timeout):
+            logger.error(f"No login within {timeout:g} seconds")
+            return None, redirect_uri
+    finally:
+        server.server_close()
+
+    if server.error:
+        logger.error(f"Login failed: {server.error}")
+    return server.auth_code, redirect_uri
+
+def acquire_token_by_device_code(app: msal.PublicClientApplication, config, show=None):
+    """Device code flow for hosts without a browser: shows a code to enter at
+    https://microsoft.com/devicelogin on any other device, then waits (up to
+    [Login] timeout seconds) for that sign-in. show receives the instructions
+    and defaults to printing them on stderr. Returns MSAL's result."""
+
+    flow = app.initiate_device_flow(scopes=list(config.scopes))
+    if 'user_code' not in flow:
+        raise ValueError(f"Failed to start the device code flow: "
+                         f"{flow.get('error_description') or flow.get('error')}")
+
+    (show or _show_device_code)(flow['message'])
+
+    # MSAL polls until expires_at
+    flow['expires_at'] = min(flow['expires_at'], time() + config.login_timeout)
+    return app.acquire_token_by_device_flow(flow)
+
+def _show_device_code(message):
+    print(message, file=sys.stderr, flush=True)
+
+def _has_browser():
+    try:
+        webbrowser.get()
+        return True
+    except webbrowser.Error:
+        return False
@@ -0,0 +1,127 @@
+import json, re, codecs
+
+# Incremental decoding of Graph collection pages. json.loads(response.data) holds a page
+# three times at its peak (raw bytes, decoded str and the parsed tree), which with $top=1000
+# and large HTML bodies runs into hundreds of MB. CollectionReader instead reads the body
+# from a stream a chunk at a time and hands out the items of the "value" array one by one,
+# so only the current chunk and the current item are held in memory.
+#
+#   reader = CollectionReader(response.read)
+#   for item in reader:
+#       ...
+#   reader.members.get('@odata.nextLink')      # other top level members, once read
+__all__ = ['CollectionReader']
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+class CollectionReader:
+    '''Parses a JSON object of the form {"value" : [ item, ... ], ...} from `read`
+    (a function like file.read taking a size) and yields the items of `key` one at
+    a time. The other members of the object are collected in .members; those that
+    come after the array are only there once every item has been read.'''
+
+    def __init__(self, read, key = 'value', chunk_size = 64 * 1024):
+        self.key = key
+        self.members = {}
+        self.chunk_size = chunk_size
+
+        self._read = read
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            name = self._value()
+            if not isinstance(name, str):
+                self._fail('Expecting property name')
+            self._expect(':')
+
+            if name == self.key and self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._separator(']'):
+                            break
+            else:
+                self.members[name] = self._value()
+
+            if self._separator('}'):
+                return
+
+    def _value(self):
+        """Decodes the next complete value, reading more data until there is one."""
+
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._text, self._pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self._text) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Grow the read with the pending value, so an item spanning many chunks
+            # is decoded a handful of times instead of once per chunk
+            self._fill(max(self.chunk_size, len(self._text) - self._pos))
+
+    def _separator(self, closing):
+        """Consumes a ',' (returns False) or the closing bracket (returns True)."""
+
+        char = self._peek()
+        self._pos += 1
+        if char == closing:
+            return True
+        if char != ',':
+            self._pos -= 1
+            self._fail(f"Expecting ',' or '{closing}'")
+        return False
+
+    def _expect(self, char):
+        if self._peek() != char:
+            self._fail(f"Expecting '{char}'")
+        self._pos += 1
+
+    def _peek(self):
+        """Skips whitespace and returns the next character."""
+
+        while True:
+            self._pos = _WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._fill(self.chunk_size):
+                self._fail('Unexpected end of data')
+
+    def _fill(self, size):
+        """Appends the next chunk to the buffer, dropping what was already parsed.
+        Returns False at the end of the stream."""
+
+        if self._eof:
+            return False
+
+        self._text = self._text[self._pos:]
+        self._pos = 0
+
+        data = self._read(size)
+        if not data:
+            self._eof = True
+            self._text += self._utf8.decode(b'', final=True)
+            return False
+
+        self._text += self._utf8.decode(data)
+        return True
+
+    def _fail(self, message):
+        raise json.JSONDecodeError(message, self._text, self._pos)
@@ -0,0 +1,218 @@
+import os, http.client, hashlib, re, urllib.parse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import authentication, MS_Graph_Mail
+from instrumentation import logger, span
+
+# Attachment downloads on top of MS_Graph_Mail. Listing attachments normally returns every
+# file inline as base64 contentBytes; list_attachments() selects only the metadata, and the
+# content is streamed from .../attachments/{id}/$value straight to disk in fixed size
+# chunks, so memory stays at one chunk per download however large the file is.
+#
+#   for result in download_attachments(message_ids, 'downloads', max_workers=4):
+#       if result.error: ...
+#
+# A download is written to <file>.part and renamed once complete. If it breaks off, the
+# next attempt (in the same call, or a later run) asks for the rest with a Range header
+# instead of starting over; a server that ignores the range gets the file from the start.
+#
+# account (as for authentication.get_headers) downloads from that account's mailbox;
+# its requests are throttled under that account (MS_Graph_Mail.mailbox_key).
+__all__ = ['Attachment', 'DownloadResult', 'list_attachments', 'download_attachment',
+           'download_attachments']
+
+_ATTACHMENT_FIELDS = 'id,name,contentType,size,isInline,lastModifiedDateTime'
+_CHUNK_SIZE = 1024 * 1024
+
+# Attempts per download; every attempt after the first resumes where the last one stopped
+_ATTEMPTS = 3
+
+_FILE_ATTACHMENT = '#microsoft.graph.fileAttachment'
+
+# kind is Graph's @odata.type without the namespace: fileAttachment, itemAttachment
+# (an attached mail or event, downloaded as MIME) or referenceAttachment (a link,
+# nothing to download)
+Attachment = namedtuple('Attachment', ['message_id', 'id', 'name', 'content_type', 'size',
+                                       'is_inline', 'kind'])
+
+# bytes is the size of the file on disk; resumed the number of bytes already in the .part
+# file from an earlier run. error is None on success, otherwise path is None.
+DownloadResult = namedtuple('DownloadResult', ['attachment', 'path', 'bytes', 'resumed',
+                                               'error'])
+
+def list_attachments(message_id, headers = None, account = None):
+    """Returns the Attachments of a message, without their content."""
+
+    if not headers:
+        headers = authentication.get_headers(account)
+
+    endpoint = f"{_message_url(message_id)}/attachments"
+    with span('attachments.list'):
+        return [ _attachment(message_id, item) for item in
+                    MS_Graph_Mail.iter_pages(endpoint, { '$select' : _ATTACHMENT_FIELDS },
+                                             headers) ]
+
+def download_attachment(attachment, directory = '.', path = None, chunk_size = _CHUNK_SIZE,
+                        headers = None, account = None):
+    """Streams the attachment's content to `path` (by default a file named after the
+    attachment in `directory`) chunk_size bytes at a time. Returns a DownloadResult;
+    failures are reported in it rather than raised."""
+
+    if path is None:
+        path = os.path.join(directory, _file_name(attachment))
+
+    if attachment.kind == 'referenceAttachment':
+        return DownloadResult(attachment, None, 0, 0,
+                              ValueError(f"{attachment.name} is a link, not a file"))
+
+    if not headers:
+        headers = authentication.get_headers(account)
+
+    part = f'{path}.part'
+    resumed = _part_size(part)
+    error = None
+
+    with span('attachments.download') as s:
+        for attempt in range(_ATTEMPTS):
+            try:
+                _fetch(attachment, part, chunk_size, headers)
+                os.replace(part, path)
+                size = os.path.getsize(path)
+                s.set(bytes=size - resumed, attempts=attempt + 1)
+                return DownloadResult(attachment, path, size, resumed, None)
+            except (http.client.HTTPException, OSError) as e:
+                # What was written so far stays in the .part file for the next attempt
+                logger.warning(f"Download of {attachment.name} interrupted: {e}")
+                error = e
+            except RuntimeError as e:
+                error = e
+                break
+
+    return DownloadResult(attachment, None, _part_size(part), resumed, error)
+
+def download_attachments(message_ids, directory = '.', max_workers = 4, include_inline = True,
+                         chunk_size = _CHUNK_SIZE, headers = None, account = None):
+    """Downloads the attachments of all messages into directory, at most max_workers
+    at a time, and yields a DownloadResult for each one as it completes. Memory use
+    is bounded by max_workers * chunk_size."""
+
+    if not headers:
+        headers = authentication.get_headers(account)
+
+    os.makedirs(directory, exist_ok=True)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        listings = [ executor.submit(list_attachments, message_id, headers)
+                        for message_id in message_ids ]
+
+        # Downloads start as soon as their message's listing is in
+        downloads = []
+        for listing in as_completed(listings):
+            try:
+                attachments = listing.result()
+            except RuntimeError as e:
+                logger.error(f"Failed to list attachments: {e}")
+                continue
+
+            downloads.extend(executor.submit(download_attachment, attachment, directory,
+                                             None, chunk_size, headers)
+                                for attachment in attachments
+                                    if include_inline or not attachment.is_inline)
+
+        for download in as_completed(downloads):
+            yield download.result()
+    finally:
+        # Don't start downloads nobody is going to wait for if the caller stops early
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _fetch(attachment, part, chunk_size, headers):
+    """Appends the rest of the content to the .part file. Raises RuntimeError for
+    errors that retrying won't fix."""
+
+    offset = _part_size(part)
+
+    # Ranges count bytes of the response as sent, so don't let it be compressed
+    headers = dict(headers)
+    headers['Accept-Encoding'] = 'identity'
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+
+    url = f"{_message_url(attachment.message_id)}/attachments/" \
+          f"{urllib.parse.quote(attachment.id, safe='')}/$value"
+
+    with MS_Graph_Mail.send_request('GET', url, headers=headers, stream=True) as response:
+        if response.status == 416 and offset:
+            # Nothing left to send, if the .part file holds exactly the whole content
+            size = _range_size(response.headers.get('Content-Range'))
+            if size is None:
+                size = attachment.size
+            if size == offset:
+                return
+            os.remove(part)
+            raise http.client.HTTPException(f"Range from {offset} not satisfiable, "
+                                            f"content is {size} bytes")
+
+        if response.status == 206:
+            start = _range_start(response.headers.get('Content-Range'))
+            if start != offset:
+                # Start over on the next attempt
+                os.remove(part)
+                raise http.client.HTTPException(f"Asked for bytes from {offset}, got {start}")
+        elif response.status == 200:
+            # No range support (or no .part file): the whole content follows
+            offset = 0
+        else:
+            raise RuntimeError(f"Failed to download {attachment.name}: {response.status}")
+
+        with open(part, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+def _attachment(message_id, item):
+    kind = (item.get('@odata.type') or _FILE_ATTACHMENT).rsplit('.', 1)[-1]
+    return Attachment(message_id, item['id'], item.get('name') or item['id'],
+                      item.get('contentType'), item.get('size'), item.get('isInline', False),
+                      kind)
+
+def _message_url(message_id):
+    # /me is the mailbox of the account whose headers the request is sent with
+    return f"{MS_Graph_Mail.GRAPH_ROOT}/me/messages/{urllib.parse.quote(message_id, safe='')}"
+
+# Anything that isn't safe in a file name on Windows or Linux
+_UNSAFE = re.compile(r'[\x00-\x1f<>:"/\\|?*]')
+
+def _file_name(attachment):
+    """A file name that stays the same across runs (so .part files are found again)
+    and doesn't collide between messages: image001.png is in half of all mail."""
+
+    key = f'{attachment.message_id}/{attachment.id}'.encode()
+    name = _UNSAFE.sub('_', attachment.name).strip(' .') or 'attachment'
+    if attachment.kind == 'itemAttachment' and '.' not in name:
+        name = f'{name}.eml'
+    return f'{hashlib.sha1(key).hexdigest()[:12]}-{name[:150]}'
+
+def _part_size(part):
+    try:
+        return os.path.getsize(part)
+    except OSError:
+        return 0
+
+def _range_start(content_range):
+    # bytes <start>-<end>/<size>
+    try:
+        return int(content_range.split(' ', 1)[1].split('-', 1)[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def _range_size(content_range):
+    # bytes */<size> on a 416, bytes <start>-<end>/<size> otherwise
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
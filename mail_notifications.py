@@ -0,0 +1,460 @@
+import json, queue, secrets, threading, urllib.parse
+from time import time
+from datetime import datetime, timezone
+from collections import namedtuple
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import authentication, MS_Graph_Mail
+from instrumentation import logger, span
+
+# Push based ingestion of new mail through Graph change notifications, instead of polling
+# get_messages() on a timer. Graph POSTs a notification to our URL as soon as a message
+# arrives in a subscribed folder; only the messages named in notifications are fetched,
+# 20 per $batch call, so mailboxes that didn't change cost no requests at all.
+#
+#   receiver = NotificationReceiver(port=8400).start()
+#   subscriptions = SubscriptionManager('https://example.org/graph', receiver)
+#   subscriptions.subscribe('Inbox/Logger/Device')
+#   for message in receiver.messages():
+#       ...
+#
+# Graph only delivers to a public https URL; the receiver listens locally and is meant to
+# sit behind whatever exposes that URL (reverse proxy, tunnel). Subscriptions expire
+# after at most 7 days for messages, so the manager renews each one `renew_margin`
+# seconds before it expires (from the token renewal thread of authentication.py).
+# Graph delivers at least once: a message can be handed out twice.
+__all__ = ['NotificationReceiver', 'SubscriptionManager', 'Subscription', 'Notification']
+
+# Graph allows up to 10080 minutes for message subscriptions
+_LIFETIME = 3 * 24 * 60 * 60
+_RENEW_MARGIN = 60 * 60
+
+# A failed renewal is retried after _RETRY_DELAY seconds, doubling with every further
+# failure up to _MAX_RETRY_DELAY
+_RETRY_DELAY = 5
+_MAX_RETRY_DELAY = 15 * 60
+
+# Notification payloads are small (a few KB); anything bigger isn't from Graph
+_MAX_BODY = 1024 * 1024
+
+_MESSAGE_FIELDS = 'from,subject,body,receivedDateTime'
+
+# A change notification about a message. lifecycle_event is set (and message_id None)
+# for lifecycle notifications: reauthorizationRequired, subscriptionRemoved or missed.
+# account is the token pool account the subscription was made for (None: the default).
+Notification = namedtuple('Notification', ['subscription_id', 'change_type', 'message_id',
+                                           'resource', 'lifecycle_event', 'account'],
+                          defaults=(None,))
+
+# id is Graph's subscription id, resource the folder's messages collection and expires
+# the expiration as a unix timestamp
+Subscription = namedtuple('Subscription', ['id', 'folder', 'resource', 'client_state',
+                                           'expires'])
+
+class _NotificationHandler(BaseHTTPRequestHandler):
+    '''Receives Graph's notification POSTs. Answers the validation request Graph sends
+    when a subscription is created (echoing validationToken), and queues notifications
+    whose clientState is one of the receiver's, rejecting the rest. Replies right away
+    (202): Graph expects an answer within a few seconds and retries otherwise.'''
+
+    timeout = 10
+
+    def do_POST(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+
+        # Subscription validation: echo the token back as plain text
+        token = query.get('validationToken', [None])[0]
+        if token is not None:
+            self._reply(200, token.encode(), 'text/plain')
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if not 0 < length <= _MAX_BODY:
+            self._reply(400)
+            return
+
+        try:
+            items = json.loads(self.rfile.read(length)).get('value', [])
+        except (ValueError, AttributeError):
+            items = None
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            self._reply(400)
+            return
+
+        status = self.server.receiver._accept(items)
+        self._reply(status)
+
+    def _reply(self, status, body = b'', content_type = None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Suppress logging; every notification would be a line
+        return
+
+class NotificationReceiver:
+    '''Embedded HTTP server receiving Graph change notifications on (host, port).
+    Accepted notifications wait in a queue of at most `max_queue` items; when it is
+    full Graph is told to retry later (503). messages() fetches what they point at.'''
+
+    def __init__(self, host = 'localhost', port = 0, max_queue = 10000):
+        self.host = host
+        self.port = port
+        self.rejected = 0
+        self.on_lifecycle = None
+
+        self._queue = queue.Queue(max_queue)
+        # client state : (subscription id, account); the id is None until the
+        # subscription has been created. Guarded by _lock: the server's threads
+        # look states up while subscriptions come and go
+        self._client_states = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._stopped = threading.Event()
+
+    @property
+    def url(self):
+        """Local URL of the receiver; Graph needs it exposed over https."""
+
+        return f'http://{self.host}:{self._server.server_address[1]}'
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), _NotificationHandler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        self._stopped.clear()
+        threading.Thread(target=self._server.serve_forever, name='notification-receiver',
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def register(self, client_state, subscription_id = None, account = None):
+        """Accepts notifications carrying client_state (from subscription_id, once known).
+        Their messages are fetched with the token of account."""
+
+        with self._lock:
+            self._client_states[client_state] = (subscription_id, account)
+
+    def unregister(self, client_state):
+        with self._lock:
+            self._client_states.pop(client_state, None)
+
+    def notifications(self, timeout = None):
+        """Yields the queued notifications as they arrive, until stop() or, with a
+        timeout, until nothing arrived for that many seconds."""
+
+        while not self._stopped.is_set():
+            try:
+                yield self._queue.get(timeout=timeout if timeout is not None else 1)
+            except queue.Empty:
+                if timeout is not None:
+                    return
+
+    def messages(self, select = _MESSAGE_FIELDS, batch_size = MS_Graph_Mail.BATCH_LIMIT,
+                 timeout = None, headers = None):
+        """Yields the messages that notifications were received for, fetched with
+        $batch: whatever is queued (up to batch_size ids) goes out in one call per
+        account. Each message is fetched with the token of the account its
+        subscription was made for, unless headers are given. Messages deleted
+        before they could be fetched are skipped. Stops like notifications()."""
+
+        for notification in self.notifications(timeout):
+            batch = [ notification ]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # account : ids; dicts keep the order and drop repeated notifications
+            # of one message
+            accounts = {}
+            for notification in batch:
+                if notification.message_id:
+                    accounts.setdefault(notification.account, {})[notification.message_id] = None
+
+            for account, ids in accounts.items():
+                yield from self._fetch(list(ids), select,
+                                       headers or authentication.get_headers(account))
+
+    def _fetch(self, ids, select, headers):
+        query = urllib.parse.urlencode({ '$select' : select }) if select else None
+        urls = [ f"/me/messages/{urllib.parse.quote(message_id, safe='')}"
+                 + (f'?{query}' if query else '') for message_id in ids ]
+
+        with span('notifications.fetch', messages=len(ids)):
+            responses = MS_Graph_Mail.batch_requests(urls, headers)
+
+        for message_id, response in zip(ids, responses):
+            if response.status == 200:
+                yield response.body
+            elif response.status != 404:
+                logger.warning(f"Failed to get message {message_id}: {response.status}")
+
+    def _accept(self, items):
+        """Queues the notifications with a known client state. Returns the status
+        to answer Graph with."""
+
+        notifications = []
+        for item in items:
+            client_state = item.get('clientState') or ''
+            subscription_id = item.get('subscriptionId')
+
+            with self._lock:
+                entry = self._client_states.get(client_state)
+                if entry is None or entry[0] not in (None, subscription_id):
+                    self.rejected += 1
+                    continue
+            account = entry[1]
+
+            resource_data = item.get('resourceData') or {}
+            notifications.append(Notification(subscription_id, item.get('changeType'),
+                                              resource_data.get('id'), item.get('resource'),
+                                              item.get('lifecycleEvent'), account))
+
+        if len(items) and not notifications:
+            logger.warning(f"Rejected {len(items)} notifications with an unknown clientState")
+            return 202
+
+        for notification in notifications:
+            if notification.lifecycle_event:
+                if self.on_lifecycle:
+                    self.on_lifecycle(notification)
+                continue
+            try:
+                self._queue.put_nowait(notification)
+            except queue.Full:
+                # Graph redelivers the whole notification later; the ones already
+                # queued will be handed out twice, which at least once allows
+                logger.warning("Notification queue is full")
+                return 503
+        return 202
+
+class SubscriptionManager:
+    '''Creates Graph subscriptions for new messages in mail folders, delivered to
+    notification_url (the public URL of `receiver`), and keeps them alive: each one
+    is renewed renew_margin seconds before it expires, and recreated if Graph
+    dropped it or it expired before a renewal went through. account selects the
+    token pool account, like authentication.get_headers, for the subscriptions and
+    for fetching their messages.'''
+
+    def __init__(self, notification_url, receiver, lifetime = _LIFETIME,
+                 renew_margin = _RENEW_MARGIN, change_type = 'created', account = None):
+        self.notification_url = notification_url
+        self.receiver = receiver
+        self.lifetime = lifetime
+        self.renew_margin = renew_margin
+        self.change_type = change_type
+        self.account = account
+
+        receiver.on_lifecycle = self._on_lifecycle
+
+        self._lock = threading.Lock()
+        # subscription id : (Subscription, renewal handle)
+        self._subscriptions = {}
+        # subscription id : renewals failed in a row
+        self._failures = {}
+
+    def subscribe(self, folder_paths = None):
+        """Subscribes to the folders (';' separated paths, as for get_messages).
+        Returns a Subscription per folder that could be subscribed. The paths are
+        resolved in the folder index of the manager's account."""
+
+        folder_ids = MS_Graph_Mail.get_folder_ids(folder_paths, headers=self._headers(),
+                                                  account=self.account)
+
+        subscriptions = []
+        for folder, folder_id in folder_ids.items():
+            subscription = self._create(folder, folder_id)
+            if subscription:
+                subscriptions.append(subscription)
+        return subscriptions
+
+    def subscriptions(self):
+        with self._lock:
+            return [ subscription for subscription, _ in self._subscriptions.values() ]
+
+    def renew(self, subscription_id):
+        """Extends the subscription by `lifetime`; recreates it if Graph no longer has it
+        or it has expired. Failed renewals and recreations are retried with exponential
+        backoff."""
+
+        with self._lock:
+            entry = self._subscriptions.get(subscription_id)
+        if entry is None:
+            return None
+        subscription = entry[0]
+
+        now = time()
+        if subscription.expires <= now:
+            # Too late to renew, Graph has dropped it
+            logger.warning(f"Subscription for {subscription.folder} expired, recreating it")
+            return self._recreate(subscription)
+
+        expires = now + self.lifetime
+        status, data = MS_Graph_Mail.request_json(
+            'PATCH', _subscription_url(subscription.id),
+            { 'expirationDateTime' : _format_time(expires) }, self._headers())
+
+        if status == 404:
+            logger.warning(f"Subscription for {subscription.folder} is gone, recreating it")
+            # As good as expired, which is what a retry should see
+            return self._recreate(subscription._replace(expires=now))
+
+        if status != 200:
+            # Not past the expiration: the attempt due then recreates it instead
+            delay = min(self._retry_delay(subscription), subscription.expires - now)
+            logger.error(f"Failed to renew subscription for {subscription.folder}: {status}, "
+                         f"retrying in {delay:g} seconds")
+            self._schedule(subscription, delay=delay)
+            return None
+
+        with self._lock:
+            self._failures.pop(subscription.id, None)
+        subscription = subscription._replace(expires=_parse_time(
+            data.get('expirationDateTime')) or expires)
+        self._schedule(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription_id):
+        with self._lock:
+            entry = self._subscriptions.get(subscription_id)
+        if entry is None:
+            return
+
+        self._forget(entry[0])
+        status, _ = MS_Graph_Mail.request_json('DELETE', _subscription_url(subscription_id),
+                                               None, self._headers())
+        if status not in (204, 404):
+            logger.warning(f"Failed to delete subscription {subscription_id}: {status}")
+
+    def close(self):
+        """Deletes every subscription."""
+
+        for subscription in self.subscriptions():
+            self.unsubscribe(subscription.id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _create(self, folder, folder_id, resource = None):
+        resource = resource or f"me/mailFolders('{folder_id}')/messages"
+        client_state = secrets.token_urlsafe(32)
+        expires = time() + self.lifetime
+
+        # Registered first: Graph may deliver before the POST returns
+        self.receiver.register(client_state, account=self.account)
+
+        payload = {
+            'changeType'                : self.change_type,
+            'notificationUrl'           : self.notification_url,
+            'lifecycleNotificationUrl'  : self.notification_url,
+            'resource'                  : resource,
+            'expirationDateTime'        : _format_time(expires),
+            'clientState'               : client_state }
+
+        with span('notifications.subscribe', folder=folder):
+            status, data = MS_Graph_Mail.request_json(
+                'POST', f"{MS_Graph_Mail.GRAPH_ROOT}/subscriptions", payload, self._headers())
+
+        if status != 201 or not data:
+            self.receiver.unregister(client_state)
+            logger.error(f"Failed to subscribe to {folder}: {status} {data}")
+            return None
+
+        self.receiver.register(client_state, data['id'], self.account)
+        subscription = Subscription(data['id'], folder, resource, client_state,
+                                    _parse_time(data.get('expirationDateTime')) or expires)
+        self._schedule(subscription)
+        return subscription
+
+    def _recreate(self, subscription):
+        """Replaces an expired subscription. If that fails the expired one is kept,
+        and recreating it is retried like a failed renewal."""
+
+        created = self._create(subscription.folder, None, subscription.resource)
+        if created is None:
+            delay = self._retry_delay(subscription)
+            logger.error(f"Failed to recreate subscription for {subscription.folder}, "
+                         f"retrying in {delay:g} seconds")
+            self._schedule(subscription, delay=delay)
+            return None
+
+        self._forget(subscription)
+        return created
+
+    def _retry_delay(self, subscription):
+        """Counts a failed attempt; the delay doubles with every failure in a row."""
+
+        with self._lock:
+            failures = self._failures[subscription.id] = \
+                self._failures.get(subscription.id, 0) + 1
+        return min(_RETRY_DELAY * 2 ** (failures - 1), _MAX_RETRY_DELAY)
+
+    def _schedule(self, subscription, delay = None):
+        if delay is None:
+            delay = max(subscription.expires - time() - self.renew_margin, 0)
+
+        with self._lock:
+            previous = self._subscriptions.get(subscription.id)
+            if previous is not None:
+                previous[1].cancel()
+            renewal = authentication.call_later(delay, self.renew, subscription.id)
+            self._subscriptions[subscription.id] = (subscription, renewal)
+
+    def _forget(self, subscription):
+        with self._lock:
+            entry = self._subscriptions.pop(subscription.id, None)
+            self._failures.pop(subscription.id, None)
+        if entry is not None:
+            entry[1].cancel()
+        self.receiver.unregister(subscription.client_state)
+
+    def _on_lifecycle(self, notification):
+        # Called from the receiver's request thread, which has to answer quickly
+        if notification.lifecycle_event in ('reauthorizationRequired', 'subscriptionRemoved'):
+            authentication.call_later(0, self.renew, notification.subscription_id)
+        elif notification.lifecycle_event == 'missed':
+            logger.warning("Graph missed notifications; run sync_messages() to catch up")
+
+    def _headers(self):
+        return authentication.get_headers(self.account)
+
+def _subscription_url(subscription_id):
+    return f"{MS_Graph_Mail.GRAPH_ROOT}/subscriptions/{subscription_id}"
+
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def _parse_time(value):
+    """Unix timestamp of a Graph dateTime, None if missing or malformed."""
+
+    if not value:
+        return None
+    try:
+        # Graph sends up to 7 fractional digits, which fromisoformat doesn't take before 3.11
+        value = value.rstrip('Z')
+        if '.' in value:
+            head, fraction = value.split('.', 1)
+            value = f'{head}.{fraction[:6]}'
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
@@ -0,0 +1,381 @@
+from datetime import datetime, date, timezone
+from collections import namedtuple
+
+# Message queries that Graph answers on the server. get_messages() used to ask for
+# from, subject and the full HTML body of everything received today and then threw most
+# of it away; a MessageQuery says which fields are wanted and which messages, and
+# compile() turns that into $select / $filter / $search / $orderby / $top and, when the
+# body is selected, Prefer: outlook.body-content-type="text" (plain text bodies are a
+# fraction of the HTML).
+#
+#   query = (MessageQuery().select('subject', 'sender')
+#                          .received(since=date.today() - timedelta(days=7))
+#                          .sender('alice@contoso.com').unread()
+#                          .order_by('received', descending=True).limit(50))
+#   messages = MS_Graph_Mail.get_messages('inbox', query=query)
+#
+# Predicates Graph can't evaluate (a sender domain, read state in a $search, a custom
+# test) are checked on the messages as they arrive instead; CompiledQuery.client_side
+# lists them, so it's visible which part of a query doesn't shrink the download.
+# Combinations Graph rejects raise a QueryError before any request is sent.
+__all__ = ['MessageQuery', 'CompiledQuery', 'QueryError', 'FIELDS']
+
+# Field names of a query and the Graph properties they select
+FIELDS = {
+    'id'              : 'id',
+    'subject'         : 'subject',
+    'sender'          : 'from',
+    'to'              : 'toRecipients',
+    'received'        : 'receivedDateTime',
+    'sent'            : 'sentDateTime',
+    'body'            : 'body',
+    'preview'         : 'bodyPreview',
+    'is_read'         : 'isRead',
+    'has_attachments' : 'hasAttachments',
+    'importance'      : 'importance',
+    'categories'      : 'categories',
+    'conversation_id' : 'conversationId',
+}
+
+# What get_messages() returns by default
+_DEFAULT_FIELDS = ('subject', 'body')
+
+# Fields Graph can sort messages by
+_ORDER_FIELDS = ('received', 'sent', 'subject')
+
+# Largest $top Graph accepts for messages
+_MAX_TOP = 1000
+
+# Lower bound that matches every message, for ordering by a date that isn't filtered on
+_EPOCH = '1900-01-01T00:00:00Z'
+
+_BODY_TYPES = ('text', 'html')
+
+class QueryError(ValueError):
+    '''The query asks for something Graph doesn't support, or is contradictory.'''
+
+# One condition on a message. filter is its $filter expression and search its KQL term
+# for $search (None if Graph has no way to express it); search_exact is False when the
+# KQL term matches more than the condition, so it has to be checked again locally.
+# properties are the Graph properties test() reads from a message.
+_Predicate = namedtuple('_Predicate', ['description', 'filter', 'search', 'search_exact',
+                                       'properties', 'test'])
+
+class CompiledQuery(namedtuple('CompiledQuery', ['params', 'headers', 'fields', 'limit',
+                                                 'client_side', 'tests'])):
+    '''A MessageQuery translated for Graph. params are the query parameters and headers
+    the extra request headers; fields the query's field names and limit the most
+    messages to return (None for all). client_side describes the predicates that are
+    evaluated locally, by matches(), on the messages Graph returns.'''
+
+    __slots__ = ()
+
+    def matches(self, message):
+        """True if the raw Graph message passes the client side predicates."""
+
+        return all(test(message) for test in self.tests)
+
+    def project(self, message):
+        """The selected fields of a raw Graph message, keyed by field name. sender is
+        the address, to a list of addresses and body the content."""
+
+        return { field : _value(message, field) for field in self.fields }
+
+class MessageQuery:
+    '''Builds a message query. Every method returns a new MessageQuery, so a base
+    query can be shared and extended. Dates are datetimes (naive ones are local time),
+    dates (local midnight) or ISO 8601 strings; ranges include since and exclude until.'''
+
+    def __init__(self):
+        self._fields = _DEFAULT_FIELDS
+        self._body_type = 'text'
+        self._predicates = ()
+        self._search = None
+        self._order = ()
+        self._limit = None
+        self._page_size = None
+
+    def select(self, *fields):
+        """The fields to return (see FIELDS). Replaces the default subject and body."""
+
+        unknown = [ field for field in fields if field not in FIELDS ]
+        if unknown or not fields:
+            raise QueryError(f"Unknown fields {unknown}, expected some of {list(FIELDS)}")
+        return self._with(_fields=tuple(dict.fromkeys(fields)))
+
+    def body_type(self, body_type):
+        """'text' (the default) or 'html', the format Graph sends the body in."""
+
+        if body_type not in _BODY_TYPES:
+            raise QueryError(f"Body type must be one of {_BODY_TYPES}, not {body_type!r}")
+        return self._with(_body_type=body_type)
+
+    def received(self, since = None, until = None):
+        """Messages received in [since, until)."""
+
+        return self._date_range('received', 'receivedDateTime', since, until)
+
+    def sent(self, since = None, until = None):
+        """Messages sent in [since, until)."""
+
+        return self._date_range('sent', 'sentDateTime', since, until)
+
+    def sender(self, *addresses):
+        """Messages from any of the addresses. '@contoso.com' matches a whole domain,
+        which Graph can't filter on and is checked locally."""
+
+        if not addresses:
+            raise QueryError("sender() needs at least one address")
+        addresses = tuple(address.strip().lower() for address in addresses)
+        exact = [ address for address in addresses if not address.startswith('@') ]
+        domains = tuple(address for address in addresses if address.startswith('@'))
+
+        def test(message):
+            address = (_value(message, 'sender') or '').lower()
+            return address in exact or address.endswith(domains)
+
+        if domains:
+            # Graph doesn't support endswith() on addresses; $search can narrow it down
+            return self._add(f"sender in {list(addresses)}", None,
+                             ' OR '.join(f'from:{_kql(address.lstrip("@"))}'
+                                         for address in addresses),
+                             False, ('from',), test)
+
+        clauses = [ f"from/emailAddress/address eq {_literal(address)}" for address in exact ]
+        expression = clauses[0] if len(clauses) == 1 else f"({' or '.join(clauses)})"
+        return self._add(f"sender in {exact}", expression,
+                         ' OR '.join(f'from:{_kql(address)}' for address in exact),
+                         True, ('from',), test)
+
+    def subject_contains(self, text):
+        """Messages whose subject contains text, ignoring case."""
+
+        if not text:
+            raise QueryError("subject_contains() needs some text")
+        needle = text.lower()
+        # KQL matches words, not substrings: the search only narrows it down
+        return self._add(f"subject contains {text!r}", f"contains(subject,{_literal(text)})",
+                         ' AND '.join(f'subject:{_kql(word)}' for word in text.split()),
+                         False, ('subject',),
+                         lambda message: needle in (message.get('subject') or '').lower())
+
+    def unread(self):
+        return self._read_state(False)
+
+    def read(self):
+        return self._read_state(True)
+
+    def has_attachments(self, value = True):
+        """Messages with (or without) attachments. Inline images count as attachments
+        for Graph only if they are file attachments."""
+
+        return self._add(f"has_attachments is {value}",
+                         f"hasAttachments eq {str(value).lower()}",
+                         f"hasattachments:{str(value).lower()}", True, ('hasAttachments',),
+                         lambda message: message.get('hasAttachments') is value)
+
+    def search(self, text):
+        """Full text search (KQL) over subject, body, sender and recipients. Graph
+        doesn't combine $search with $filter or $orderby: the other predicates go into
+        the search as far as KQL can express them, the rest are checked locally."""
+
+        if not text or '"' in text:
+            raise QueryError("search() needs some text without double quotes")
+        return self._with(_search=text)
+
+    def where(self, test, properties = (), description = None):
+        """A predicate Graph can't evaluate: test receives each raw Graph message and
+        is always evaluated locally. properties are the Graph properties it reads,
+        which are selected even if they aren't among the fields."""
+
+        return self._add(description or getattr(test, '__name__', repr(test)), None, None,
+                         False, tuple(properties), test)
+
+    def order_by(self, field, descending = False):
+        """Sorts by received, sent or subject; called again, sorts by a further field."""
+
+        if field not in _ORDER_FIELDS:
+            raise QueryError(f"Can't order by {field!r}, only by {_ORDER_FIELDS}")
+        if any(existing == field for existing, _ in self._order):
+            raise QueryError(f"Already ordered by {field!r}")
+        return self._with(_order=self._order + ((field, descending),))
+
+    def limit(self, count):
+        """Returns at most count messages."""
+
+        if count <= 0:
+            raise QueryError(f"Limit must be positive, not {count}")
+        return self._with(_limit=count)
+
+    def page_size(self, size):
+        """Messages per response ($top); by default the limit, up to Graph's maximum."""
+
+        if not 0 < size <= _MAX_TOP:
+            raise QueryError(f"Page size must be between 1 and {_MAX_TOP}, not {size}")
+        return self._with(_page_size=size)
+
+    def compile(self):
+        """Returns the CompiledQuery. Raises a QueryError for combinations Graph
+        would reject."""
+
+        if self._search is not None:
+            params, client = self._compile_search()
+        else:
+            params, client = self._compile_filter()
+
+        # Graph only returns what was selected (and id), so whatever the local
+        # predicates read has to be selected as well
+        properties = [ FIELDS[field] for field in self._fields ]
+        for predicate in client:
+            properties.extend(predicate.properties)
+        params['$select'] = ','.join(dict.fromkeys(properties))
+
+        top = self._page_size or (min(self._limit, _MAX_TOP) if self._limit else None)
+        if top:
+            params['$top'] = top
+
+        headers = {}
+        if 'body' in self._fields and self._body_type == 'text':
+            headers['Prefer'] = 'outlook.body-content-type="text"'
+
+        return CompiledQuery(params, headers, self._fields, self._limit,
+                             tuple(predicate.description for predicate in client),
+                             tuple(predicate.test for predicate in client))
+
+    def _compile_filter(self):
+        server = [ predicate for predicate in self._predicates if predicate.filter ]
+        client = [ predicate for predicate in self._predicates if not predicate.filter ]
+
+        params = {}
+        if server:
+            params['$filter'] = ' and '.join(self._ordered_filter(server))
+        if self._order:
+            params['$orderby'] = ','.join(
+                f"{FIELDS[field]} desc" if descending else FIELDS[field]
+                    for field, descending in self._order)
+        return params, client
+
+    def _ordered_filter(self, predicates):
+        """Graph rejects a $filter with an $orderby ('InefficientFilter') unless the
+        sorted properties come first in the filter, in the same order."""
+
+        clauses = []
+        rest = list(predicates)
+        for field, _ in self._order:
+            if field == 'subject':
+                raise QueryError("Graph can't order by subject when filtering; "
+                                 "sort the results locally instead")
+            property = FIELDS[field]
+            matching = [ predicate for predicate in rest if property in predicate.properties ]
+            if matching:
+                clauses.extend(predicate.filter for predicate in matching)
+                rest = [ predicate for predicate in rest if predicate not in matching ]
+            else:
+                # Matches everything, only there to satisfy the ordering rule
+                clauses.append(f"{property} ge {_EPOCH}")
+        clauses.extend(predicate.filter for predicate in rest)
+        return clauses
+
+    def _compile_search(self):
+        if self._order:
+            raise QueryError("Graph doesn't support $orderby with $search "
+                             "(search results come newest first)")
+
+        terms = [ f'({self._search})' ]
+        client = []
+        for predicate in self._predicates:
+            if predicate.search:
+                terms.append(f'({predicate.search})')
+            if not predicate.search or not predicate.search_exact:
+                client.append(predicate)
+        return { '$search' : f'"{" AND ".join(terms)}"' }, client
+
+    def _date_range(self, field, property, since, until):
+        since = _timestamp(since) if since is not None else None
+        until = _timestamp(until) if until is not None else None
+        if since is None and until is None:
+            raise QueryError(f"{field}() needs since, until or both")
+        if since is not None and until is not None and since >= until:
+            raise QueryError(f"Empty {field} range: {since} to {until}")
+
+        # The timestamps are all in one format, so they compare as strings
+        def test(message):
+            value = _normalized(message.get(property))
+            return value is not None and (since is None or value >= since) and \
+                                         (until is None or value < until)
+
+        clauses = []
+        terms = []
+        if since is not None:
+            clauses.append(f"{property} ge {since}")
+            terms.append(f"{field}>={since[:10]}")
+        if until is not None:
+            clauses.append(f"{property} lt {until}")
+            # KQL only has days, so the search covers the whole last day
+            terms.append(f"{field}<={until[:10]}")
+
+        description = f"{field} in [{since or '...'}, {until or '...'})"
+        return self._add(description, ' and '.join(clauses), ' AND '.join(terms), False,
+                         (property,), test)
+
+    def _read_state(self, is_read):
+        # Not one of the properties KQL can search
+        return self._add(f"is_read is {is_read}", f"isRead eq {str(is_read).lower()}", None,
+                         False, ('isRead',),
+                         lambda message: message.get('isRead') is is_read)
+
+    def _add(self, description, filter, search, search_exact, properties, test):
+        predicate = _Predicate(description, filter, search, search_exact, properties, test)
+        return self._with(_predicates=self._predicates + (predicate,))
+
+    def _with(self, **changes):
+        query = object.__new__(MessageQuery)
+        query.__dict__.update(self.__dict__, **changes)
+        return query
+
+    def __repr__(self):
+        return (f'MessageQuery(fields={self._fields}, '
+                f'predicates={[predicate.description for predicate in self._predicates]}, '
+                f'search={self._search!r}, order={self._order}, limit={self._limit})')
+
+def _value(message, field):
+    value = message.get(FIELDS[field])
+    if value is None:
+        return None
+    if field == 'sender':
+        return (value.get('emailAddress') or {}).get('address')
+    if field == 'to':
+        return [ (recipient.get('emailAddress') or {}).get('address') for recipient in value ]
+    if field == 'body':
+        return value.get('content')
+    return value
+
+def _timestamp(value):
+    """UTC timestamp in the format of Graph's dateTimes (and of the filters)."""
+
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            raise QueryError(f"Not an ISO 8601 date: {value!r}")
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if not isinstance(value, datetime):
+        raise QueryError(f"Expected a datetime, date or ISO 8601 string, not {value!r}")
+    # astimezone() takes naive datetimes as local time
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _normalized(value):
+    # Graph sends the same format, but may add fractional seconds
+    if not value:
+        return None
+    return value[:19] + 'Z' if len(value) > 20 else value
+
+def _literal(text):
+    # OData strings are single quoted, with quotes doubled
+    return "'" + text.replace("'", "''") + "'"
+
+def _kql(text):
+    if '"' in text:
+        raise QueryError(f"Can't search for {text!r}: double quotes aren't supported")
+    return text
@@ -0,0 +1,202 @@
+import sqlite3, threading
+
+# Optional local message store backed by the built-in sqlite3 module. Messages fetched
+# from Microsoft Graph can be written through to it, so repeat queries (a subject search,
+# a date window, a full text search of the bodies) are answered locally instead of
+# making another round trip to Graph.
+# Messages are keyed by their Graph id, so storing the same message twice updates it.
+__all__ = ['MessageStore']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id        TEXT NOT NULL UNIQUE,
+    folder    TEXT,
+    received  TEXT,
+    sender    TEXT,
+    subject   TEXT,
+    body_type TEXT,
+    body      TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_folder   ON messages (folder, received);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (received);
+CREATE INDEX IF NOT EXISTS messages_subject  ON messages (subject COLLATE NOCASE);
+'''
+
+# The full text index shares rowids with the messages table (external content),
+# and is kept in sync by triggers so it never has to be maintained by hand
+_FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    body, content='messages', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body) VALUES (new.rowid, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body) VALUES ('delete', old.rowid, old.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF body ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body) VALUES ('delete', old.rowid, old.body);
+    INSERT INTO messages_fts (rowid, body) VALUES (new.rowid, new.body);
+END;
+'''
+
+_UPSERT = '''
+INSERT INTO messages (id, folder, received, sender, subject, body_type, body)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    folder    = COALESCE(excluded.folder, folder),
+    received  = COALESCE(excluded.received, received),
+    sender    = COALESCE(excluded.sender, sender),
+    subject   = COALESCE(excluded.subject, subject),
+    body_type = COALESCE(excluded.body_type, body_type),
+    body      = COALESCE(excluded.body, body)
+'''
+
+_COLUMNS = ('id', 'folder', 'received', 'sender', 'subject', 'body_type', 'body')
+
+class MessageStore:
+    '''Local SQLite store of Graph messages with indexes on folder, receivedDateTime
+    and subject, and a full text index on the body if SQLite was built with FTS5.
+    The store can be shared between threads; access is serialised by a lock.'''
+
+    def __init__(self, path = 'messages.db', batch_size = 1000):
+        self.path = path
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+        try:
+            self._conn.executescript(_FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5; body searches fall back to LIKE
+            self.has_fts = False
+
+    def add_messages(self, messages, folder = None):
+        """Inserts or updates Graph message dicts, batch_size rows per transaction.
+        Returns the number of messages stored."""
+
+        count = 0
+        batch = []
+        for message in messages:
+            batch.append(_to_row(message, folder))
+            if len(batch) >= self.batch_size:
+                count += self._write(batch)
+                batch = []
+        if batch:
+            count += self._write(batch)
+        return count
+
+    def remove_messages(self, ids):
+        """Deletes the messages with the given Graph ids."""
+
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM messages WHERE id = ?',
+                                   ((id,) for id in ids))
+
+    def retain_messages(self, folder, ids):
+        """Deletes the folder's messages whose Graph ids aren't in ids, e.g. after a
+        full resync of the folder. Returns the number of messages deleted."""
+
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS retained (id TEXT PRIMARY KEY)')
+            self._conn.execute('DELETE FROM retained')
+            self._conn.executemany('INSERT OR IGNORE INTO retained (id) VALUES (?)',
+                                   ((id,) for id in ids))
+            cursor = self._conn.execute(
+                'DELETE FROM messages WHERE folder = ? AND id NOT IN (SELECT id FROM retained)',
+                (folder,))
+            self._conn.execute('DELETE FROM retained')
+            return cursor.rowcount
+
+    def get(self, id):
+        """Returns a single message by Graph id, or None."""
+
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT {", ".join(_COLUMNS)} FROM messages WHERE id = ?', (id,)).fetchone()
+        return dict(zip(_COLUMNS, row)) if row else None
+
+    def iter_messages(self, folder = None, since = None, until = None,
+                      subject = None, search = None, limit = None, fetch_size = 500):
+        """Streams the stored messages matching every given filter, newest first.
+        since / until are ISO 8601 strings compared against receivedDateTime,
+        subject is a case-insensitive substring and search a full text query on
+        the body. Rows are fetched fetch_size at a time, so memory stays flat."""
+
+        where = []
+        args = []
+        if folder is not None:
+            where.append('m.folder = ?')
+            args.append(folder)
+        if since is not None:
+            where.append('m.received >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('m.received < ?')
+            args.append(until)
+        if subject is not None:
+            where.append('m.subject LIKE ? COLLATE NOCASE')
+            args.append(f'%{subject}%')
+        if search is not None:
+            if self.has_fts:
+                where.append('m.rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)')
+                args.append(search)
+            else:
+                where.append('m.body LIKE ?')
+                args.append(f'%{search}%')
+
+        sql = f'SELECT {", ".join("m." + column for column in _COLUMNS)} FROM messages m'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY m.received DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+
+        # Each chunk is read under the lock, so writers can interleave between chunks
+        with self._lock:
+            cursor = self._conn.execute(sql, args)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(zip(_COLUMNS, row))
+        finally:
+            cursor.close()
+
+    def count(self, folder = None):
+        with self._lock:
+            if folder is None:
+                return self._conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM messages WHERE folder = ?', (folder,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(_UPSERT, rows)
+        return len(rows)
+
+def _to_row(message, folder):
+    """Flattens a Graph message dict into a messages table row."""
+
+    sender = (message.get('from') or {}).get('emailAddress') or {}
+    body = message.get('body') or {}
+    return ( message['id'],
+             folder,
+             message.get('receivedDateTime'),
+             sender.get('address'),
+             message.get('subject'),
+             body.get('contentType'),
+             body.get('content') )
@@ -0,0 +1,799 @@
+import json, gzip, random, re, threading, time, base64, urllib.parse, urllib.request, urllib.error
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-ins for login.microsoftonline.com and graph.microsoft.com, used by
+# benchmark.py to measure this project without touching the live services.
+# Both run on plain http on 127.0.0.1 with a random free port and count every
+# request they receive, so scenarios can report how many round trips they made.
+__all__ = ['MockGraphServer', 'MockAuthorityServer', 'AuthorityHttpClient']
+
+AUTHORITY_HOST = 'https://login.microsoftonline.com'
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Scenarios open many connections at once (concurrent fetches, parallel workers)
+    request_queue_size = 128
+
+class _MockServer:
+    '''Shared start / stop and request counting for the mock servers.'''
+
+    handler = None
+
+    def __init__(self, latency = 0.0):
+        self.latency = latency
+        self.counts = {}
+        # Bytes of response bodies sent, as they went over the wire (compressed or not)
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        handler = type('Handler', (self.handler,), { 'mock' : self })
+        self._server = _Server(('127.0.0.1', 0), handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, endpoint):
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def reset_counts(self):
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, Nagle plus delayed ACKs
+    # add ~40ms to every kept-alive response and swamp whatever is being measured
+    disable_nagle_algorithm = True
+    mock = None
+
+    def send_json(self, status, data, headers = None):
+        body = json.dumps(data).encode()
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body, compresslevel=1)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.mock._lock:
+            self.mock.bytes_sent += len(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def log_message(self, format, *args):
+        return
+
+class _GraphHandler(_Handler):
+
+    def do_GET(self):
+        self._handle('GET', self.path, None)
+
+    def do_POST(self):
+        self._handle('POST', self.path, self.read_body())
+
+    def do_PATCH(self):
+        self._handle('PATCH', self.path, self.read_body())
+
+    def do_DELETE(self):
+        self._handle('DELETE', self.path, None)
+
+    def _handle(self, method, path, body):
+        mock = self.mock
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        route = urllib.parse.urlsplit(path).path
+        if method == 'POST' and route == '/v1.0/$batch':
+            mock.count('batch')
+            return self._batch(json.loads(body))
+        if method == 'GET' and route.endswith('/$value'):
+            mock.count('attachment.$value')
+            return self._attachment_value(route)
+        if route.startswith('/v1.0/subscriptions'):
+            mock.count(f'subscriptions.{method}')
+            status, data = mock.subscriptions_request(method, route, body)
+            if data is None:
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.send_json(status, data)
+
+        status, data, headers = mock.route(path, prefer=self.headers.get('Prefer'))
+        self.send_json(status, data, headers)
+
+    def _attachment_value(self, route):
+        """Streams an attachment's content, honouring a 'Range: bytes=<start>-' header."""
+
+        mock = self.mock
+        segments = [ urllib.parse.unquote(segment) for segment in route.split('/') if segment ]
+        j = mock._attachment_index(segments[3], segments[5]) if len(segments) == 7 else None
+        if j is None:
+            return self.send_json(404, _error('ErrorItemNotFound'))
+
+        size = mock.attachment_size
+        start = 0
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        self.send_response(206 if match else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if match:
+            self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        # The first download of each attachment breaks off after drop_after bytes
+        end = size
+        if mock.drop_after is not None and mock._first_download(route):
+            end = min(size, start + mock.drop_after)
+
+        position = start
+        while position < end:
+            chunk = mock.attachment_chunk(position, end)
+            self.wfile.write(chunk)
+            position += len(chunk)
+
+        if end < size:
+            self.close_connection = True
+
+    def _batch(self, payload):
+        responses = []
+        for request in payload.get('requests', []):
+            status, data, headers = self.mock.route('/v1.0' + request['url'], batched=True)
+            responses.append({ 'id' : request['id'], 'status' : status,
+                               'headers' : headers, 'body' : data })
+        self.send_json(200, { 'responses' : responses })
+
+class MockGraphServer(_MockServer):
+    '''Stand-in for the Graph mail endpoints used by MS_Graph_Mail: mailFolders,
+    childFolders, single folders, messages (paged with @odata.nextLink), single
+    messages, $batch, subscriptions (see notify() for sending notifications) and
+    delta queries of a folder's messages (see change_messages() and
+    expire_delta_links()).
+
+    The folder tree has `breadth` top level folders (the first one is Inbox), each
+    with `breadth` children, `depth` levels deep. Every folder holds
+    `messages_per_folder` generated messages with bodies of `body_size` characters.
+    With `error_rate` > 0 that fraction of requests (and batch sub-requests) is
+    answered with a 429 carrying Retry-After: `retry_after`.
+
+    Every message has `attachments_per_message` file attachments of `attachment_size`
+    bytes. With drop_after set, the first download of each attachment's $value is cut
+    off after that many bytes, like a dropped connection.'''
+
+    handler = _GraphHandler
+
+    def __init__(self, depth = 3, breadth = 3, messages_per_folder = 100, body_size = 2000,
+                 default_page_size = 10, max_page_size = 1000, latency = 0.0,
+                 error_rate = 0.0, retry_after = 0, attachments_per_message = 0,
+                 attachment_size = 0, drop_after = None, seed = 0):
+        super().__init__(latency)
+        self.messages_per_folder = messages_per_folder
+        self.body_size = body_size
+        self.default_page_size = default_page_size
+        self.max_page_size = max_page_size
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.attachments_per_message = attachments_per_message
+        self.attachment_size = attachment_size
+        self.drop_after = drop_after
+        self._random = random.Random(seed)
+        # Attachment contents repeat this block; random so it doesn't compress
+        self._attachment_block = random.Random(seed).randbytes(64 * 1024)
+        self._downloaded = set()
+        self.subscriptions = {}
+        self._subscription_count = 0
+        # Messages added by notify() / change_messages(): folder id : message count
+        self._new_messages = {}
+        # Delta state: every change is logged as (sequence, folder id, index) and a delta
+        # link carries the sequence it was handed out at, after the generation of the
+        # sync state (expire_delta_links() starts a new one)
+        self._changes = []
+        self._removed = {}
+        self._edits = {}
+        self._delta_generation = 0
+
+        self.folders = {}
+        self.children = { None : [] }
+        self.paths = []
+        self._build_tree(None, '', depth, breadth)
+
+    def _build_tree(self, parent_id, parent_path, depth, breadth):
+        if depth == 0:
+            return
+        for i in range(breadth):
+            name = 'Inbox' if parent_id is None and i == 0 else f'Folder{depth}_{i}'
+            path = f'{parent_path}/{name}' if parent_path else name
+            folder_id = 'id-' + path.replace('/', '-').lower()
+            self.folders[folder_id] = {
+                'id'               : folder_id,
+                'displayName'      : name,
+                'parentFolderId'   : parent_id or 'root',
+                'childFolderCount' : breadth if depth > 1 else 0 }
+            self.children[parent_id].append(folder_id)
+            self.children[folder_id] = []
+            self.paths.append(path)
+            self._build_tree(folder_id, path, depth - 1, breadth)
+
+    def folder_paths(self, count = None, min_depth = 1):
+        """Returns ';' joinable folder paths of at least min_depth segments."""
+
+        paths = [ path for path in self.paths if path.count('/') + 1 >= min_depth ]
+        return paths[:count] if count else paths
+
+    def route(self, path, batched = False, prefer = None):
+        """Answers a Graph GET. Returns (status, body, headers). Sub-requests of a
+        $batch are counted separately, as they are not round trips of their own.
+        prefer is the Prefer header; outlook.body-content-type="text" is honoured."""
+
+        parts = urllib.parse.urlsplit(path)
+        query = { key : values[0] for key, values in urllib.parse.parse_qs(parts.query).items() }
+        segments = [ urllib.parse.unquote(segment) for segment in parts.path.split('/') if segment ]
+
+        # ['v1.0', 'me', 'messages', id, 'attachments'?, id?]
+        if segments[:3] == ['v1.0', 'me', 'messages'] and 4 <= len(segments) <= 6:
+            endpoint = 'message' if len(segments) == 4 else (
+                       'attachments' if len(segments) == 5 else 'attachment')
+            self.count(f'batched.{endpoint}' if batched else endpoint)
+
+            folder_id, _, i = segments[3].rpartition('-m')
+            if folder_id not in self.folders or not i.isdigit():
+                return 404, _error('ErrorItemNotFound'), {}
+            select = query.get('$select')
+            fields = set(select.split(',')) if select else None
+
+            if endpoint == 'message':
+                return 200, self._message(folder_id, int(i), fields), {}
+            if endpoint == 'attachments':
+                items = [ self._attachment(segments[3], j, fields)
+                            for j in range(self.attachments_per_message) ]
+                return 200, self._page(parts.path, query, items, len(items)), {}
+            j = self._attachment_index(segments[3], segments[5])
+            if j is None:
+                return 404, _error('ErrorItemNotFound'), {}
+            return 200, self._attachment(segments[3], j, fields), {}
+
+        # ['v1.0', 'me', 'mailFolders', id?, 'childFolders' | 'messages'?]
+        if segments[:3] != ['v1.0', 'me', 'mailFolders']:
+            self.count('unknown')
+            return 404, _error('ResourceNotFound'), {}
+
+        endpoint = 'mailFolders' if len(segments) == 3 else (
+                   'folder' if len(segments) == 4 else '/'.join(segments[4:]))
+        self.count(f'batched.{endpoint}' if batched else endpoint)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.count('throttled')
+            return 429, _error('TooManyRequests'), { 'Retry-After' : self.retry_after }
+
+        folder_id = segments[3] if len(segments) > 3 else None
+        if folder_id is not None and folder_id.lower() == 'inbox':
+            # Well-known folder name, as used by MS_Graph_Mail for plain 'inbox'
+            folder_id = self.children[None][0]
+        if folder_id is not None and folder_id not in self.folders:
+            return 404, _error('ErrorItemNotFound'), {}
+
+        if endpoint == 'folder':
+            return 200, self.folders[folder_id], {}
+
+        if endpoint in ('mailFolders', 'childFolders'):
+            items = [ self.folders[child] for child in self.children[folder_id] ]
+            return 200, self._page(parts.path, query, items, len(items)), {}
+
+        if endpoint == 'messages/delta':
+            select = query.get('$select')
+            fields = set(select.split(',')) if select else None
+            status, page = self._delta(parts.path, folder_id, query, fields, prefer)
+            return status, page, {}
+
+        if endpoint == 'messages':
+            select = query.get('$select')
+            fields = set(select.split(',')) if select else None
+            text = 'outlook.body-content-type="text"' in (prefer or '')
+            indices = self._matching(folder_id, query)
+            if indices is None:
+                return 400, _error('BadRequest'), {}
+            page = self._page(parts.path, query, None, len(indices),
+                              lambda i: self._message(folder_id, indices[i], fields, text))
+            return 200, page, {}
+
+        return 404, _error('ResourceNotFound'), {}
+
+    def subscriptions_request(self, method, path, body):
+        """POST / PATCH / DELETE on /subscriptions. Creating one first validates the
+        notification URL like Graph does: it has to echo a validationToken."""
+
+        segments = [ segment for segment in path.split('/') if segment ]
+        payload = json.loads(body) if body else {}
+
+        if method == 'POST' and len(segments) == 2:
+            token = f'validation-{random.random()}'
+            url = f"{payload['notificationUrl']}?{urllib.parse.urlencode({ 'validationToken' : token })}"
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, data=b'', method='POST'),
+                                            timeout=10) as response:
+                    echoed = response.read().decode()
+            except OSError:
+                echoed = None
+            if echoed != token:
+                return 400, _error('ValidationError')
+
+            with self._lock:
+                self._subscription_count += 1
+                subscription = dict(payload, id=f'subscription-{self._subscription_count}')
+                self.subscriptions[subscription['id']] = subscription
+            return 201, subscription
+
+        subscription = self.subscriptions.get(segments[2]) if len(segments) == 3 else None
+        if subscription is None:
+            return 404, _error('ResourceNotFound')
+        if method == 'PATCH':
+            subscription['expirationDateTime'] = payload['expirationDateTime']
+            return 200, subscription
+        if method == 'DELETE':
+            self.subscriptions.pop(subscription['id'], None)
+            return 204, None
+        return 405, _error('MethodNotAllowed')
+
+    def notify(self, count = 1, client_state = None, lifecycle_event = None):
+        """Fake notification sender: delivers `count` new messages in each subscribed
+        folder to its subscription, like Graph does when mail arrives. client_state
+        overrides the subscription's (to test forged notifications); with a
+        lifecycle_event a lifecycle notification is sent instead. Returns the ids of
+        the new messages."""
+
+        message_ids = []
+        for subscription in list(self.subscriptions.values()):
+            folder_id = subscription['resource'].split("'")[1]
+            if folder_id.lower() == 'inbox':
+                folder_id = self.children[None][0]
+
+            items = []
+            for _ in range(1 if lifecycle_event else count):
+                item = { 'subscriptionId' : subscription['id'],
+                         'clientState' : client_state or subscription['clientState'],
+                         'subscriptionExpirationDateTime' : subscription['expirationDateTime'],
+                         'tenantId' : 'benchmark-tenant' }
+                if lifecycle_event:
+                    item['lifecycleEvent'] = lifecycle_event
+                else:
+                    i = self._add_message(folder_id)
+                    message_id = f'{folder_id}-m{i}'
+                    message_ids.append(message_id)
+                    item.update(changeType='created', resource=f'Users/me/Messages/{message_id}',
+                                resourceData={ '@odata.type' : '#Microsoft.Graph.Message',
+                                               'id' : message_id })
+                items.append(item)
+
+            request = urllib.request.Request(subscription['notificationUrl'],
+                                             data=json.dumps({ 'value' : items }).encode(),
+                                             headers={ 'Content-Type' : 'application/json' })
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+        return message_ids
+
+    def change_messages(self, folder_id, added = 0, changed = (), removed = ()):
+        """Adds `added` messages to the folder, edits the subjects of the messages with
+        the indices in changed and deletes the ones in removed, for delta queries to
+        pick up. Returns the ids of the added messages."""
+
+        added_ids = [ f'{folder_id}-m{self._add_message(folder_id)}' for _ in range(added) ]
+        with self._lock:
+            for i in changed:
+                self._edits[(folder_id, i)] = self._edits.get((folder_id, i), 0) + 1
+                self._changes.append((len(self._changes) + 1, folder_id, i))
+            for i in removed:
+                self._removed.setdefault(folder_id, set()).add(i)
+                self._changes.append((len(self._changes) + 1, folder_id, i))
+        return added_ids
+
+    def expire_delta_links(self):
+        """Answers every delta link handed out so far with 410 Gone, like Graph does
+        once the sync state behind a link expired."""
+
+        with self._lock:
+            self._delta_generation += 1
+
+    def _add_message(self, folder_id):
+        with self._lock:
+            i = self._new_messages.get(folder_id, self.messages_per_folder)
+            self._new_messages[folder_id] = i + 1
+            self._changes.append((len(self._changes) + 1, folder_id, i))
+        return i
+
+    def _live_indices(self, folder_id):
+        total = self._new_messages.get(folder_id, self.messages_per_folder)
+        removed = self._removed.get(folder_id)
+        if not removed:
+            return range(total)
+        return [ i for i in range(total) if i not in removed ]
+
+    def _delta(self, path, folder_id, query, fields, prefer):
+        """A page of a delta query: every message without a $deltatoken, otherwise
+        the ones added, changed or removed since the token was handed out."""
+
+        match = re.search(r'odata\.maxpagesize=(\d+)', prefer or '')
+        if match and '$top' not in query:
+            query = dict(query, **{ '$top' : match.group(1) })
+
+        token = query.get('$deltatoken')
+        with self._lock:
+            generation = self._delta_generation
+            sequence = len(self._changes)
+            if token is not None:
+                token_generation, token = map(int, token.split('-'))
+                if token_generation != generation:
+                    return 410, _error('SyncStateNotFound')
+                changed = dict.fromkeys(i for seq, folder, i in self._changes
+                                            if seq > token and folder == folder_id)
+            removed = set(self._removed.get(folder_id, ()))
+
+        if token is None:
+            indices = self._live_indices(folder_id)
+            page = self._page(path, query, None, len(indices),
+                              lambda i: self._message(folder_id, indices[i], fields))
+        else:
+            page = { 'value' : [ _removed(f'{folder_id}-m{i}') if i in removed
+                                    else self._message(folder_id, i, fields)
+                                        for i in changed ] }
+
+        if '@odata.nextLink' not in page:
+            link = { '$deltatoken' : f'{generation}-{sequence}' }
+            if '$select' in query:
+                link['$select'] = query['$select']
+            page['@odata.deltaLink'] = f'{self.url}{path}?{urllib.parse.urlencode(link)}'
+        return 200, page
+
+    def attachment_chunk(self, start, end):
+        """Up to 64 KB of attachment content from offset start (before end)."""
+
+        block = self._attachment_block
+        offset = start % len(block)
+        return block[offset:offset + min(end - start, len(block) - offset)]
+
+    def _attachment(self, message_id, j, fields):
+        attachment = {
+            '@odata.type'          : '#microsoft.graph.fileAttachment',
+            'id'                   : f'{message_id}-a{j}',
+            'name'                 : f'report{j}.bin',
+            'contentType'          : 'application/octet-stream',
+            'size'                 : self.attachment_size,
+            'isInline'             : False,
+            'lastModifiedDateTime' : '2024-01-01T00:00:00Z' }
+        if fields:
+            return { key : value for key, value in attachment.items()
+                        if key in ('@odata.type', 'id') or key in fields }
+
+        # Like Graph: without $select the content comes along, base64 encoded
+        content = b''.join(self.attachment_chunk(position, self.attachment_size)
+                            for position in range(0, self.attachment_size,
+                                                  len(self._attachment_block)))
+        attachment['contentBytes'] = base64.b64encode(content).decode()
+        return attachment
+
+    def _attachment_index(self, message_id, attachment_id):
+        prefix, _, j = attachment_id.rpartition('-a')
+        if prefix != message_id or not j.isdigit() or int(j) >= self.attachments_per_message:
+            return None
+        return int(j)
+
+    def _first_download(self, route):
+        with self._lock:
+            first = route not in self._downloaded
+            self._downloaded.add(route)
+        return first
+
+    def _page(self, path, query, items, total, make = None):
+        top = min(int(query.get('$top', self.default_page_size)), self.max_page_size)
+        skip = int(query.get('$skip', 0))
+        end = min(skip + top, total)
+
+        value = items[skip:end] if items is not None else [ make(i) for i in range(skip, end) ]
+        page = { 'value' : value }
+        if end < total:
+            query = dict(query, **{ '$skip' : end, '$top' : top })
+            page['@odata.nextLink'] = f'{self.url}{path}?{urllib.parse.urlencode(query)}'
+        return page
+
+    def _message(self, folder_id, i, fields, text = False):
+        edits = self._edits.get((folder_id, i))
+        message = {
+            'id'               : f'{folder_id}-m{i}',
+            'subject'          : f'Message {i} in {folder_id}' + (f' ({edits})' if edits else ''),
+            'receivedDateTime' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1.7e9 + i * 60)),
+            'from'             : { 'emailAddress' : { 'name' : 'Logger',
+                                                      'address' : _sender(i) } } }
+        if not fields or 'body' in fields:
+            body = _body(i, self.body_size)
+            message['body'] = { 'contentType' : 'text' if text else 'html',
+                                'content' : _TAGS.sub('', body) if text else body }
+        if fields:
+            message = { key : value for key, value in message.items()
+                            if key == 'id' or key in fields }
+            # Only when selected, so scenarios without $select keep their payload
+            for key, value in (('isRead', i % 4 != 0),
+                               ('hasAttachments', self.attachments_per_message > 0),
+                               ('bodyPreview', _TAGS.sub('', _body(i, 255)))):
+                if key in fields:
+                    message[key] = value
+        return message
+
+    def _matching(self, folder_id, query):
+        """Indices of the folder's messages passing $filter, in $orderby order.
+        Understands the filters mail_query.py writes; None for anything else."""
+
+        indices = self._live_indices(folder_id)
+        expression = query.get('$filter')
+        if expression:
+            clauses = [ _clause(clause) for clause in expression.split(' and ') ]
+            if None in clauses:
+                return None
+            indices = [ i for i in indices
+                            if all(test(self._message(folder_id, i, _FILTERABLE))
+                                       for test in clauses) ]
+
+        order = query.get('$orderby', '')
+        if order.startswith('receivedDateTime desc'):
+            indices = indices[::-1]
+        return indices
+
+class _AuthorityHandler(_Handler):
+
+    def do_GET(self):
+        mock = self.mock
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        path = urllib.parse.urlsplit(self.path).path
+        if path.endswith('/discovery/instance'):
+            mock.count('discovery')
+            return self.send_json(200, mock.instance_discovery())
+        if path.endswith('/.well-known/openid-configuration'):
+            mock.count('openid-configuration')
+            return self.send_json(200, mock.openid_configuration(path.split('/')[1]))
+
+        mock.count('unknown')
+        self.send_json(404, _error('not_found'))
+
+    def do_POST(self):
+        mock = self.mock
+        body = urllib.parse.parse_qs(self.read_body().decode())
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        path = urllib.parse.urlsplit(self.path).path
+        if path.endswith('/oauth2/v2.0/devicecode'):
+            mock.count('devicecode')
+            return self.send_json(200, mock.device_code())
+        if not path.endswith('/oauth2/v2.0/token'):
+            mock.count('unknown')
+            return self.send_json(404, _error('not_found'))
+
+        mock.count('token')
+        grant_type = body.get('grant_type', [None])[0]
+        if grant_type == 'refresh_token' and mock.reject_refresh:
+            return self.send_json(400, { 'error' : 'invalid_grant',
+                                         'error_description' : 'Refresh token expired' })
+        if grant_type == 'urn:ietf:params:oauth:grant-type:device_code':
+            signed_in = mock.device_signed_in(body.get('device_code', [''])[0])
+            if signed_in is None:
+                return self.send_json(400, { 'error' : 'expired_token',
+                                             'error_description' : 'Unknown device code' })
+            if not signed_in:
+                return self.send_json(400, { 'error' : 'authorization_pending',
+                                             'error_description' : 'User has not signed in yet' })
+        self.send_json(200, mock.token())
+
+class MockAuthorityServer(_MockServer):
+    '''Stand-in for the login.microsoftonline.com endpoints MSAL uses: instance
+    discovery, OpenID configuration and the token endpoint. Every token request
+    succeeds with a new access token valid for `token_lifetime` seconds, unless
+    reject_refresh is set, which fails refresh token grants. A device code is
+    signed in after it has been polled `device_polls` times.'''
+
+    handler = _AuthorityHandler
+
+    def __init__(self, token_lifetime = 3600, latency = 0.0, reject_refresh = False,
+                 device_polls = 2):
+        super().__init__(latency)
+        self.token_lifetime = token_lifetime
+        self.reject_refresh = reject_refresh
+        self.device_polls = device_polls
+        self._issued = 0
+        self._device_codes = {}
+
+    def instance_discovery(self):
+        return {
+            'tenant_discovery_endpoint' :
+                f'{AUTHORITY_HOST}/common/v2.0/.well-known/openid-configuration',
+            'api-version' : '1.1',
+            'metadata' : [ { 'preferred_network' : 'login.microsoftonline.com',
+                             'preferred_cache'   : 'login.windows.net',
+                             'aliases' : [ 'login.microsoftonline.com', 'login.windows.net' ] } ] }
+
+    def openid_configuration(self, tenant):
+        base = f'{AUTHORITY_HOST}/{tenant}'
+        return {
+            'authorization_endpoint' : f'{base}/oauth2/v2.0/authorize',
+            'token_endpoint'         : f'{base}/oauth2/v2.0/token',
+            'device_authorization_endpoint' : f'{base}/oauth2/v2.0/devicecode',
+            'issuer'                 : f'{base}/v2.0' }
+
+    def device_code(self):
+        with self._lock:
+            device_code = f'mock-device-code-{len(self._device_codes) + 1}'
+            self._device_codes[device_code] = 0
+        # interval 0: MSAL polls again right away instead of sleeping seconds
+        return { 'device_code' : device_code, 'user_code' : 'MOCK-CODE',
+                 'verification_uri' : 'https://microsoft.com/devicelogin',
+                 'expires_in' : 900, 'interval' : 0,
+                 'message' : 'To sign in, enter MOCK-CODE at https://microsoft.com/devicelogin' }
+
+    def device_signed_in(self, device_code):
+        """None for an unknown device code, else whether the user signed in."""
+
+        with self._lock:
+            if device_code not in self._device_codes:
+                return None
+            self._device_codes[device_code] += 1
+            return self._device_codes[device_code] > self.device_polls
+
+    def token(self):
+        with self._lock:
+            self._issued += 1
+            issued = self._issued
+        client_info = base64.urlsafe_b64encode(
+            json.dumps({ 'uid' : 'benchmark-user', 'utid' : 'benchmark-tenant' }).encode())
+        return {
+            'token_type'    : 'Bearer',
+            'scope'         : 'User.Read Mail.Read',
+            'expires_in'    : self.token_lifetime,
+            'access_token'  : f'mock-access-token-{issued}',
+            'refresh_token' : f'mock-refresh-token-{issued}',
+            'client_info'   : client_info.decode().rstrip('=') }
+
+class _HttpResponse:
+    '''The parts of a requests.Response that MSAL reads.'''
+
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f'HTTP {self.status_code}: {self.text}')
+
+class AuthorityHttpClient:
+    '''Minimal stdlib http_client for msal.PublicClientApplication that sends every
+    login.microsoftonline.com request to a MockAuthorityServer instead.'''
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def get(self, url, params = None, headers = None, **kwargs):
+        return self._send('GET', url, params, None, headers)
+
+    def post(self, url, params = None, data = None, headers = None, **kwargs):
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(data)
+        if isinstance(data, str):
+            data = data.encode()
+        return self._send('POST', url, params, data, headers)
+
+    def close(self):
+        return
+
+    def _send(self, method, url, params, data, headers):
+        if url.startswith(AUTHORITY_HOST):
+            url = self.base_url + url[len(AUTHORITY_HOST):]
+        if params:
+            url = f'{url}{"&" if "?" in url else "?"}{urllib.parse.urlencode(params)}'
+
+        request = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return _HttpResponse(response.status, response.read().decode(),
+                                     dict(response.headers))
+        except urllib.error.HTTPError as e:
+            return _HttpResponse(e.code, e.read().decode(), dict(e.headers))
+
+_TAGS = re.compile(r'<[^>]+>')
+
+# Properties a $filter can test
+_FILTERABLE = { 'receivedDateTime', 'from', 'subject', 'isRead', 'hasAttachments' }
+
+_SENDERS = ('logger@example.com', 'alerts@example.com', 'reports@example.org')
+
+def _sender(i):
+    return _SENDERS[i % 7 % len(_SENDERS)]
+
+_COMPARISONS = {
+    'eq' : lambda a, b: a == b, 'ne' : lambda a, b: a != b,
+    'ge' : lambda a, b: a >= b, 'gt' : lambda a, b: a > b,
+    'le' : lambda a, b: a <= b, 'lt' : lambda a, b: a < b }
+
+_PATHS = { 'receivedDateTime' : lambda m: m['receivedDateTime'],
+           'from/emailAddress/address' : lambda m: m['from']['emailAddress']['address'],
+           'isRead' : lambda m: m['isRead'], 'hasAttachments' : lambda m: m['hasAttachments'] }
+
+def _clause(clause):
+    """Test for one clause of a $filter: a comparison, contains(subject,...) or
+    comparisons joined by 'or' in parentheses. None if it isn't understood."""
+
+    if clause.startswith('(') and clause.endswith(')'):
+        tests = [ _clause(part) for part in clause[1:-1].split(' or ') ]
+        return None if None in tests else lambda m: any(test(m) for test in tests)
+
+    match = re.fullmatch(r"contains\(subject,'((?:[^']|'')*)'\)", clause)
+    if match:
+        needle = match.group(1).replace("''", "'").lower()
+        return lambda m: needle in m['subject'].lower()
+
+    match = re.fullmatch(r"(\S+) (eq|ne|ge|gt|le|lt) (.+)", clause)
+    if not match or match.group(1) not in _PATHS:
+        return None
+    path, compare, literal = _PATHS[match.group(1)], _COMPARISONS[match.group(2)], match.group(3)
+    if literal in ('true', 'false'):
+        value = literal == 'true'
+    elif literal.startswith("'") and literal.endswith("'"):
+        value = literal[1:-1].replace("''", "'")
+    else:
+        value = literal
+    return lambda m: compare(path(m), value)
+
+def _removed(message_id):
+    return { 'id' : message_id, '@removed' : { 'reason' : 'deleted' } }
+
+def _error(code):
+    return { 'error' : { 'code' : code, 'message' : code } }
+
+_WORDS = ('device', 'logger', 'status', 'report', 'normal', 'test', 'error', 'event')
+
+def _body(seed, size):
+    words = []
+    length = 0
+    i = seed
+    while length < size:
+        word = _WORDS[i % len(_WORDS)]
+        words.append(word)
+        length += len(word) + 1
+        # Only i % len(_WORDS) matters, and without the modulo i grows into a huge int
+        i = (i * 7 + 3) % len(_WORDS)
+    return '<html><body><p>' + ' '.join(words)[:size] + '</p></body></html>'
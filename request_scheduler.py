@@ -0,0 +1,244 @@
+import threading, random, http.client, time
+from email.utils import parsedate_to_datetime
+
+# Throttling aware request scheduling for Microsoft Graph. Graph answers 429 (and 503)
+# with a Retry-After header when a mailbox is hit too hard; ignoring it and retrying
+# straight away only makes the throttling last longer. Every request goes through:
+#   1. a token bucket per mailbox, so we stay under the service limit to begin with
+#   2. Retry-After, which pauses the whole mailbox's bucket, not just the one request
+#   3. exponential backoff with full jitter for other transient errors
+#   4. a retry budget, so retries can never be more than a fraction of the traffic
+__all__ = ['RequestScheduler', 'TokenBucket', 'RetryBudget']
+
+# Status codes worth retrying; anything else is returned to the caller as is
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Connection level errors worth retrying
+RETRY_ERRORS = (http.client.HTTPException, ConnectionError, TimeoutError)
+
+class TokenBucket:
+    '''Allows `rate` requests per second on average with bursts of up to `capacity`.'''
+
+    def __init__(self, rate, capacity, clock = time.monotonic, sleep = time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            self._sleep(wait)
+
+    async def acquire_async(self):
+        """acquire() for coroutines: waits without blocking the event loop."""
+
+        import asyncio
+
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def _take(self):
+        """Takes a token if there is one. Returns 0 if it did, otherwise how long
+        to wait before trying again."""
+
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        """Stops handing out tokens for the next `seconds` seconds (Retry-After)."""
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+class RetryBudget:
+    '''Each request deposits `ratio` of a retry and each retry withdraws a whole one,
+    so under a throttling storm retries stay at about `ratio` of the traffic instead of
+    multiplying it. `reserve` retries are always available for low traffic.'''
+
+    def __init__(self, ratio = 0.2, reserve = 10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self._balance + self.ratio, self.reserve * 10)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+class RequestScheduler:
+    '''Sends requests through a per mailbox rate limiter and retries throttled or
+    failed requests, honoring Retry-After. Safe to share between threads.'''
+
+    def __init__(self, rate = 16, burst = 16, max_retries = 5, base_delay = 0.5,
+                 max_delay = 60, budget = None, clock = time.monotonic, sleep = time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._counters = { 'requests' : 0, 'retries' : 0, 'throttled' : 0, 'budget_exhausted' : 0 }
+
+    def execute(self, key, send):
+        """Calls send() (which returns a response with .status and .headers) once
+        the `key` mailbox has capacity, retrying retryable statuses and errors.
+        Returns the last response, or raises the last error once retries run out."""
+
+        bucket = self._bucket(key)
+        self.budget.deposit()
+        self._count('requests')
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = send()
+            except RETRY_ERRORS:
+                if not self.backoff(key, attempt):
+                    raise
+                attempt += 1
+                continue
+
+            if response.status not in RETRY_STATUSES:
+                return response
+
+            if not self.backoff(key, attempt, response.status,
+                                response.headers.get('Retry-After')):
+                return response
+            attempt += 1
+
+    async def execute_async(self, key, send):
+        """execute() for coroutines: send is a coroutine function, and waiting for
+        the rate limiter or a backoff doesn't block the event loop. Shares the
+        mailbox buckets with execute(), so sync and async callers are limited together."""
+
+        bucket = self._bucket(key)
+        self.budget.deposit()
+        self._count('requests')
+
+        attempt = 0
+        while True:
+            await bucket.acquire_async()
+            try:
+                response = await send()
+            except RETRY_ERRORS:
+                if not await self.backoff_async(key, attempt):
+                    raise
+                attempt += 1
+                continue
+
+            if response.status not in RETRY_STATUSES:
+                return response
+
+            if not await self.backoff_async(key, attempt, response.status,
+                                            response.headers.get('Retry-After')):
+                return response
+            attempt += 1
+
+    def backoff(self, key, attempt, status = None, retry_after = None):
+        """Waits before retry number `attempt` of a request to the `key` mailbox.
+        Returns False, without waiting, if the request should not be retried."""
+
+        delay = self._retry_delay(key, attempt, retry_after)
+        if delay is None:
+            return False
+        self._sleep(delay)
+        return True
+
+    async def backoff_async(self, key, attempt, status = None, retry_after = None):
+        import asyncio
+
+        delay = self._retry_delay(key, attempt, retry_after)
+        if delay is None:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    def _retry_delay(self, key, attempt, retry_after):
+        """Returns how long to wait before the retry, or None if there shouldn't be one."""
+
+        if attempt >= self.max_retries:
+            return None
+
+        if not self.budget.withdraw():
+            self._count('budget_exhausted')
+            return None
+
+        self._count('retries')
+        delay = parse_retry_after(retry_after)
+        if delay is not None:
+            # The whole mailbox is throttled, hold back every other request too
+            self._count('throttled')
+            self._bucket(key).pause(delay)
+        else:
+            # Full jitter: spreads retries of many clients evenly over the window
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return delay
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _bucket(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst,
+                                                          self._clock, self._sleep)
+        return bucket
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+def parse_retry_after(value):
+    """Returns the Retry-After header as seconds to wait, or None if missing.
+    It can either be a number of seconds or an HTTP date."""
+
+    if value is None:
+        return None
+
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
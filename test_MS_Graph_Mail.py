@@ -0,0 +1,142 @@
+import pytest
+import MS_Graph_Mail
+from MS_Graph_Mail import FolderIndex
+
+_FOLDERS = [
+    { 'id' : 'inbox-id', 'displayName' : 'Inbox', 'parentFolderId' : 'root' },
+    { 'id' : 'logger-id', 'displayName' : 'Logger', 'parentFolderId' : 'inbox-id' },
+    { 'id' : 'device-id', 'displayName' : 'Device', 'parentFolderId' : 'logger-id' },
+    { 'id' : 'archive-id', 'displayName' : 'Archive', 'parentFolderId' : 'root' },
+    { 'id' : 'archive-logger-id', 'displayName' : 'Logger', 'parentFolderId' : 'archive-id' },
+]
+
+_HEADERS = { 'Authorization' : 'Bearer test' }
+
+@pytest.fixture
+def fetches(tmp_path, monkeypatch):
+    """Runs in an empty directory with no index in memory; FolderIndex.fetch returns
+    _FOLDERS and records how often it was called."""
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(MS_Graph_Mail, '_folder_indexes', {})
+    calls = []
+    def fetch(headers):
+        calls.append(headers)
+        return FolderIndex(list(_FOLDERS))
+    monkeypatch.setattr(FolderIndex, 'fetch', staticmethod(fetch))
+    return calls
+
+def test_resolve_nested_path():
+    index = FolderIndex(_FOLDERS)
+    assert index.resolve('Inbox/Logger/Device') == 'device-id'
+    assert index.resolve('/inbox/LOGGER/device/') == 'device-id'
+
+def test_resolve_keeps_same_names_apart():
+    index = FolderIndex(_FOLDERS)
+    assert index.resolve('Inbox/Logger') == 'logger-id'
+    assert index.resolve('Archive/Logger') == 'archive-logger-id'
+
+def test_resolve_missing_path():
+    index = FolderIndex(_FOLDERS)
+    assert index.resolve('Inbox/Nope') is None
+    assert index.resolve('Logger') is None
+
+def test_is_expired():
+    index = FolderIndex(_FOLDERS, fetched_at=1000)
+    assert index.is_expired(ttl=60)
+    assert not FolderIndex(_FOLDERS).is_expired(ttl=60)
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'folder_index.json')
+    FolderIndex(_FOLDERS).save(path)
+    assert FolderIndex.load(path).resolve('Inbox/Logger/Device') == 'device-id'
+
+def test_load_expired_or_missing(tmp_path):
+    path = str(tmp_path / 'folder_index.json')
+    assert FolderIndex.load(path) is None
+    FolderIndex(_FOLDERS, fetched_at=1000).save(path)
+    assert FolderIndex.load(path) is None
+
+def test_inbox_needs_no_index(fetches):
+    assert MS_Graph_Mail.get_folder_ids('Inbox', headers=_HEADERS) == { 'inbox' : 'inbox' }
+    assert not fetches
+
+def test_index_is_fetched_once(fetches):
+    paths = 'Inbox/Logger;Archive/Logger'
+    expected = { 'Inbox/Logger' : 'logger-id', 'Archive/Logger' : 'archive-logger-id' }
+    assert MS_Graph_Mail.get_folder_ids(paths, headers=_HEADERS) == expected
+    assert MS_Graph_Mail.get_folder_ids(paths, headers=_HEADERS) == expected
+    assert len(fetches) == 1
+
+def test_missing_path_only_refreshes_an_old_index(fetches):
+    for _ in range(3):
+        assert MS_Graph_Mail.get_folder_ids('Inbox/Nope', headers=_HEADERS) == {}
+    assert len(fetches) == 1
+
+    MS_Graph_Mail._folder_indexes[None].fetched_at -= MS_Graph_Mail._FOLDER_REFRESH_AGE + 1
+    assert MS_Graph_Mail.get_folder_ids('Inbox/Nope', headers=_HEADERS) == {}
+    assert len(fetches) == 2
+
+class _DeltaServer:
+    '''Stands in for _get_json: answers urls from `pages`, counting the requests.'''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.urls = []
+
+    def __call__(self, url, params = None, headers = None):
+        self.urls.append(url)
+        return self.pages[url]
+
+def _message(id, subject = 'Hello'):
+    return { 'id' : id, 'subject' : subject, 'receivedDateTime' : '2024-05-01T10:00:00Z' }
+
+_DELTA = f"{MS_Graph_Mail.GRAPH_ROOT}/me/mailFolders/inbox/messages/delta"
+
+def test_sync_follows_pages_and_stores_the_delta_link(tmp_path, monkeypatch):
+    delta_file = str(tmp_path / 'delta_links.json')
+    server = _DeltaServer({
+        _DELTA    : (200, { 'value' : [ _message('a') ], '@odata.nextLink' : 'page-2' }),
+        'page-2'  : (200, { 'value' : [ _message('b') ], '@odata.deltaLink' : 'delta-1' }),
+        'delta-1' : (200, { 'value' : [ _message('b', 'Edited'),
+                                        { 'id' : 'a', '@removed' : {} } ],
+                            '@odata.deltaLink' : 'delta-2' }),
+    })
+    monkeypatch.setattr(MS_Graph_Mail, '_get_json', server)
+
+    [ result ] = MS_Graph_Mail.sync_messages(headers=_HEADERS, delta_file=delta_file)
+    assert result.resynced
+    assert [ message['id'] for message in result.changed ] == [ 'a', 'b' ]
+
+    [ result ] = MS_Graph_Mail.sync_messages(headers=_HEADERS, delta_file=delta_file)
+    assert not result.resynced
+    assert [ message['subject'] for message in result.changed ] == [ 'Edited' ]
+    assert result.removed == [ 'a' ]
+    assert server.urls == [ _DELTA, 'page-2', 'delta-1' ]
+    assert MS_Graph_Mail._load_delta_links(delta_file) == { 'inbox' : 'delta-2' }
+
+def test_expired_delta_link_resyncs_and_prunes_the_store(tmp_path, monkeypatch):
+    from message_store import MessageStore
+
+    delta_file = str(tmp_path / 'delta_links.json')
+    MS_Graph_Mail._save_delta_links({ 'inbox' : 'expired' }, delta_file)
+    store = MessageStore(str(tmp_path / 'messages.db'))
+    store.add_messages([ _message('kept'), _message('deleted') ], 'inbox')
+
+    monkeypatch.setattr(MS_Graph_Mail, '_get_json', _DeltaServer({
+        'expired' : (410, None),
+        _DELTA    : (200, { 'value' : [ _message('kept') ], '@odata.deltaLink' : 'fresh' }),
+    }))
+
+    [ result ] = MS_Graph_Mail.sync_messages(headers=_HEADERS, delta_file=delta_file,
+                                             store=store)
+    assert result.resynced
+    assert store.get('kept') is not None
+    assert store.get('deleted') is None
+    assert MS_Graph_Mail._load_delta_links(delta_file) == { 'inbox' : 'fresh' }
+    store.close()
+
+def test_failed_sync_raises(tmp_path, monkeypatch):
+    monkeypatch.setattr(MS_Graph_Mail, '_get_json', _DeltaServer({ _DELTA : (500, None) }))
+    with pytest.raises(RuntimeError):
+        MS_Graph_Mail.sync_messages(headers=_HEADERS, delta_file=str(tmp_path / 'links.json'))
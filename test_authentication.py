@@ -0,0 +1,129 @@
+import json
+from time import time
+import pytest
+import authentication, MS_Graph_Mail
+from authentication import TokenPool, TokenProvider
+
+def _token(oid, username, access_token):
+    # No refresh token, so no background renewal gets scheduled
+    return { 'access_token' : access_token, 'expires_on' : int(time()) + 3600,
+             'id_token_claims' : { 'oid' : oid, 'tid' : 'tenant',
+                                   'preferred_username' : username } }
+
+@pytest.fixture
+def pool(tmp_path):
+    token_file = tmp_path / 'tokens.json'
+    token_file.write_text(json.dumps({
+        'ann.tenant' : _token('ann', 'Ann@example.org', 'token-ann'),
+        'bob.tenant' : _token('bob', 'bob@example.org', 'token-bob') }))
+    pool = TokenPool(str(token_file))
+    yield pool
+    pool.close()
+
+def test_pool_hands_out_each_accounts_token(pool):
+    assert pool.get_headers('ann.tenant')['Authorization'] == 'Bearer token-ann'
+    assert pool.get_headers('bob.tenant')['Authorization'] == 'Bearer token-bob'
+    assert sorted(pool.accounts()) == [ 'ann.tenant', 'bob.tenant' ]
+
+def test_usernames_are_aliases(pool):
+    assert pool.provider('ann@example.org') is pool.provider('ann.tenant')
+    assert pool.get_headers('ANN@example.org')['Authorization'] == 'Bearer token-ann'
+
+def test_account_of_headers(pool):
+    assert authentication.account_of(pool.get_headers('bob@example.org')) == 'bob.tenant'
+    assert authentication.account_of({ 'Authorization' : 'Bearer unknown' }) is None
+    assert authentication.account_of(None) is None
+
+def test_account_of_forgets_replaced_tokens(pool):
+    provider = pool.provider('ann.tenant')
+    headers = provider.get_headers()
+    provider.invalidate()
+    assert authentication.account_of(headers) is None
+
+def test_default_provider_without_claims(tmp_path):
+    token_file = tmp_path / 'token.json'
+    token_file.write_text(json.dumps({ 'access_token' : 'token-default',
+                                       'expires_on' : int(time()) + 3600 }))
+    provider = TokenProvider(str(token_file))
+    assert authentication.account_of(provider.get_headers()) is None
+
+def test_mailbox_key_per_account(pool):
+    root = MS_Graph_Mail.GRAPH_ROOT
+    ann, bob = pool.get_headers('ann.tenant'), pool.get_headers('bob.tenant')
+
+    assert MS_Graph_Mail.mailbox_key(f'{root}/me/messages', ann) == 'me/ann.tenant'
+    assert MS_Graph_Mail.mailbox_key(f'{root}/me/messages', bob) == 'me/bob.tenant'
+    assert MS_Graph_Mail.mailbox_key(f'{root}/me/messages') == 'me'
+    assert MS_Graph_Mail.mailbox_key(f'{root}/$batch', bob) == 'me/bob.tenant'
+    assert MS_Graph_Mail.mailbox_key(f'{root}/users/Carl@example.org/messages',
+                                     ann) == 'users/carl@example.org'
+
+def test_folder_index_per_account(pool, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(MS_Graph_Mail, '_folder_indexes', {})
+    trees = { 'Bearer token-ann' : 'ann-logger', 'Bearer token-bob' : 'bob-logger' }
+    monkeypatch.setattr(MS_Graph_Mail.FolderIndex, 'fetch', staticmethod(
+        lambda headers: MS_Graph_Mail.FolderIndex([ {
+            'id' : trees[headers['Authorization']], 'displayName' : 'Logger' } ])))
+
+    for account, folder_id in (('ann.tenant', 'ann-logger'), ('bob@example.org', 'bob-logger')):
+        headers = pool.get_headers(account)
+        assert MS_Graph_Mail.get_folder_ids('Logger', headers) == { 'Logger' : folder_id }
+    assert (tmp_path / 'folder_index.ann.tenant.json').exists()
+    assert (tmp_path / 'folder_index.bob.tenant.json').exists()
+
+def _refresh_token(secret, modified):
+    return { 'secret' : secret, 'last_modification_time' : str(modified) }
+
+def test_merge_msal_state_keeps_both_processes_entries():
+    saved = { 'RefreshToken' : { 'ann' : _refresh_token('ann-1', 100) },
+              'Account' : { 'ann' : { 'username' : 'ann' } } }
+    current = { 'RefreshToken' : { 'bob' : _refresh_token('bob-1', 100) },
+                'Account' : { 'bob' : { 'username' : 'bob' } } }
+    merged = authentication._merge_msal_state(saved, current)
+    assert sorted(merged['RefreshToken']) == [ 'ann', 'bob' ]
+    assert sorted(merged['Account']) == [ 'ann', 'bob' ]
+
+def test_merge_msal_state_newer_entry_wins():
+    saved = { 'RefreshToken' : { 'ann' : _refresh_token('from-disk', 200) },
+              'AccessToken' : { 'ann' : { 'secret' : 'from-disk', 'cached_at' : '100' } } }
+    current = { 'RefreshToken' : { 'ann' : _refresh_token('in-memory', 100) },
+                'AccessToken' : { 'ann' : { 'secret' : 'in-memory', 'cached_at' : '300' } } }
+    merged = authentication._merge_msal_state(saved, current)
+    assert merged['RefreshToken']['ann']['secret'] == 'from-disk'
+    assert merged['AccessToken']['ann']['secret'] == 'in-memory'
+
+def test_merge_msal_state_tie_goes_to_this_process():
+    merged = authentication._merge_msal_state(
+        { 'RefreshToken' : { 'ann' : _refresh_token('from-disk', 100) } },
+        { 'RefreshToken' : { 'ann' : _refresh_token('in-memory', 100) } })
+    assert merged['RefreshToken']['ann']['secret'] == 'in-memory'
+
+def test_merge_msal_state_odd_entries():
+    merged = authentication._merge_msal_state(
+        { 'AppMetadata' : 'from-disk', 'IdToken' : { 'ann' : { 'cached_at' : 'never' } } },
+        { 'AppMetadata' : { 'app' : {} }, 'IdToken' : { 'ann' : { 'cached_at' : '1' } } })
+    assert merged['AppMetadata'] == { 'app' : {} }
+    assert merged['IdToken']['ann'] == { 'cached_at' : '1' }
+
+def test_read_msal_state(tmp_path):
+    cache_file = tmp_path / 'msal_cache.bin'
+    assert authentication._read_msal_state(str(cache_file)) == {}
+    cache_file.write_text('')
+    assert authentication._read_msal_state(str(cache_file)) == {}
+    cache_file.write_text('{"Account" : {}}')
+    assert authentication._read_msal_state(str(cache_file)) == { 'Account' : {} }
+
+def test_pools_sharing_a_file_keep_each_others_accounts(tmp_path):
+    token_file = str(tmp_path / 'tokens.json')
+    first, second = TokenPool(token_file), TokenPool(token_file)
+    assert first.accounts() == second.accounts() == []
+
+    first.save('ann@example.org', _token('ann', 'ann@example.org', 'token-ann'))
+    second.save('bob@example.org', _token('bob', 'bob@example.org', 'token-bob'))
+
+    third = TokenPool(token_file)
+    assert sorted(third.accounts()) == [ 'ann.tenant', 'bob.tenant' ]
+    assert first.get_headers('bob@example.org')['Authorization'] == 'Bearer token-bob'
+    for pool in (first, second, third):
+        pool.close()
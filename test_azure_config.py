@@ -0,0 +1,88 @@
+import os
+import pytest
+from azure_config import AzureConfig, ConfigError, load_config
+
+_CONFIG = '''
+[Tenant]
+id = tenant-id
+
+[Client]
+id = client-id
+
+[Scopes]
+mail = Mail.Read
+send = Mail.Send
+
+[Redirect URI]
+base = http://localhost/
+
+[Ports]
+start = 5000
+end = 5010
+
+[Login]
+flow = Device_Code
+timeout = 60
+'''
+
+def _replace(entry, line):
+    return _CONFIG.replace(entry, line)
+
+def test_parse():
+    config = AzureConfig.parse(_CONFIG)
+    assert (config.tenant_id, config.client_id) == ('tenant-id', 'client-id')
+    assert config.scopes == ('Mail.Read', 'Mail.Send')
+    assert config.authority == 'https://login.microsoftonline.com/tenant-id'
+    assert (config.redirect_base, config.redirect_host) == ('http://localhost', 'localhost')
+    assert config.ports == (5000, 5010)
+    assert (config.login_flow, config.login_timeout) == ('device_code', 60)
+
+def test_defaults():
+    config = AzureConfig.parse('[Tenant]\nid = t\n[Client]\nid = c\n[Scopes]\nmail = Mail.Read\n')
+    assert config.redirect_base is None and config.redirect_host is None
+    assert config.ports == (0, 0)
+    assert (config.login_flow, config.login_timeout) == ('auto', 300)
+    assert AzureConfig.parse(_replace('end = 5010', '')).ports == (5000, 5000)
+
+@pytest.mark.parametrize('entry, line, message', [
+    ('id = tenant-id', 'id =', '[Tenant] id is missing'),
+    ('[Client]\nid = client-id', '', '[Client] id is missing'),
+    ('mail = Mail.Read\nsend = Mail.Send', 'mail =', '[Scopes] has no scopes'),
+    ('[Scopes]\nmail = Mail.Read\nsend = Mail.Send', '', '[Scopes] is missing'),
+    ('base = http://localhost/', 'base = http://localhost:5000',
+     "[Redirect URI] base must look like http://localhost, not 'http://localhost:5000'"),
+    ('start = 5000', 'start = 50OO', "[Ports] start must be a number, not '50OO'"),
+    ('end = 5010', 'end = 70000', '[Ports] end must be between 0 and 65535'),
+    ('end = 5010', 'end = 4000', '[Ports] end is lower than start'),
+    ('flow = Device_Code', 'flow = web', "[Login] flow must be one of auto, browser, "
+                                         "device_code, not 'web'"),
+    ('timeout = 60', 'timeout = soon', "[Login] timeout must be a number, not 'soon'"),
+    ('timeout = 60', 'timeout = 0', '[Login] timeout must be positive'),
+])
+def test_errors_name_the_entry(entry, line, message):
+    with pytest.raises(ConfigError) as error:
+        AzureConfig.parse(_replace(entry, line), 'test.cnf')
+    assert str(error.value) == f'test.cnf: {message}'
+
+def test_syntax_error():
+    with pytest.raises(ConfigError, match='^test.cnf: '):
+        AzureConfig.parse('id = outside a section', 'test.cnf')
+
+def test_load_config_parses_only_changed_files(tmp_path):
+    path = tmp_path / 'azure.cnf'
+    path.write_text(_CONFIG)
+    config = load_config(str(path))
+    assert load_config(str(path)) is config
+
+    path.write_text(_replace('tenant-id', 'other-tenant'))
+    os.utime(path, ns=(0, 0))
+    assert load_config(str(path)).tenant_id == 'other-tenant'
+
+def test_load_config_errors(tmp_path):
+    with pytest.raises(ConfigError, match="Can't read"):
+        load_config(str(tmp_path / 'missing.cnf'))
+
+    path = tmp_path / 'azure.cnf'
+    path.write_text(_replace('id = tenant-id', ''))
+    with pytest.raises(ConfigError, match=r'\[Tenant\] id is missing'):
+        load_config(str(path))
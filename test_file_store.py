@@ -0,0 +1,75 @@
+import json, os, threading
+import pytest
+import file_store
+from file_store import FileLock, write_atomic, write_json, read_json
+
+def test_write_atomic_replaces_the_file(tmp_path):
+    path = tmp_path / 'data.txt'
+    path.write_text('old')
+    write_atomic(str(path), 'new')
+    assert path.read_text() == 'new'
+    assert os.listdir(tmp_path) == [ 'data.txt' ]
+
+def test_write_atomic_failure_leaves_the_file_alone(tmp_path, monkeypatch):
+    path = tmp_path / 'data.txt'
+    path.write_text('old')
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        write_atomic(str(path), 'new')
+    assert path.read_text() == 'old'
+    assert os.listdir(tmp_path) == [ 'data.txt' ]
+
+def test_read_json_parses_only_changed_files(tmp_path, monkeypatch):
+    path = str(tmp_path / 'data.json')
+    write_json(path, { 'a' : 1 })
+
+    loads = []
+    real_load = json.load
+    monkeypatch.setattr(json, 'load', lambda f: loads.append(1) or real_load(f))
+
+    # Remembered from write_json
+    assert read_json(path) == { 'a' : 1 }
+    assert read_json(path) is read_json(path)
+    assert loads == []
+
+    # Changed by someone else
+    with open(path, 'w') as f:
+        f.write('{"a" : 2, "b" : 3}')
+    assert read_json(path) == { 'a' : 2, 'b' : 3 }
+    assert read_json(path) == { 'a' : 2, 'b' : 3 }
+    assert loads == [ 1 ]
+
+def test_read_json_errors(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        read_json(str(tmp_path / 'missing.json'))
+    (tmp_path / 'broken.json').write_text('{')
+    with pytest.raises(ValueError):
+        read_json(str(tmp_path / 'broken.json'))
+
+def _blocks(lock, other):
+    '''True if `other` can't be taken by another thread while `lock` is held.'''
+
+    taken = threading.Event()
+    def take():
+        with other:
+            taken.set()
+
+    with lock:
+        thread = threading.Thread(target=take)
+        thread.start()
+        blocked = not taken.wait(0.2)
+    thread.join()
+    return blocked
+
+def test_file_lock_excludes_other_threads(tmp_path):
+    path = str(tmp_path / 'data.lock')
+    assert _blocks(FileLock(path), FileLock(path))
+
+def test_file_lock_slots_are_independent(tmp_path):
+    path = str(tmp_path / 'data.lock')
+    assert not _blocks(FileLock(path, 1), FileLock(path, 2))
+    assert not _blocks(FileLock.for_key(path, 'ann'), FileLock(path))
+    assert FileLock.for_key(path, 'ann').slot == FileLock.for_key(path, 'ann').slot
+    assert 1 <= FileLock.for_key(path, 'bob').slot <= file_store._KEY_SLOTS
@@ -0,0 +1,67 @@
+import io, json
+import pytest
+from json_stream import CollectionReader
+from MS_Graph_Mail import MessageRecord
+
+def _reader(data, chunk_size = 64 * 1024):
+    if isinstance(data, dict):
+        data = json.dumps(data)
+    return CollectionReader(io.BytesIO(data.encode()).read, chunk_size=chunk_size)
+
+_PAGE = { '@odata.context' : 'messages',
+          'value' : [ { 'id' : str(i), 'subject' : f'Ünïcode {i} ✓', 'size' : 12345 + i }
+                        for i in range(50) ],
+          '@odata.nextLink' : 'next-page' }
+
+@pytest.mark.parametrize('chunk_size', [ 1, 7, 64 * 1024 ])
+def test_items_and_members_any_chunk_size(chunk_size):
+    reader = _reader(_PAGE, chunk_size)
+    assert list(reader) == _PAGE['value']
+    assert reader.members == { '@odata.context' : 'messages', '@odata.nextLink' : 'next-page' }
+
+def test_members_after_the_array_come_once_read():
+    reader = _reader(_PAGE)
+    items = iter(reader)
+    next(items)
+    assert '@odata.nextLink' not in reader.members
+    list(items)
+    assert reader.members['@odata.nextLink'] == 'next-page'
+
+@pytest.mark.parametrize('data', [ '{}', '{"value" : []}', ' { "value" : [ ] , "x" : 1 } ' ])
+def test_empty_collections(data):
+    assert list(_reader(data)) == []
+
+def test_number_split_across_chunks():
+    assert list(_reader('{"value":[1234567,89]}', chunk_size=3)) == [ 1234567, 89 ]
+
+def test_other_key():
+    reader = CollectionReader(io.BytesIO(b'{"value" : 1, "responses" : [2, 3]}').read,
+                              key='responses')
+    assert list(reader) == [ 2, 3 ]
+    assert reader.members == { 'value' : 1 }
+
+@pytest.mark.parametrize('data', [ '[1, 2]', '{"value" : [1, 2}', '{"value" : [1, 2]',
+                                   '{"value" : [1 2]}', '{1 : 2}' ])
+def test_malformed(data):
+    with pytest.raises(json.JSONDecodeError):
+        list(_reader(data))
+
+_MESSAGE = { '@odata.etag' : 'W/"1"', 'id' : 'm1', 'subject' : 'Report',
+             'receivedDateTime' : '2024-05-01T10:00:00Z',
+             'from' : { 'emailAddress' : { 'name' : 'Ann', 'address' : 'ann@example.org' } },
+             'body' : { 'contentType' : 'html', 'content' : '<p>' + 'x' * 1000 + '</p>' },
+             'isRead' : False }
+
+@pytest.mark.parametrize('lazy_body', [ False, True ])
+def test_message_record(lazy_body):
+    record = MessageRecord(_MESSAGE, lazy_body)
+    assert (record.id, record.subject, record.received) == (
+        'm1', 'Report', '2024-05-01T10:00:00Z')
+    assert (record.sender, record.sender_name, record.body_type) == (
+        'ann@example.org', 'Ann', 'html')
+    assert record.body == _MESSAGE['body']['content']
+    assert record.extra == { 'isRead' : False }
+
+def test_message_record_unselected_fields():
+    record = MessageRecord({ 'id' : 'm2', 'subject' : 'Hi' }, lazy_body=True)
+    assert record.sender is None and record.body is None and record.extra is None
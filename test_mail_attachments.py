@@ -0,0 +1,109 @@
+import io, os
+import pytest
+import MS_Graph_Mail, mail_attachments
+from mail_attachments import Attachment, download_attachment
+
+_CONTENT = bytes(range(256)) * 40
+
+def _attachment(name = 'report.pdf', kind = 'fileAttachment', message_id = 'm1', id = 'a1'):
+    return Attachment(message_id, id, name, 'application/pdf', len(_CONTENT), False, kind)
+
+@pytest.mark.parametrize('content_range, start, size', [
+    ('bytes 100-199/1000', 100, 1000),
+    ('bytes */1000', None, 1000),
+    ('bytes 0-9/*', 0, None),
+    (None, None, None), ('', None, None), ('garbage', None, None),
+])
+def test_content_range(content_range, start, size):
+    assert mail_attachments._range_start(content_range) == start
+    assert mail_attachments._range_size(content_range) == size
+
+def test_file_name():
+    name = mail_attachments._file_name(_attachment('a/b:c?.pdf'))
+    assert name.endswith('-a_b_c_.pdf')
+    assert name == mail_attachments._file_name(_attachment('a/b:c?.pdf'))
+    assert name != mail_attachments._file_name(_attachment('a/b:c?.pdf', message_id='m2'))
+    assert mail_attachments._file_name(_attachment(' .. ')).endswith('-attachment')
+    assert mail_attachments._file_name(_attachment('Re: hi', 'itemAttachment')) \
+        .endswith('-Re_ hi.eml')
+
+class _Response:
+    def __init__(self, status, body = b'', headers = None, fail_after = None):
+        self.status = status
+        self.headers = headers or {}
+        self._body = io.BytesIO(body)
+        self._fail_after = fail_after
+
+    def read(self, size):
+        if self._fail_after is not None and self._body.tell() >= self._fail_after:
+            raise ConnectionResetError('connection reset')
+        return self._body.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class _Server:
+    '''Stands in for send_request, serving _CONTENT. `responses` are functions of the
+    requested offset, one per request.'''
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.ranges = []
+
+    def __call__(self, method, url, headers = None, stream = False):
+        self.ranges.append(headers.get('Range'))
+        offset = int(headers['Range'][6:-1]) if 'Range' in headers else 0
+        return self.responses.pop(0)(offset)
+
+def _full(fail_after = None):
+    return lambda offset: _Response(200, _CONTENT, fail_after=fail_after)
+
+def _partial(offset):
+    return _Response(206, _CONTENT[offset:],
+                     { 'Content-Range' : f'bytes {offset}-{len(_CONTENT) - 1}/{len(_CONTENT)}' })
+
+def _download(tmp_path, monkeypatch, server):
+    monkeypatch.setattr(MS_Graph_Mail, 'send_request', server)
+    return download_attachment(_attachment(), str(tmp_path), chunk_size=1000,
+                               headers={ 'Authorization' : 'Bearer test' })
+
+def test_interrupted_download_resumes(tmp_path, monkeypatch):
+    server = _Server(_full(fail_after=3000), _partial)
+    result = _download(tmp_path, monkeypatch, server)
+
+    assert result.error is None
+    assert server.ranges == [ None, 'bytes=3000-' ]
+    with open(result.path, 'rb') as f:
+        assert f.read() == _CONTENT
+    assert os.listdir(tmp_path) == [ os.path.basename(result.path) ]
+
+def test_part_file_from_an_earlier_run(tmp_path, monkeypatch):
+    path = tmp_path / mail_attachments._file_name(_attachment())
+    (tmp_path / f'{path.name}.part').write_bytes(_CONTENT[:5000])
+
+    result = _download(tmp_path, monkeypatch, _Server(_partial))
+    assert (result.bytes, result.resumed) == (len(_CONTENT), 5000)
+    assert path.read_bytes() == _CONTENT
+
+def test_server_ignoring_the_range_starts_over(tmp_path, monkeypatch):
+    (tmp_path / f'{mail_attachments._file_name(_attachment())}.part').write_bytes(b'stale')
+    result = _download(tmp_path, monkeypatch, _Server(_full()))
+    with open(result.path, 'rb') as f:
+        assert f.read() == _CONTENT
+
+def test_complete_part_file(tmp_path, monkeypatch):
+    (tmp_path / f'{mail_attachments._file_name(_attachment())}.part').write_bytes(_CONTENT)
+    unsatisfiable = lambda offset: _Response(416, headers={
+        'Content-Range' : f'bytes */{len(_CONTENT)}' })
+    result = _download(tmp_path, monkeypatch, _Server(unsatisfiable))
+    assert result.error is None and result.bytes == len(_CONTENT)
+
+def test_errors_are_reported(tmp_path, monkeypatch):
+    result = _download(tmp_path, monkeypatch, _Server(lambda offset: _Response(403)))
+    assert isinstance(result.error, RuntimeError) and result.path is None
+
+    result = download_attachment(_attachment(kind='referenceAttachment'), str(tmp_path))
+    assert isinstance(result.error, ValueError)
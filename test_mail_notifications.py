@@ -0,0 +1,162 @@
+import json, urllib.request
+from time import time
+import pytest
+import authentication, MS_Graph_Mail, mail_notifications
+from mail_notifications import NotificationReceiver, SubscriptionManager, Subscription
+
+def _item(client_state, subscription_id = 'sub-1', message_id = 'm1', **extra):
+    return dict({ 'clientState' : client_state, 'subscriptionId' : subscription_id,
+                  'changeType' : 'created', 'resource' : 'me/messages',
+                  'resourceData' : { 'id' : message_id } }, **extra)
+
+def _queued(receiver):
+    return list(receiver.notifications(timeout=0))
+
+def test_accept_carries_the_account():
+    receiver = NotificationReceiver()
+    receiver.register('state-ann', 'sub-1', 'ann.tenant')
+    receiver.register('state-bob', account='bob.tenant')
+
+    assert receiver._accept([ _item('state-ann'), _item('state-bob', 'sub-2', 'm2') ]) == 202
+    assert [ (n.message_id, n.account) for n in _queued(receiver) ] == [
+        ('m1', 'ann.tenant'), ('m2', 'bob.tenant') ]
+
+def test_accept_rejects_unknown_client_states():
+    receiver = NotificationReceiver()
+    receiver.register('state', 'sub-1')
+    assert receiver._accept([ _item('forged'), _item('state', 'sub-other'), _item(None) ]) == 202
+    assert receiver.rejected == 3
+    assert _queued(receiver) == []
+
+    receiver.unregister('state')
+    receiver._accept([ _item('state') ])
+    assert receiver.rejected == 4
+
+def test_accept_full_queue_and_lifecycle():
+    receiver = NotificationReceiver(max_queue=1)
+    receiver.register('state')
+    lifecycle = []
+    receiver.on_lifecycle = lifecycle.append
+
+    assert receiver._accept([ _item('state', lifecycleEvent='missed') ]) == 202
+    assert [ n.lifecycle_event for n in lifecycle ] == [ 'missed' ]
+    assert receiver._accept([ _item('state'), _item('state', message_id='m2') ]) == 503
+
+def _post(url, data):
+    request = urllib.request.Request(url, data, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def test_receiver_over_http():
+    with NotificationReceiver() as receiver:
+        receiver.register('state', 'sub-1')
+        assert _post(f'{receiver.url}/?validationToken=a%20b', b'') == (200, b'a b')
+        assert _post(receiver.url, b'[1]')[0] == 400
+        assert _post(receiver.url, json.dumps({ 'value' : [ _item('state') ] }).encode()) \
+            == (202, b'')
+        assert [ n.message_id for n in receiver.notifications(timeout=1) ] == [ 'm1' ]
+
+class _Renewal:
+    def __init__(self, delay):
+        self.delay = delay
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+@pytest.fixture
+def graph(monkeypatch):
+    """Stands in for Graph: `graph.statuses` are the statuses the next requests get,
+    `graph.requests` records them. Renewals are recorded in `graph.renewals`
+    instead of being scheduled."""
+
+    class Graph:
+        statuses = []
+        requests = []
+        renewals = []
+
+    def request_json(method, url, payload, headers):
+        Graph.requests.append((method, url, payload))
+        status = Graph.statuses.pop(0)
+        if method == 'POST' and status == 201:
+            return status, { 'id' : f'sub-{len(Graph.requests)}',
+                             'expirationDateTime' : payload['expirationDateTime'] }
+        if method == 'PATCH' and status == 200:
+            return status, payload
+        return status, None
+
+    def call_later(delay, fn, *args):
+        Graph.renewals.append(_Renewal(delay))
+        return Graph.renewals[-1]
+
+    monkeypatch.setattr(MS_Graph_Mail, 'request_json', request_json)
+    monkeypatch.setattr(authentication, 'call_later', call_later)
+    monkeypatch.setattr(authentication, 'get_headers', lambda account = None: {})
+    return Graph
+
+def _manager(graph, **options):
+    graph.statuses.append(201)
+    manager = SubscriptionManager('https://example.org/graph', NotificationReceiver(),
+                                  **options)
+    subscription = manager._create('Inbox', 'inbox')
+    return manager, subscription
+
+def test_create_schedules_the_renewal(graph):
+    manager, subscription = _manager(graph, lifetime=3600, renew_margin=600)
+    assert manager.subscriptions() == [ subscription ]
+    assert 2990 < graph.renewals[-1].delay <= 3000
+    assert manager.receiver._client_states[subscription.client_state] == (subscription.id, None)
+
+def test_failed_renewals_back_off(graph, monkeypatch):
+    monkeypatch.setattr(mail_notifications, '_MAX_RETRY_DELAY', 30)
+    manager, subscription = _manager(graph)
+    graph.statuses.extend([ 503 ] * 5)
+    for _ in range(5):
+        manager.renew(subscription.id)
+    assert [ renewal.delay for renewal in graph.renewals[1:] ] == [ 5, 10, 20, 30, 30 ]
+
+    graph.statuses.extend([ 200, 503 ])
+    manager.renew(subscription.id)
+    manager.renew(subscription.id)
+    assert graph.renewals[-1].delay == 5
+
+def test_failed_recreate_keeps_the_subscription(graph):
+    manager, subscription = _manager(graph)
+    expired = subscription._replace(expires=time() - 1)
+    manager._schedule(expired)
+
+    graph.statuses.extend([ 403, 403 ])
+    assert manager.renew(subscription.id) is None
+    assert manager.renew(subscription.id) is None
+    assert manager.subscriptions() == [ expired ]
+    assert [ renewal.delay for renewal in graph.renewals[-2:] ] == [ 5, 10 ]
+    assert list(manager.receiver._client_states) == [ subscription.client_state ]
+
+    graph.statuses.append(201)
+    created = manager.renew(subscription.id)
+    assert manager.subscriptions() == [ created ]
+    assert created.resource == subscription.resource
+    assert list(manager.receiver._client_states) == [ created.client_state ]
+
+def test_gone_subscription_is_recreated(graph):
+    manager, subscription = _manager(graph)
+    graph.statuses.extend([ 404, 201 ])
+    created = manager.renew(subscription.id)
+    assert created.id != subscription.id
+    assert [ method for method, _, _ in graph.requests[-2:] ] == [ 'PATCH', 'POST' ]
+    assert manager.subscriptions() == [ created ]
+
+@pytest.mark.parametrize('value, expected', [
+    ('2024-05-01T10:00:00Z', 1714557600.0),
+    ('2024-05-01T10:00:00.1234567Z', 1714557600.123456),
+    (None, None), ('soon', None),
+])
+def test_parse_time(value, expected):
+    assert mail_notifications._parse_time(value) == pytest.approx(expected)
+
+def test_format_time_round_trips():
+    assert mail_notifications._parse_time(mail_notifications._format_time(1714557600.5)) \
+        == 1714557600.5
@@ -0,0 +1,115 @@
+from datetime import datetime, date, timezone
+import pytest
+from mail_query import MessageQuery, QueryError
+
+_MAY = '2024-05-01T00:00:00+00:00'
+_JUNE = '2024-06-01T00:00:00+00:00'
+
+def _message(sender = 'ann@contoso.com', subject = 'Daily Report',
+             received = '2024-05-10T08:00:00Z', is_read = False):
+    return { 'id' : 'm1', 'subject' : subject, 'receivedDateTime' : received, 'isRead' : is_read,
+             'from' : { 'emailAddress' : { 'address' : sender } },
+             'body' : { 'contentType' : 'text', 'content' : 'All good' } }
+
+def test_default_query():
+    compiled = MessageQuery().compile()
+    assert compiled.params == { '$select' : 'subject,body' }
+    assert compiled.headers == { 'Prefer' : 'outlook.body-content-type="text"' }
+    assert compiled.client_side == ()
+    assert compiled.project(_message()) == { 'subject' : 'Daily Report', 'body' : 'All good' }
+
+def test_filter_and_select():
+    compiled = (MessageQuery().select('sender', 'subject', 'sender').body_type('html')
+                              .sender('ann@contoso.com', "o'neil@contoso.com").unread()
+                              .limit(50).compile())
+    assert compiled.params == {
+        '$select' : 'from,subject',
+        '$filter' : "(from/emailAddress/address eq 'ann@contoso.com' or "
+                    "from/emailAddress/address eq 'o''neil@contoso.com') and isRead eq false",
+        '$top' : 50 }
+    assert compiled.headers == {}
+    assert compiled.fields == ('sender', 'subject') and compiled.limit == 50
+
+def test_ordered_properties_lead_the_filter():
+    compiled = (MessageQuery().unread().received(since=_MAY, until=_JUNE)
+                              .order_by('received', descending=True).compile())
+    assert compiled.params['$filter'] == ('receivedDateTime ge 2024-05-01T00:00:00Z and '
+                                          'receivedDateTime lt 2024-06-01T00:00:00Z and '
+                                          'isRead eq false')
+    assert compiled.params['$orderby'] == 'receivedDateTime desc'
+
+    compiled = MessageQuery().unread().order_by('sent').compile()
+    assert compiled.params['$filter'] == ('sentDateTime ge 1900-01-01T00:00:00Z and '
+                                          'isRead eq false')
+
+def test_client_side_predicates_select_what_they_read():
+    compiled = (MessageQuery().select('id').sender('@Contoso.com')
+                              .where(lambda message: True, ('importance',), 'urgent').compile())
+    assert '$filter' not in compiled.params
+    assert compiled.params['$select'] == 'id,from,importance'
+    assert compiled.client_side == ("sender in ['@contoso.com']", 'urgent')
+    assert compiled.matches(_message('Bob@contoso.com'))
+    assert not compiled.matches(_message('bob@contoso.com.evil'))
+
+def test_search_takes_what_kql_can_express():
+    compiled = (MessageQuery().search('pump').sender('ann@contoso.com').unread()
+                              .subject_contains('daily report')
+                              .received(since=_MAY).compile())
+    assert compiled.params['$search'] == ('"(pump) AND (from:ann@contoso.com) AND '
+                                          '(subject:daily AND subject:report) AND '
+                                          '(received>=2024-05-01)"')
+    assert '$filter' not in compiled.params
+    assert compiled.client_side == ("is_read is False", "subject contains 'daily report'",
+                                    'received in [2024-05-01T00:00:00Z, ...)')
+    assert compiled.matches(_message())
+    assert not compiled.matches(_message(is_read=True))
+    assert not compiled.matches(_message(subject='Report daily'))
+    assert not compiled.matches(_message(received='2024-04-30T23:59:59.1234567Z'))
+
+def test_page_size_and_limit():
+    assert MessageQuery().limit(5000).compile().params['$top'] == 1000
+    assert MessageQuery().limit(5000).page_size(100).compile().params['$top'] == 100
+
+def test_dates():
+    until = date(2024, 5, 2)
+    since = datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+    compiled = MessageQuery().sent(since, until).compile()
+    local_midnight = datetime(2024, 5, 2).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    assert compiled.params['$filter'] == (f'sentDateTime ge 2024-05-01T12:00:00Z and '
+                                          f'sentDateTime lt {local_midnight}')
+
+def test_queries_are_immutable():
+    base = MessageQuery().unread()
+    base.limit(5)
+    base.read()
+    compiled = base.compile()
+    assert compiled.limit is None and compiled.params['$filter'] == 'isRead eq false'
+
+@pytest.mark.parametrize('build', [
+    lambda q: q.select(),
+    lambda q: q.select('subject', 'author'),
+    lambda q: q.body_type('rtf'),
+    lambda q: q.received(),
+    lambda q: q.received(since=_JUNE, until=_MAY),
+    lambda q: q.received(since='last week'),
+    lambda q: q.sent(since=20240501),
+    lambda q: q.sender(),
+    lambda q: q.sender('"ann"@contoso.com'),
+    lambda q: q.subject_contains(''),
+    lambda q: q.search('say "hi"'),
+    lambda q: q.order_by('size'),
+    lambda q: q.order_by('sent').order_by('sent', descending=True),
+    lambda q: q.limit(0),
+    lambda q: q.page_size(1001),
+])
+def test_invalid_queries(build):
+    with pytest.raises(QueryError):
+        build(MessageQuery())
+
+@pytest.mark.parametrize('query', [
+    MessageQuery().search('pump').order_by('received'),
+    MessageQuery().unread().order_by('subject'),
+])
+def test_combinations_graph_rejects(query):
+    with pytest.raises(QueryError):
+        query.compile()
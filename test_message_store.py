@@ -0,0 +1,58 @@
+import pytest
+from message_store import MessageStore
+
+def _message(id, received, subject = 'Report', body = 'All good', sender = 'a@example.org'):
+    return { 'id' : id, 'receivedDateTime' : received, 'subject' : subject,
+             'from' : { 'emailAddress' : { 'address' : sender } },
+             'body' : { 'contentType' : 'text', 'content' : body } }
+
+@pytest.fixture
+def store(tmp_path):
+    store = MessageStore(str(tmp_path / 'messages.db'), batch_size=2)
+    store.add_messages([
+        _message('1', '2024-05-01T08:00:00Z', 'Daily report', 'Pump pressure nominal'),
+        _message('2', '2024-05-02T08:00:00Z', 'Alarm', 'Pump pressure high'),
+        _message('3', '2024-05-03T08:00:00Z', 'Daily REPORT', 'Valve stuck'),
+    ], 'inbox')
+    yield store
+    store.close()
+
+def test_add_flattens_messages(store):
+    assert store.count() == 3
+    assert store.get('2') == { 'id' : '2', 'folder' : 'inbox',
+                               'received' : '2024-05-02T08:00:00Z', 'sender' : 'a@example.org',
+                               'subject' : 'Alarm', 'body_type' : 'text',
+                               'body' : 'Pump pressure high' }
+    assert store.get('missing') is None
+
+def test_add_again_updates_only_the_given_fields(store):
+    store.add_messages([ { 'id' : '2', 'subject' : 'Alarm (cleared)' } ])
+    message = store.get('2')
+    assert message['subject'] == 'Alarm (cleared)'
+    assert message['folder'] == 'inbox'
+    assert message['body'] == 'Pump pressure high'
+    assert store.count() == 3
+
+def test_query_filters_newest_first(store):
+    ids = lambda **filters: [ message['id'] for message in store.iter_messages(**filters) ]
+    assert ids() == [ '3', '2', '1' ]
+    assert ids(subject='report') == [ '3', '1' ]
+    assert ids(since='2024-05-02', until='2024-05-03') == [ '2' ]
+    assert ids(search='pump') == [ '2', '1' ]
+    assert ids(folder='archive') == []
+    assert ids(limit=1, fetch_size=1) == [ '3' ]
+
+def test_search_follows_body_updates(store):
+    store.add_messages([ { 'id' : '3', 'body' : { 'content' : 'Valve replaced' } } ])
+    assert [ message['id'] for message in store.iter_messages(search='stuck') ] == []
+    assert [ message['id'] for message in store.iter_messages(search='replaced') ] == [ '3' ]
+
+def test_remove_messages(store):
+    store.remove_messages([ '1', '3' ])
+    assert store.count('inbox') == 1
+
+def test_retain_messages_prunes_only_the_folder(store):
+    store.add_messages([ _message('4', '2024-05-04T08:00:00Z') ], 'archive')
+    assert store.retain_messages('inbox', iter([ '2' ])) == 2
+    assert store.count('inbox') == 1
+    assert store.count('archive') == 1
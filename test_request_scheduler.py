@@ -0,0 +1,112 @@
+import http.client
+from collections import namedtuple
+from email.utils import formatdate
+from time import time
+import pytest
+from request_scheduler import RequestScheduler, TokenBucket, RetryBudget, parse_retry_after
+
+_Response = namedtuple('_Response', ['status', 'headers'])
+
+class _Clock:
+    '''Fake monotonic clock; sleeping advances it and is recorded.'''
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def _scheduler(clock, **options):
+    return RequestScheduler(clock=clock, sleep=clock.sleep, **options)
+
+def _responses(*statuses, retry_after = None):
+    responses = iter(statuses)
+    headers = {} if retry_after is None else { 'Retry-After' : retry_after }
+    return lambda: _Response(next(responses), headers)
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None), ('3', 3.0), (' 1.5 ', 1.5), ('-4', 0.0), (7, 7.0), ('soon', None),
+])
+def test_parse_retry_after_seconds(value, expected):
+    assert parse_retry_after(value) == expected
+
+def test_parse_retry_after_http_date():
+    assert 55 <= parse_retry_after(formatdate(time() + 60, usegmt=True)) <= 60
+    assert parse_retry_after(formatdate(time() - 60, usegmt=True)) == 0.0
+
+def test_bucket_allows_bursts_then_the_rate():
+    clock = _Clock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    bucket.acquire()
+    assert clock.sleeps == [ pytest.approx(0.5) ]
+
+def test_bucket_pause():
+    clock = _Clock()
+    bucket = TokenBucket(rate=100, capacity=100, clock=clock, sleep=clock.sleep)
+    bucket.pause(10)
+    bucket.acquire()
+    assert clock.now == pytest.approx(10)
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, reserve=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+def test_retry_after_pauses_the_mailbox():
+    clock = _Clock()
+    scheduler = _scheduler(clock)
+    response = scheduler.execute('me', _responses(429, 200, retry_after='5'))
+
+    assert response.status == 200
+    assert clock.now >= 5
+    assert scheduler.stats() == { 'requests' : 1, 'retries' : 1, 'throttled' : 1,
+                                  'budget_exhausted' : 0 }
+
+    # Only that mailbox was paused
+    scheduler._bucket('me').pause(5)
+    before = clock.now
+    scheduler.execute('users/other', _responses(200))
+    assert clock.now == before
+
+def test_gives_up_after_max_retries():
+    clock = _Clock()
+    scheduler = _scheduler(clock, max_retries=2)
+    response = scheduler.execute('me', _responses(503, 503, 503, 200))
+    assert response.status == 503
+    assert scheduler.stats()['retries'] == 2
+
+def test_other_statuses_are_not_retried():
+    clock = _Clock()
+    scheduler = _scheduler(clock)
+    assert scheduler.execute('me', _responses(404)).status == 404
+    assert scheduler.stats()['retries'] == 0
+
+def test_connection_errors_are_retried_then_raised():
+    clock = _Clock()
+    scheduler = _scheduler(clock, max_retries=1)
+    attempts = []
+    def send():
+        attempts.append(1)
+        raise http.client.RemoteDisconnected('gone')
+
+    with pytest.raises(http.client.RemoteDisconnected):
+        scheduler.execute('me', send)
+    assert len(attempts) == 2
+
+def test_empty_budget_stops_retries():
+    clock = _Clock()
+    scheduler = _scheduler(clock, budget=RetryBudget(ratio=0, reserve=0))
+    assert scheduler.execute('me', _responses(429, 200, retry_after='1')).status == 429
+    assert scheduler.stats()['budget_exhausted'] == 1